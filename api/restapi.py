@@ -572,7 +572,7 @@ class OpenBazaarAPI(APIResource):
             for keyword in request.args["keywords"]:
                 if keyword != "":
                     self.kserver.set(digest(keyword.lower()), unhexlify(c.get_contract_id()),
-                                     self.kserver.node.getProto().SerializeToString())
+                                     self.kserver.node.getSerializedProto())
             request.write(json.dumps({"success": True, "id": c.get_contract_id()}))
             request.finish()
             return server.NOT_DONE_YET
@@ -622,7 +622,7 @@ class OpenBazaarAPI(APIResource):
             return server.NOT_DONE_YET
         else:
             for vendor in self.protocol.vendors.values():
-                self.db.vendors.save_vendor(vendor.id.encode("hex"), vendor.getProto().SerializeToString())
+                self.db.vendors.save_vendor(vendor.id.encode("hex"), vendor.getSerializedProto())
             PortMapper().clean_my_mappings(self.kserver.node.port)
             self.protocol.shutdown()
             reactor.stop()
@@ -916,14 +916,22 @@ class OpenBazaarAPI(APIResource):
     @authenticated
     def get_routing_table(self, request):
         nodes = []
-        for bucket in self.kserver.protocol.router.buckets:
+        router = self.kserver.protocol.router
+        for bucket in router.buckets:
             for node in bucket.nodes.values():
+                stats = bucket.stats[node.id]
                 n = {
                     "guid": node.id.encode("hex"),
                     "ip": node.ip,
                     "port": node.port,
                     "vendor": node.vendor,
-                    "nat_type": objects.NATType.Name(node.nat_type)
+                    "nat_type": objects.NATType.Name(node.nat_type),
+                    "last_seen": stats.lastSeen,
+                    "rtt": stats.rtt,
+                    "successes": stats.successes,
+                    "failures": stats.failures,
+                    "consecutive_failures": stats.consecutiveFailures,
+                    "stale": node.id in router.stale
                 }
                 nodes.append(n)
         request.setHeader('content-type', "application/json")
@@ -129,7 +129,7 @@ class WSProtocol(Protocol):
                                 .addCallback(parse_profile, node_to_ask)
                     except Exception:
                         pass
-        self.factory.kserver.get("moderators").addCallback(parse_response)
+        self.factory.kserver.get("moderators", paths=3).addCallback(parse_response)
 
     def get_homepage_listings(self, message_id):
         if message_id not in self.factory.outstanding_listings:
@@ -238,12 +238,18 @@ class WSProtocol(Protocol):
                     listing_json["listing"]["ships_to"].append(str(CountryCode.Name(country)))
                 self.transport.write(str(bleach.clean(json.dumps(listing_json, indent=4), tags=ALLOWED_TAGS)))
 
+        # listings already asked for, as values are streamed in and then returned again at the end
+        asked = set()
+
         def parse_results(values):
             if values is not None:
                 for v in values:
                     try:
                         val = Value()
                         val.ParseFromString(v)
+                        if val.valueKey in asked:
+                            continue
+                        asked.add(val.valueKey)
                         n = objects.Node()
                         n.ParseFromString(val.serializedData)
                         node_to_ask = Node(n.guid, n.nodeAddress.ip, n.nodeAddress.port, n.publicKey,
@@ -262,7 +268,7 @@ class WSProtocol(Protocol):
                                 .addCallback(respond, node_to_ask)
                     except Exception:
                         pass
-        self.factory.kserver.get(keyword.lower()).addCallback(parse_results)
+        self.factory.kserver.get(keyword.lower(), paths=3, onValues=parse_results).addCallback(parse_results)
 
     def dataReceived(self, payload):
         try:
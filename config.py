@@ -30,6 +30,11 @@ DEFAULTS = {
     'libbitcoin_server': 'tcp://libbitcoin1.openbazaar.org:9091',
     'libbitcoin_server_testnet': 'tcp://libbitcoin2.openbazaar.org:9091',
     'resolver': 'http://resolver.onename.com/',
+    'dht_storage': 'sqlite',
+    'dht_max_entries': '100000',
+    'dht_max_bytes': '268435456',
+    'dht_max_per_keyword': '1000',
+    'dht_max_per_origin': '5000',
     'ssl_cert': None,
     'ssl_key': None,
     'ssl': False,
@@ -165,6 +170,11 @@ TRANSACTION_FEE = int(cfg.get('CONSTANTS', 'TRANSACTION_FEE'))
 LIBBITCOIN_SERVER = cfg.get('CONSTANTS', 'LIBBITCOIN_SERVER')
 LIBBITCOIN_SERVER_TESTNET = cfg.get('CONSTANTS', 'LIBBITCOIN_SERVER_TESTNET')
 RESOLVER = cfg.get('CONSTANTS', 'RESOLVER')
+DHT_STORAGE = cfg.get('CONSTANTS', 'DHT_STORAGE')
+DHT_MAX_ENTRIES = int(cfg.get('CONSTANTS', 'DHT_MAX_ENTRIES'))
+DHT_MAX_BYTES = int(cfg.get('CONSTANTS', 'DHT_MAX_BYTES'))
+DHT_MAX_PER_KEYWORD = int(cfg.get('CONSTANTS', 'DHT_MAX_PER_KEYWORD'))
+DHT_MAX_PER_ORIGIN = int(cfg.get('CONSTANTS', 'DHT_MAX_PER_ORIGIN'))
 SSL = str_to_bool(cfg.get('AUTHENTICATION', 'SSL'))
 SSL_CERT = cfg.get('AUTHENTICATION', 'SSL_CERT')
 SSL_KEY = cfg.get('AUTHENTICATION', 'SSL_KEY')
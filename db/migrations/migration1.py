@@ -0,0 +1,28 @@
+__author__ = 'chris'
+
+import sqlite3 as lite
+
+
+def migrate(database_path, ttl=604800):
+    """
+    Move the dht table from hex encoded TEXT keywords and a birthday column to
+    BLOB keywords, an expires_at column and a unique (keyword, id) index. If
+    there are duplicate (keyword, id) rows the newest one is kept.
+    """
+    conn = lite.connect(database_path)
+    conn.text_factory = str
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    cursor.execute('''BEGIN''')
+    cursor.execute('''ALTER TABLE dht RENAME TO dht_old''')
+    cursor.execute('''CREATE TABLE dht(keyword BLOB, id BLOB, value BLOB, expires_at FLOAT)''')
+    cursor.execute('''CREATE UNIQUE INDEX index_dht_keyword_id ON dht(keyword, id)''')
+    cursor.execute('''CREATE INDEX index_dht_expires_at ON dht(expires_at)''')
+    rows = conn.cursor()
+    rows.execute('''SELECT keyword, id, value, birthday FROM dht_old ORDER BY birthday DESC''')
+    for keyword, key, value, birthday in rows:
+        cursor.execute('''INSERT OR IGNORE INTO dht(keyword, id, value, expires_at) VALUES (?,?,?,?)''',
+                       (lite.Binary(keyword.decode("hex")), lite.Binary(key), lite.Binary(value), birthday + ttl))
+    cursor.execute('''DROP TABLE dht_old''')
+    cursor.execute('''COMMIT''')
+    conn.close()
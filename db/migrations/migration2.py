@@ -0,0 +1,21 @@
+__author__ = 'chris'
+
+import sqlite3 as lite
+
+
+def migrate(database_path):
+    """
+    Add the origin and distance columns used by the dht storage quota. The
+    distance depends on our node id, so it's left NULL here and filled in by
+    the storage the first time it's opened with a quota.
+    """
+    conn = lite.connect(database_path)
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    cursor.execute('''BEGIN''')
+    cursor.execute('''ALTER TABLE dht ADD COLUMN origin BLOB''')
+    cursor.execute('''ALTER TABLE dht ADD COLUMN distance INTEGER''')
+    cursor.execute('''CREATE INDEX index_dht_origin ON dht(origin)''')
+    cursor.execute('''CREATE INDEX index_dht_distance ON dht(distance)''')
+    cursor.execute('''COMMIT''')
+    conn.close()
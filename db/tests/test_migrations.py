@@ -0,0 +1,69 @@
+import os
+import time
+import unittest
+import sqlite3 as lite
+
+from db.migrations import migration1, migration2
+from dht.storage import PersistentStorage, StorageQuota
+from dht.utils import digest
+
+
+class MigrationsTest(unittest.TestCase):
+    def setUp(self):
+        self.path = "test_migrations.db"
+        self.keyword = digest("shoes")
+        conn = lite.connect(self.path)
+        conn.text_factory = str
+        cursor = conn.cursor()
+        cursor.execute('''CREATE TABLE dht(keyword TEXT, id BLOB, value BLOB, birthday FLOAT)''')
+        now = time.time()
+        for key, value, birthday in (("key1", "old", now - 20), ("key1", "new", now - 10), ("key2", "value", now)):
+            cursor.execute('''INSERT INTO dht(keyword, id, value, birthday) VALUES (?,?,?,?)''',
+                           (self.keyword.encode("hex"), key, value, birthday))
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_migration1(self):
+        migration1.migrate(self.path, ttl=100)
+        conn = lite.connect(self.path)
+        conn.text_factory = str
+        cursor = conn.cursor()
+        cursor.execute('''SELECT keyword, id, value, expires_at FROM dht ORDER BY id''')
+        rows = cursor.fetchall()
+        self.assertEqual([(str(k), str(i), str(v)) for k, i, v, _ in rows],
+                         [(self.keyword, "key1", "new"), (self.keyword, "key2", "value")])
+        self.assertTrue(all(85 < expires_at - time.time() <= 100 for _, _, _, expires_at in rows))
+        cursor.execute('''SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='dht' ORDER BY name''')
+        self.assertEqual(cursor.fetchall(), [("index_dht_expires_at",), ("index_dht_keyword_id",)])
+        conn.close()
+
+    def test_storage_migrates_on_open(self):
+        p = PersistentStorage(self.path)
+        self.assertEqual(list(p.iterkeys()), [self.keyword])
+        self.assertEqual(p.getSpecific(self.keyword, "key1"), "new")
+        self.assertEqual(p.getSpecific(self.keyword, "key2"), "value")
+
+    def test_migration2(self):
+        migration1.migrate(self.path)
+        migration2.migrate(self.path)
+        conn = lite.connect(self.path)
+        cursor = conn.cursor()
+        cursor.execute('''PRAGMA table_info(dht)''')
+        self.assertEqual([column[1] for column in cursor.fetchall()],
+                         ["keyword", "id", "value", "expires_at", "origin", "distance"])
+        cursor.execute('''SELECT COUNT(*) FROM dht WHERE origin IS NULL AND distance IS NULL''')
+        self.assertEqual(cursor.fetchone()[0], 2)
+        conn.close()
+
+    def test_storage_fills_distances_on_open(self):
+        p = PersistentStorage(self.path, quota=StorageQuota(digest("node")))
+        cursor = p.db.cursor()
+        cursor.execute('''SELECT DISTINCT distance FROM dht''')
+        self.assertEqual(cursor.fetchall(),
+                         [(StorageQuota(digest("node")).distance(self.keyword) >> StorageQuota.DISTANCE_SHIFT,)])
+        self.assertEqual((p.entries, p.size), (2, 16))
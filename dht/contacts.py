@@ -0,0 +1,97 @@
+"""
+Remembers where recently seen peers can be reached, by guid.
+
+Copyright (c) 2015 OpenBazaar
+"""
+
+from collections import OrderedDict
+
+from twisted.internet import reactor
+
+from dht.node import Node
+from protos import objects
+
+
+class ContactCache(object):
+    """
+    The node, with its address, relay and NAT type, of each peer we've had a verified
+    message from recently, so resolving a guid we've just heard from doesn't need a
+    crawl. It holds at most maxsize peers and drops the least recently used first.
+
+    hits and misses count the guids get() did and didn't know.
+    """
+
+    def __init__(self, maxsize=5000, clock=reactor):
+        """
+        Args:
+            maxsize: The most peers to remember.
+            clock: The reactor used to tell the time.
+        """
+        self.maxsize = maxsize
+        self.clock = clock
+        # guid -> (last seen, node), least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, guid):
+        return guid in self.entries
+
+    def add(self, node, seen=None):
+        """
+        Record that node was just heard from, or at seen if it's given.
+        """
+        self.entries.pop(node.id, None)
+        self.entries[node.id] = (self.clock.seconds() if seen is None else seen, node)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def get(self, guid):
+        """
+        The node for guid, or None if it hasn't been seen recently.
+        """
+        entry = self.entries.pop(guid, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries[guid] = entry
+        self.hits += 1
+        return entry[1]
+
+    def remove(self, guid):
+        self.entries.pop(guid, None)
+
+    def stale(self, age, count):
+        """
+        Up to count of the nodes not heard from in the last age seconds, least
+        recently used first.
+        """
+        cutoff = self.clock.seconds() - age
+        nodes = []
+        for seen, node in self.entries.itervalues():
+            if seen < cutoff:
+                nodes.append(node)
+                if len(nodes) == count:
+                    break
+        return nodes
+
+    def snapshot(self):
+        """
+        The cache as a list of (last seen, serialized node) pairs for restore().
+        """
+        return [(seen, node.getSerializedProto()) for seen, node in self.entries.itervalues()]
+
+    def restore(self, entries):
+        """
+        Add the peers from a snapshot(), returning how many there were.
+        """
+        for seen, proto in entries:
+            n = objects.Node()
+            n.ParseFromString(proto)
+            self.add(Node(n.guid, n.nodeAddress.ip, n.nodeAddress.port, n.publicKey,
+                          None if not n.HasField("relayAddress") else (n.relayAddress.ip, n.relayAddress.port),
+                          n.natType, n.vendor), seen)
+        return len(entries)
@@ -4,11 +4,12 @@ Copyright (c) 2015 OpenBazaar
 """
 
 from collections import Counter, defaultdict
-from twisted.internet import defer
+
+from twisted.internet import defer, reactor
+from twisted.python import failure
 
 from log import Logger
 
-from dht.utils import deferredDict
 from dht.node import Node, NodeHeap
 
 from protos import objects
@@ -17,8 +18,17 @@ from protos import objects
 class SpiderCrawl(object):
     """
     Crawl the network and look for given 160-bit keys.
+
+    Lookups are pipelined rather than run in rounds: alpha queries are kept in flight
+    and the next closest uncontacted node is asked as soon as any of them answers, so
+    one slow peer doesn't hold up the rest. A peer which hasn't answered after
+    HOP_TIMEOUT seconds is treated as slow. It stops counting towards alpha and is
+    dropped from the nearest nodes, but if it answers before the lookup finishes its
+    response is still used.
     """
 
+    HOP_TIMEOUT = 2.0
+
     def __init__(self, protocol, node, peers, ksize, alpha):
         """
         Create a new C{SpiderCrawl}er.
@@ -35,7 +45,15 @@ class SpiderCrawl(object):
         self.alpha = alpha
         self.node = node
         self.nearest = NodeHeap(self.node, self.ksize)
-        self.lastIDsCrawled = []
+        self.queries = 0
+        self.rpcmethod = None
+        # peer id -> soft timeout of the queries in flight
+        self.waiting = {}
+        # peer id -> node, for queries past their soft timeout
+        self.slow = {}
+        self.pumping = False
+        self.done = False
+        self.finished = None
         self.log = Logger(system=self)
         self.log.debug("creating spider with peers: %s" % peers)
         self.nearest.push(peers)
@@ -48,35 +66,157 @@ class SpiderCrawl(object):
             rpcmethod: The protocol's callFindValue or callFindNode.
 
         The process:
-          1. calls find_* to current ALPHA nearest not already queried nodes,
-             adding results to current nearest list of k nodes.
-          2. current nearest list needs to keep track of who has been queried already
-             sort by nearest, keep KSIZE
-          3. if list is same as last time, next call should be to everyone not
-             yet queried
-          4. repeat, unless nearest list has all been queried, then ur done
+          1. calls find_* to the ALPHA nearest not already queried nodes, adding
+             results to the current nearest list of k nodes as they arrive.
+          2. each time a query is answered, or passes its soft timeout, call find_*
+             to the next nearest not already queried node.
+          3. the nearest list keeps track of who has been queried already, sorted
+             by nearest, keeping KSIZE
+          4. once nothing is in flight and the nearest list has all been queried,
+             ur done
         """
         self.log.debug("crawling with nearest: %s" % str(tuple(self.nearest)))
-        count = self.alpha
-        if self.nearest.getIDs() == self.lastIDsCrawled:
-            self.log.debug("last iteration same as current - checking all in list now")
-            count = len(self.nearest)
-        self.lastIDsCrawled = self.nearest.getIDs()
+        self.rpcmethod = rpcmethod
+        self.finished = defer.Deferred()
+        d = self.finished
+        self._continue()
+        return d
+
+    def _continue(self):
+        """
+        Query nodes until alpha are in flight, or finish the lookup if there's no one
+        left to ask. Returns the result if the lookup is over, otherwise a deferred
+        which fires with it.
+        """
+        if self.pumping or self.done:
+            return self.finished
+        self.pumping = True
+        try:
+            while not self.done and len(self.waiting) < self.alpha:
+                peers = self._candidates(self.alpha - len(self.waiting))
+                if not peers:
+                    break
+                # queries answered straight away are handled by this loop
+                for peer in peers:
+                    self._query(peer)
+        finally:
+            self.pumping = False
+        if self.done:
+            return self.finished
+        if not self.waiting and self.nearest.allBeenContacted():
+            if not self.slow or len(self.nearest) >= self.ksize:
+                return self._finish(self._result())
+            self.log.debug("waiting on %d slow peers" % len(self.slow))
+        if self.finished is None:
+            self.finished = defer.Deferred()
+        return self.finished
+
+    def _query(self, peer):
+        self.nearest.markContacted(peer)
+        self.queries += 1
+        self.waiting[peer.id] = reactor.callLater(self.HOP_TIMEOUT, self._timedOut, peer)
+        self.rpcmethod(peer, self.node).addCallback(self._responded, peer).addErrback(self._failed, peer)
+
+    def _timedOut(self, peer):
+        """
+        Give up waiting on peer for now and ask someone else instead.
+        """
+        del self.waiting[peer.id]
+        self.slow[peer.id] = peer
+        self.nearest.remove([peer.id])
+        self._continue()
 
-        ds = {}
-        for peer in self.nearest.getUncontacted()[:count]:
-            ds[peer.id] = rpcmethod(peer, self.node)
-            self.nearest.markContacted(peer)
-        return deferredDict(ds).addCallback(self._nodesFound)
+    def _responded(self, response, peer):
+        if self.done:
+            return
+        timeout = self.waiting.pop(peer.id, None)
+        if timeout is not None and timeout.active():
+            timeout.cancel()
+        if self.slow.pop(peer.id, None) is not None and response[0]:
+            self.nearest.push(peer)
+        self._nodesFound({peer.id: response})
+
+    def _failed(self, err, peer):
+        """
+        Handling peer's response raised. Carry on as if peer hadn't answered, so the
+        lookup still finishes.
+        """
+        self.log.warning("failed to handle the response from %s: %s" % (peer, err.getErrorMessage()))
+        if self.done:
+            return
+        timeout = self.waiting.pop(peer.id, None)
+        if timeout is not None and timeout.active():
+            timeout.cancel()
+        self.slow.pop(peer.id, None)
+        self.nearest.remove([peer.id])
+        try:
+            self._continue()
+        except Exception:
+            self._finish(failure.Failure())
+
+    def _finish(self, result):
+        """
+        End the lookup with result, which may be a deferred.
+        """
+        self.done = True
+        for timeout in self.waiting.values():
+            if timeout.active():
+                timeout.cancel()
+        self.waiting.clear()
+        self.slow.clear()
+        if self.finished is not None:
+            if isinstance(result, defer.Deferred):
+                result.chainDeferred(self.finished)
+            else:
+                self.finished.callback(result)
+        return result
+
+    def _result(self):  # pylint: disable=no-self-use
+        """
+        What the lookup returns when every nearest node has been queried, nothing
+        unless a subclass says otherwise.
+        """
+        return None
+
+    def _candidates(self, count):
+        """
+        The count uncontacted nodes to query next. These are the closest ones, except
+        that nodes at distances with the same bit length are ranked by how quickly the
+        routing table expects them to answer.
+        """
+        uncontacted = self.nearest.getUncontacted()
+        if len(uncontacted) <= count:
+            return uncontacted
+        router = self.protocol.router
+        target = self.node.long_id
+        return sorted(uncontacted, key=lambda n: ((target ^ n.long_id).bit_length(), router.cost(n)))[:count]
 
 
 class ValueSpiderCrawl(SpiderCrawl):
-    def __init__(self, protocol, node, peers, ksize, alpha, save_at_nearest=True):
+    def __init__(self, protocol, node, peers, ksize, alpha, save_at_nearest=True, onValues=None):
+        """
+        Args:
+            save_at_nearest: Store the value found at the nearest node without it.
+            onValues: Called with each batch of values as peers return them, before the
+                lookup has finished. Only values with keys it hasn't been given before
+                are passed on, and the merged result the lookup fires with is final.
+                With onValues the lookup doesn't end at the first value. No new queries
+                are sent, but those already in flight get until their soft timeout to
+                answer, and the values they return are passed on and merged too.
+        """
         SpiderCrawl.__init__(self, protocol, node, peers, ksize, alpha)
         # keep track of the single nearest node without value - per
         # section 2.3 so we can set the key there if found
         self.nearestWithoutValue = NodeHeap(self.node, 1)
         self.saveToNearestWitoutValue = save_at_nearest
+        self.rpcmethod = protocol.callFindValue
+        self.onValues = onValues
+        # keys of the values passed to onValues
+        self.streamed = set()
+        # whether to wait for the queries in flight once a value is found, and the
+        # values found so far if so
+        self.gather = onValues is not None
+        self.gathered = []
 
     def find(self):
         """
@@ -86,7 +226,7 @@ class ValueSpiderCrawl(SpiderCrawl):
 
     def _nodesFound(self, responses):
         """
-        Handle the result of an iteration in _find.
+        Handle responses to queries made by _find.
         """
         toremove = []
         foundValues = []
@@ -99,16 +239,56 @@ class ValueSpiderCrawl(SpiderCrawl):
                 foundValues = list(set(foundValues) | set(response.getValue()))
             else:
                 peer = self.nearest.getNodeById(peerid)
-                self.nearestWithoutValue.push(peer)
+                if peer is not None:
+                    self.nearestWithoutValue.push(peer)
                 self.nearest.push(response.getNodeList())
         self.nearest.remove(toremove)
 
         if len(foundValues) > 0:
-            return self._handleFoundValues(foundValues)
-        if self.nearest.allBeenContacted():
-            # not found!
-            return None
-        return self.find()
+            self._stream(foundValues)
+            if not self.gather:
+                return self._finish(self._handleFoundValues(foundValues))
+            self.gathered = list(set(self.gathered) | set(foundValues))
+        return self._continue()
+
+    def _continue(self):
+        result = SpiderCrawl._continue(self)
+        # once a value is found nothing new is asked, so it's over when no one is left to answer
+        if self.gathered and not self.waiting and not self.pumping and not self.done:
+            return self._finish(self._result())
+        return result
+
+    def _candidates(self, count):
+        if self.gathered:
+            return []
+        return SpiderCrawl._candidates(self, count)
+
+    def _result(self):
+        if self.gathered:
+            return self._handleFoundValues(self.gathered)
+        return None
+
+    def _stream(self, values):
+        """
+        Pass the values with keys onValues hasn't been given yet on to it.
+        """
+        if self.onValues is None:
+            return
+        new = []
+        for v in values:
+            try:
+                d = objects.Value()
+                d.ParseFromString(v)
+            except Exception:
+                continue
+            if d.valueKey not in self.streamed:
+                self.streamed.add(d.valueKey)
+                new.append(v)
+        if new:
+            try:
+                self.onValues(new)
+            except Exception, e:
+                self.log.warning("failed to handle values found for %s: %s" % (self.node.id.encode("hex"), e))
 
     def _handleFoundValues(self, values):
         """
@@ -143,22 +323,24 @@ class ValueSpiderCrawl(SpiderCrawl):
             value.append(val.SerializeToString())
 
         if self.saveToNearestWitoutValue:
-            ds = []
             peerToSaveTo = self.nearestWithoutValue.popleft()
             if peerToSaveTo is not None:
+                # send them all in one VALUES message so the peer can store them in one go
+                values = []
                 for v in value:
-                    try:
-                        val = objects.Value()
-                        val.ParseFromString(v)
-                        ds.append(self.protocol.callStore(peerToSaveTo, self.node.id, val.valueKey,
-                                                          val.serializedData, val.ttl))
-                    except Exception:
-                        pass
-                return defer.gatherResults(ds).addCallback(lambda _: value)
+                    val = objects.Value()
+                    val.ParseFromString(v)
+                    val.keyword = self.node.id
+                    values.append(val.SerializeToString())
+                return self.protocol.callValues(peerToSaveTo, values).addCallback(lambda _: value)
         return value
 
 
 class NodeSpiderCrawl(SpiderCrawl):
+    def __init__(self, protocol, node, peers, ksize, alpha):
+        SpiderCrawl.__init__(self, protocol, node, peers, ksize, alpha)
+        self.rpcmethod = protocol.callFindNode
+
     def find(self):
         """
         Find the closest nodes.
@@ -167,7 +349,7 @@ class NodeSpiderCrawl(SpiderCrawl):
 
     def _nodesFound(self, responses):
         """
-        Handle the result of an iteration in _find.
+        Handle responses to queries made by _find.
         """
         toremove = []
         for peerid, response in responses.items():
@@ -177,10 +359,133 @@ class NodeSpiderCrawl(SpiderCrawl):
             else:
                 self.nearest.push(response.getNodeList())
         self.nearest.remove(toremove)
+        return self._continue()
+
+    def _result(self):
+        return list(self.nearest)
+
+
+class _PathSpiderCrawl(ValueSpiderCrawl):
+    """
+    One path of a DisjointValueSpiderCrawl. It never queries a node another path has
+    queried, and returns the values it finds without merging or storing them.
+    """
+
+    def __init__(self, protocol, node, peers, ksize, alpha, claimed, onValues=None):
+        ValueSpiderCrawl.__init__(self, protocol, node, peers, ksize, alpha, False, onValues)
+        # each path ends at its first value, the other paths are what finds more
+        self.gather = False
+        # ids of the nodes queried by any path
+        self.claimed = claimed
+
+    def _candidates(self, count):
+        taken = [n.id for n in self.nearest.getUncontacted() if n.id in self.claimed]
+        if taken:
+            self.nearest.remove(taken)
+        return ValueSpiderCrawl._candidates(self, count)
+
+    def _query(self, peer):
+        self.claimed.add(peer.id)
+        ValueSpiderCrawl._query(self, peer)
 
-        if self.nearest.allBeenContacted():
-            return list(self.nearest)
-        return self.find()
+    def _handleFoundValues(self, values):
+        return values
+
+
+class DisjointValueSpiderCrawl(ValueSpiderCrawl):
+    """
+    Look for a value over several disjoint paths at once, as in section 4.4 of the
+    S/Kademlia paper. The starting peers are dealt out between the paths and no node
+    is queried by more than one of them, so one bad or slow node can only affect the
+    path it's on.
+
+    Each path ends at the first value it's given. Once quorum paths have found the
+    same values the lookup ends without waiting for the rest. Otherwise it merges what
+    the paths found, so a keyword with many values (search terms, moderators) gets the
+    values any path saw, and where paths disagree about a value the one most paths saw
+    wins. Once quorum paths have finished, the others get QUORUM_GRACE more seconds
+    before the lookup merges what it has, so a path stuck behind slow peers doesn't
+    hold up the result.
+    """
+
+    QUORUM_GRACE = 0.5
+
+    def __init__(self, protocol, node, peers, ksize, alpha, paths=3, quorum=None, save_at_nearest=True,
+                 onValues=None):
+        """
+        Args:
+            paths: The number of disjoint paths to look up the value over.
+            quorum: How many paths must agree to end the lookup early, a majority by default.
+            onValues: Called with the values each path finds as it finds them, see
+                :class:`ValueSpiderCrawl`.
+        """
+        ValueSpiderCrawl.__init__(self, protocol, node, peers, ksize, alpha, save_at_nearest, onValues)
+        paths = max(1, min(paths, len(peers)))
+        self.quorum = quorum or paths / 2 + 1
+        claimed = set()
+        stream = self._stream if onValues is not None else None
+        self.paths = [_PathSpiderCrawl(protocol, node, peers[i::paths], ksize, alpha, claimed, stream)
+                      for i in range(paths)]
+        # path -> the values it found
+        self.found = {}
+        self.running = 0
+        self.deadline = None
+
+    def find(self):
+        self.finished = defer.Deferred()
+        d = self.finished
+        self.running = len(self.paths)
+        for path in self.paths:
+            path.find().addCallback(self._pathFinished, path)
+        return d
+
+    def _pathFinished(self, values, path):
+        if self.done:
+            return
+        self.running -= 1
+        self.nearestWithoutValue.push(list(path.nearestWithoutValue))
+        if values:
+            self.found[path] = values
+        agreed = Counter(_valueSet(v) for v in self.found.values()).most_common(1)
+        if self.running > 0 and agreed and agreed[0][1] >= self.quorum:
+            self.log.debug("%d paths agree on the values for %s" % (agreed[0][1], self.node.id.encode("hex")))
+        elif self.running > 0:
+            if self.deadline is None and len(self.paths) - self.running >= self.quorum:
+                self.deadline = reactor.callLater(self.QUORUM_GRACE, self._merge)
+            return
+        self._merge()
+
+    def _merge(self):
+        """
+        End the lookup with the values the paths have found so far.
+        """
+        if self.deadline is not None and self.deadline.active():
+            self.deadline.cancel()
+        self.queries = sum(p.queries for p in self.paths)
+        # every path's values, so _handleFoundValues counts how many paths saw each one
+        values = []
+        for path in self.paths:
+            values.extend(self.found.get(path, []))
+        self._finish(self._handleFoundValues(values) if values else None)
+        for path in self.paths:
+            if not path.done:
+                path._finish(None)  # pylint: disable=protected-access
+
+
+def _valueSet(values):
+    """
+    The key and data of each of values, ignoring their ttls, which depend on when
+    they were stored.
+    """
+    found = set()
+    for v in values:
+        try:
+            d = objects.Value()
+            d.ParseFromString(v)
+            found.add((d.valueKey, d.serializedData))
+        except Exception:
+            found.add(v)
+    return frozenset(found)
 
 
 class RPCFindResponse(object):
@@ -0,0 +1,81 @@
+"""
+XOR distances between a target and many node ids at once.
+
+When NumPy is installed ids are packed into three arrays of uint64 words, the
+top 64 bits of every id in the first. Distances are XORed and compared a whole
+array at a time, most of them settled by the first word alone. Without NumPy, or
+for only a few ids, the same methods work a Python long at a time.
+
+Copyright (c) 2015 OpenBazaar
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# below this many ids packing them costs more than comparing them one at a time
+VECTORIZE_THRESHOLD = 64
+
+
+def _words(long_id):
+    """
+    Split a 160 bit id or distance the way PackedIds does, as numpy scalars.
+    """
+    long_id = min(long_id, 2 ** 160 - 1)
+    return (numpy.uint64(long_id >> 96), numpy.uint64((long_id >> 32) & 0xffffffffffffffff),
+            numpy.uint64((long_id & 0xffffffff) << 32))
+
+
+class PackedIds(object):
+    """
+    The ids of a fixed list of nodes, packed for comparing against targets in bulk.
+    """
+
+    __slots__ = ("nodes", "words")
+
+    def __init__(self, nodes):
+        self.nodes = list(nodes)
+        if numpy is not None and len(self.nodes) >= VECTORIZE_THRESHOLD:
+            # pad the ids to three big endian words, then make a native array of each
+            rows = numpy.frombuffer("".join(node.id + "\0\0\0\0" for node in self.nodes), dtype=">u8")
+            rows = rows.reshape(len(self.nodes), 3)
+            self.words = tuple(numpy.ascontiguousarray(rows[:, i], dtype=numpy.uint64) for i in range(3))
+        else:
+            self.words = None
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def vectorized(self):
+        """
+        Whether the ids are packed for NumPy. If not it's usually quicker for callers
+        to use the routing table than to compare against every id.
+        """
+        return self.words is not None
+
+    def _closer(self, target, distance):
+        """
+        A boolean array of which nodes are strictly closer than distance to target.
+        """
+        target, bound = _words(target.long_id), _words(distance)
+        top = self.words[0] ^ target[0]
+        closer = top < bound[0]
+        tied = top == bound[0]
+        if tied.any():
+            for word in (1, 2):
+                xored = self.words[word] ^ target[word]
+                closer |= tied & (xored < bound[word])
+                tied &= xored == bound[word]
+        return closer
+
+    def countWithin(self, target, distance):
+        """
+        How many nodes are strictly closer than distance to target.
+        """
+        if self.words is None:
+            target = target.long_id
+            return sum(1 for node in self.nodes if target ^ node.long_id < distance)
+        return int(numpy.count_nonzero(self._closer(target, distance)))
+
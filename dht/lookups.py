@@ -0,0 +1,96 @@
+"""
+Shares lookups between callers asking for the same keyword or guid.
+
+Copyright (c) 2015 OpenBazaar
+"""
+
+from collections import OrderedDict
+
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+
+class LookupCache(object):
+    """
+    Remembers the results of recent lookups for ttl seconds and lets callers wait on a
+    lookup that's already running instead of starting another crawl. Empty results,
+    such as a value that wasn't found, are shared with the callers waiting on them but
+    not kept.
+
+    hits counts the lookups answered from the cache, coalesced the ones which waited
+    on a crawl that was already running and misses the ones which started a crawl.
+    """
+
+    def __init__(self, ttl=30, maxsize=1000, clock=reactor):
+        """
+        Args:
+            ttl: Seconds to keep a result for.
+            maxsize: The most results to keep, the least recently used are dropped first.
+            clock: The reactor used to tell the time.
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        # key -> (expiry time, result), least recently used first
+        self.results = OrderedDict()
+        # key -> deferreds waiting on the running lookup
+        self.pending = {}
+        # keys invalidated while their lookup was running
+        self.stale = set()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key, lookup):
+        """
+        Get the result of the lookup for key, calling lookup to start one if it's not
+        cached or running already.
+
+        Args:
+            key: Identifies the lookup, such as ("nodes", keyword).
+            lookup: A callable starting the lookup, returning its result or a deferred.
+
+        Returns:
+            A deferred firing with the result of the lookup. Lists are copied for each
+            caller.
+        """
+        cached = self.results.pop(key, None)
+        if cached is not None and cached[0] > self.clock.seconds():
+            self.results[key] = cached
+            self.hits += 1
+            return defer.succeed(_copy(cached[1]))
+        d = defer.Deferred()
+        if key in self.pending:
+            self.coalesced += 1
+            self.pending[key].append(d)
+            return d
+        self.misses += 1
+        self.pending[key] = [d]
+        defer.maybeDeferred(lookup).addBoth(self._finished, key)
+        return d
+
+    def invalidate(self, key):
+        """
+        Forget the result for key, including the one a running lookup is about to return.
+        """
+        self.results.pop(key, None)
+        if key in self.pending:
+            self.stale.add(key)
+
+    def _finished(self, result, key):
+        waiting = self.pending.pop(key)
+        if key in self.stale:
+            self.stale.remove(key)
+        elif result and not isinstance(result, failure.Failure):
+            self.results[key] = (self.clock.seconds() + self.ttl, result)
+            while len(self.results) > self.maxsize:
+                self.results.popitem(last=False)
+        for d in waiting:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(_copy(result))
+
+
+def _copy(result):
+    return list(result) if isinstance(result, list) else result
@@ -5,12 +5,12 @@ Copyright (c) 2014 Brian Muller
 Copyright (c) 2015 OpenBazaar
 """
 
+import os
 import pickle
 import httplib
-import random
 from binascii import hexlify
 from twisted.internet.task import LoopingCall
-from twisted.internet import defer, reactor, task
+from twisted.internet import defer, reactor, task, threads
 
 import nacl.signing
 import nacl.hash
@@ -22,7 +22,10 @@ from dht.protocol import KademliaProtocol
 from dht.utils import deferredDict, digest
 from dht.storage import ForgetfulStorage
 from dht.node import Node
-from dht.crawling import ValueSpiderCrawl
+from dht.routing import SnapshotError
+from dht.refresh import RefreshScheduler
+from dht.lookups import LookupCache
+from dht.crawling import ValueSpiderCrawl, DisjointValueSpiderCrawl
 from dht.crawling import NodeSpiderCrawl
 
 from protos import objects
@@ -49,7 +52,8 @@ class Server(object):
     to start listening as an active node on the network.
     """
 
-    def __init__(self, node, db, signing_key, ksize=20, alpha=3, storage=None):
+    def __init__(self, node, db, signing_key, ksize=20, alpha=3, storage=None, refreshConcurrency=None,
+                 refreshRate=None, lookupCacheTTL=30):
         """
         Create a server instance.  This will start listening on the given port.
 
@@ -59,6 +63,10 @@ class Server(object):
             ksize (int): The k parameter from the paper
             alpha (int): The alpha parameter from the paper
             storage: An instance that implements :interface:`~dht.storage.IStorage`
+            refreshConcurrency (int): The most bucket refreshes or republishes to run at once
+            refreshRate (float): Refreshes and republishes to start a second. By default they're
+                spread over half the hour between refreshes.
+            lookupCacheTTL (int): Seconds to reuse the result of a lookup for in get, set and resolve.
         """
         self.ksize = ksize
         self.alpha = alpha
@@ -66,7 +74,15 @@ class Server(object):
         self.storage = storage or ForgetfulStorage()
         self.node = node
         self.protocol = KademliaProtocol(self.node, self.storage, ksize, db, signing_key)
-        self.refreshLoop = LoopingCall(self.refreshTable).start(3600)
+        self.refresher = RefreshScheduler(self.protocol, ksize, alpha, concurrency=refreshConcurrency,
+                                          rate=refreshRate)
+        self.refreshLoop = self.refresher.start()
+        self.lookups = LookupCache(lookupCacheTTL)
+        self.cullLoop = LoopingCall(self.storage.cull).start(600, now=False)
+        self.verifyLoop = LoopingCall(self.verifyStaleContacts)
+        self.revalidateLoop = LoopingCall(self.revalidateContacts)
+        self.revalidateLoop.start(60, now=False)
+        self.routingTableLoop = None
 
     def listen(self, port):
         """
@@ -81,23 +97,11 @@ class Server(object):
     def refreshTable(self):
         """
         Refresh buckets that haven't had any lookups in the last hour
-        (per section 2.3 of the paper).
+        (per section 2.3 of the paper) and republish our values. The work is
+        spread over the hour by the :class:`~dht.refresh.RefreshScheduler`; the
+        deferred fires with a report of the pass once it's done.
         """
-        ds = []
-        refresh_ids = self.protocol.getRefreshIDs()
-        refresh_ids.append(digest(random.getrandbits(255)))  # random node so we get more diversity
-        for rid in refresh_ids:
-            node = Node(rid)
-            nearest = self.protocol.router.findNeighbors(node, self.alpha)
-            spider = NodeSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha)
-            ds.append(spider.find())
-
-        def republishKeys(_):
-            for bucket in self.protocol.router.buckets:
-                for node in bucket.nodes.values():
-                    self.protocol.transferKeyValues(node)
-
-        return defer.gatherResults(ds).addCallback(republishKeys)
+        return self.refresher.refresh()
 
     def querySeed(self, list_seed_pubkey):
         """
@@ -221,13 +225,19 @@ class Server(object):
             ds.append(self.protocol.stun(neighbor))
         return defer.gatherResults(ds).addCallback(handle)
 
-    def get(self, keyword, save_at_nearest=True):
+    def get(self, keyword, save_at_nearest=True, paths=1, quorum=None, onValues=None):
         """
         Get a key if the network has it.
 
         Args:
             keyword = the keyword to save to
             save_at_nearest = save value at the nearest without value
+            paths = look the keyword up over this many disjoint paths, see
+                :class:`~dht.crawling.DisjointValueSpiderCrawl`
+            quorum = how many paths must agree to end the lookup early, a majority by default
+            onValues = called with batches of values as peers return them, before the lookup
+                finishes. It's not called when the value is stored locally or the result of
+                another lookup for the keyword is used, so callers still need the result.
 
         Returns:
             :class:`None` if not found, the value otherwise.
@@ -235,13 +245,22 @@ class Server(object):
         dkey = digest(keyword)
         if self.storage.get(dkey) is not None:
             return defer.succeed(self.storage.get(dkey))
-        node = Node(dkey)
-        nearest = self.protocol.router.findNeighbors(node)
-        if len(nearest) == 0:
-            self.log.warning("there are no known neighbors to get key %s" % dkey.encode('hex'))
-            return defer.succeed(None)
-        spider = ValueSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha, save_at_nearest)
-        return spider.find()
+
+        def find():
+            node = Node(dkey)
+            nearest = self.protocol.router.findNeighbors(node)
+            if len(nearest) == 0:
+                self.log.warning("there are no known neighbors to get key %s" % dkey.encode('hex'))
+                return None
+            if paths > 1:
+                spider = DisjointValueSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha, paths,
+                                                  quorum, save_at_nearest, onValues)
+            else:
+                spider = ValueSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha, save_at_nearest,
+                                          onValues)
+            return spider.find()
+
+        return self.lookups.get(("value", dkey), find)
 
     def set(self, keyword, key, value, ttl=604800):
         """
@@ -266,6 +285,9 @@ class Server(object):
         self.log.debug("setting '%s' on network" % keyword.encode("hex"))
 
         def store(nodes):
+            if not nodes:
+                self.log.warning("there are no known neighbors to set keyword %s" % keyword.encode("hex"))
+                return False
             self.log.debug("setting '%s' on %s" % (keyword.encode("hex"), [str(i) for i in nodes]))
             ds = [self.protocol.callStore(node, keyword, key, value, ttl) for node in nodes]
 
@@ -276,13 +298,9 @@ class Server(object):
 
             return defer.DeferredList(ds).addCallback(_anyRespondSuccess)
 
-        node = Node(keyword)
-        nearest = self.protocol.router.findNeighbors(node)
-        if len(nearest) == 0:
-            self.log.warning("there are no known neighbors to set keyword %s" % keyword.encode("hex"))
-            return defer.succeed(False)
-        spider = NodeSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha)
-        return spider.find().addCallback(store)
+        # what a get has cached for this keyword doesn't include the new value
+        self.lookups.invalidate(("value", keyword))
+        return self._findNodes(keyword).addCallback(store)
 
     def delete(self, keyword, key, signature):
         """
@@ -307,6 +325,7 @@ class Server(object):
 
             if self.storage.getSpecific(dkey, key) is not None:
                 self.storage.delete(dkey, key)
+            self.lookups.invalidate(("value", dkey))
 
             return defer.DeferredList(ds).addCallback(_anyRespondSuccess)
 
@@ -327,13 +346,17 @@ class Server(object):
             guid: the 20 raw bytes representing the guid.
         """
 
+        node = self.protocol.contacts.get(guid)
+        if node is not None:
+            return defer.succeed(node)
+
         node_to_find = Node(guid)
         for connection in self.protocol.multiplexer.values():
             if connection.handler.node is not None and connection.handler.node.id == node_to_find.id:
                 return defer.succeed(connection.handler.node)
 
         def check_for_node(nodes):
-            for node in nodes:
+            for node in nodes or []:
                 if node.id == node_to_find.id:
                     return node
             return None
@@ -344,18 +367,92 @@ class Server(object):
             if node.id == node_to_find.id:
                 return defer.succeed(node)
 
-        nearest = self.protocol.router.findNeighbors(node_to_find)
-        if len(nearest) == 0:
-            self.log.warning("there are no known neighbors to find node %s" % node_to_find.id.encode("hex"))
-            return defer.succeed(None)
+        return self._findNodes(guid).addCallback(check_for_node)
 
-        spider = NodeSpiderCrawl(self.protocol, node_to_find, nearest, self.ksize, self.alpha)
-        return spider.find().addCallback(check_for_node)
+    def _findNodes(self, key):
+        """
+        Find the k nodes closest to key, sharing the lookup with anyone else looking
+        for them. Fires with None if there are no neighbors to ask.
+        """
+        def find():
+            node = Node(key)
+            nearest = self.protocol.router.findNeighbors(node)
+            if len(nearest) == 0:
+                self.log.warning("there are no known neighbors to find nodes near %s" % key.encode("hex"))
+                return None
+            spider = NodeSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha)
+            return spider.find()
+
+        return self.lookups.get(("nodes", key), find)
+
+    def verifyStaleContacts(self):
+        """
+        Ping some of the contacts restored from a routing table snapshot which
+        haven't been heard from yet. The ones that don't answer are removed.
+        """
+        for node in self.protocol.router.popStale(self.ksize):
+            self.protocol.callPing(node)
+        if len(self.protocol.router.stale) == 0 and self.verifyLoop.running:
+            self.verifyLoop.stop()
+
+    def revalidateContacts(self, age=900):
+        """
+        Ping a few of the peers in the contact cache which haven't been heard from in
+        the last age seconds. Their answers refresh them in the cache and the ones
+        that don't answer are dropped, so resolve keeps returning reachable peers.
+        """
+        def check(result, node):
+            if not result[0]:
+                self.protocol.contacts.remove(node.id)
+
+        contacts = self.protocol.contacts
+        for node in contacts.stale(age, self.alpha):
+            # not stale again until the ping has had time to be answered
+            contacts.add(node)
+            self.protocol.callPing(node).addCallback(check, node)
+
+    def saveRoutingTable(self, fname):
+        """
+        Write a snapshot of the routing table to fname. The file is written in a
+        thread and renamed into place, so a crash never leaves a partial snapshot.
+        """
+        data = self.protocol.router.snapshot()
+
+        def write():
+            with open(fname + ".tmp", "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            if os.name == "nt" and os.path.exists(fname):
+                os.remove(fname)
+            os.rename(fname + ".tmp", fname)
+
+        def failed(err):
+            self.log.warning("failed to save the routing table: %s" % err.getErrorMessage())
+
+        return threads.deferToThread(write).addErrback(failed)
+
+    def loadRoutingTable(self, fname):
+        """
+        Restore the routing table from a snapshot written by saveRoutingTable and
+        start checking the restored contacts in the background. Returns False if
+        there's no usable snapshot.
+        """
+        try:
+            with open(fname, "rb") as f:
+                count = self.protocol.router.restore(f.read())
+        except (IOError, SnapshotError), e:
+            self.log.warning("not restoring the routing table: %s" % e)
+            return False
+        self.log.info("restored %d contacts from the routing table snapshot" % count)
+        if not self.verifyLoop.running:
+            self.verifyLoop.start(1, now=False)
+        return True
 
     def saveState(self, fname):
         """
-        Save the state of this node (the alpha/ksize/id/immediate neighbors)
-        to a cache file with the given fname.
+        Save the state of this node (the alpha/ksize/id/immediate neighbors and
+        the contact cache) to a cache file with the given fname.
         """
         data = {'ksize': self.ksize,
                 'alpha': self.alpha,
@@ -364,6 +461,7 @@ class Server(object):
                 'pubkey': self.node.pubkey,
                 'signing_key': self.protocol.signing_key,
                 'neighbors': self.bootstrappableNeighbors(),
+                'contacts': self.protocol.contacts.snapshot(),
                 'testnet': self.protocol.multiplexer.testnet}
         if len(data['neighbors']) == 0:
             self.log.warning("no known neighbors, so not writing to cache.")
@@ -385,6 +483,9 @@ class Server(object):
         n = Node(data['id'], ip_address, port, data['pubkey'], relay_node, nat_type, data['vendor'])
         s = Server(n, db, data['signing_key'], data['ksize'], data['alpha'], storage=storage)
         s.protocol.connect_multiplexer(multiplexer)
+        s.protocol.contacts.restore(data.get('contacts', []))
+        if os.path.exists(fname + ".rt"):
+            s.loadRoutingTable(fname + ".rt")
         if len(data['neighbors']) > 0:
             if callback is not None:
                 s.bootstrap(data['neighbors']).addCallback(callback)
@@ -398,16 +499,23 @@ class Server(object):
                 s.bootstrap(s.querySeed(SEEDS))
         return s
 
-    def saveStateRegularly(self, fname, frequency=600):
+    def saveStateRegularly(self, fname, frequency=600, routingTableFrequency=600):
         """
         Save the state of node with a given regularity to the given
-        filename.
+        filename, and a snapshot of the routing table to fname + ".rt".
 
         Args:
             fname: File name to save retularly to
             frequency: Frequency in seconds that the state should be saved.
                         By default, 10 minutes.
+            routingTableFrequency: Frequency in seconds that the routing table
+                        snapshot should be saved. Encoding it takes a while, so
+                        this is independent of frequency. By default, 10 minutes.
         """
         loop = LoopingCall(self.saveState, fname)
         loop.start(frequency)
+        # not straight away, so a table which is still being filled doesn't replace
+        # the snapshot it was restored from
+        self.routingTableLoop = LoopingCall(self.saveRoutingTable, fname + ".rt")
+        self.routingTableLoop.start(routingTableFrequency, now=False)
         return loop
@@ -4,41 +4,78 @@ Copyright (c) 2015 OpenBazaar
 """
 import heapq
 
-from operator import itemgetter
+from binascii import hexlify
+from operator import attrgetter
 from protos import objects
 
 
+def _protoField(name):
+    """
+    A Node attribute which is part of its protobuf, so setting it drops the cached
+    encoding.
+    """
+    attr = "_" + name
+
+    def fset(self, value):
+        setattr(self, attr, value)
+        self._proto = self._serialized = None
+
+    return property(attrgetter(attr), fset)
+
+
 class Node(object):
+    __slots__ = ("id", "long_id", "_ip", "_port", "_pubkey", "_relay_node", "_nat_type", "_vendor",
+                 "_proto", "_serialized")
+
+    ip = _protoField("ip")
+    port = _protoField("port")
+    pubkey = _protoField("pubkey")
+    relay_node = _protoField("relay_node")
+    nat_type = _protoField("nat_type")
+    vendor = _protoField("vendor")
+
     def __init__(self, node_id, ip=None, port=None, pubkey=None,
                  relay_node=None, nat_type=None, vendor=False):
         self.id = node_id
-        self.ip = ip
-        self.port = port
-        self.pubkey = pubkey
-        self.relay_node = relay_node
-        self.nat_type = nat_type
-        self.vendor = vendor
-        self.long_id = long(node_id.encode('hex'), 16)
+        self.long_id = long(hexlify(node_id), 16)
+        self._ip = ip
+        self._port = port
+        self._pubkey = pubkey
+        self._relay_node = relay_node
+        self._nat_type = nat_type
+        self._vendor = vendor
+        self._proto = None
+        self._serialized = None
 
     def getProto(self):
-        node_address = objects.Node.IPAddress()
-        node_address.ip = self.ip
-        node_address.port = self.port
-
-        n = objects.Node()
-        n.guid = self.id
-        n.publicKey = self.pubkey
-        n.natType = self.nat_type
-        n.nodeAddress.MergeFrom(node_address)
-        n.vendor = self.vendor
-
-        if self.relay_node is not None:
-            relay_address = objects.Node.IPAddress()
-            relay_address.ip = self.relay_node[0]
-            relay_address.port = self.relay_node[1]
-            n.relayAddress.MergeFrom(relay_address)
-
-        return n
+        """
+        Return this node as an `objects.Node`. The message is built once and cached
+        until one of its fields changes, so callers must copy it (MergeFrom) rather
+        than modify it.
+        """
+        if self._proto is None:
+            n = objects.Node()
+            n.guid = self.id
+            n.publicKey = self._pubkey
+            n.natType = self._nat_type
+            n.nodeAddress.ip = self._ip
+            n.nodeAddress.port = self._port
+            n.vendor = self._vendor
+
+            if self._relay_node is not None:
+                n.relayAddress.ip = self._relay_node[0]
+                n.relayAddress.port = self._relay_node[1]
+
+            self._proto = n
+        return self._proto
+
+    def getSerializedProto(self):
+        """
+        Return getProto() serialized, cached the same way.
+        """
+        if self._serialized is None:
+            self._serialized = self.getProto().SerializeToString()
+        return self._serialized
 
     def sameHomeAs(self, node):
         return self.ip == node.ip and self.port == node.port
@@ -65,8 +102,16 @@ class Node(object):
 class NodeHeap(object):
     """
     A heap of nodes ordered by distance to a given node.
+
+    Nodes are indexed by id, so membership tests and lookups are O(1). Removed
+    nodes are only marked as such and skipped until they reach the top of the
+    heap, and the sorted list of the closest maxsize nodes is cached until the
+    heap changes.
     """
 
+    # heap entry fields
+    DISTANCE, NODE, REMOVED = range(3)
+
     def __init__(self, node, maxsize):
         """
         Constructor.
@@ -76,8 +121,11 @@ class NodeHeap(object):
         """
         self.node = node
         self.heap = []
+        # node id -> [distance, node, removed] heap entry
+        self.entries = {}
         self.contacted = set()
         self.maxsize = maxsize
+        self._nearest = None
 
     def remove(self, peerIDs):
         """
@@ -87,20 +135,19 @@ class NodeHeap(object):
         removal of nodes may not change the visible size as previously added
         nodes suddenly become visible.
         """
-        peerIDs = set(peerIDs)
-        if len(peerIDs) == 0:
-            return
-        nheap = []
-        for distance, node in self.heap:
-            if node.id not in peerIDs:
-                heapq.heappush(nheap, (distance, node))
-        self.heap = nheap
+        for peerID in peerIDs:
+            entry = self.entries.pop(peerID, None)
+            if entry is not None:
+                entry[self.REMOVED] = True
+                self._nearest = None
+        # drop the removed entries once they make up most of the heap
+        if len(self.heap) > 2 * len(self.entries):
+            self.heap = [entry for entry in self.heap if not entry[self.REMOVED]]
+            heapq.heapify(self.heap)
 
     def getNodeById(self, node_id):
-        for _, node in self.heap:
-            if node.id == node_id:
-                return node
-        return None
+        entry = self.entries.get(node_id)
+        return None if entry is None else entry[self.NODE]
 
     def allBeenContacted(self):
         return len(self.getUncontacted()) == 0
@@ -112,8 +159,12 @@ class NodeHeap(object):
         self.contacted.add(node.id)
 
     def popleft(self):
-        if len(self) > 0:
-            return heapq.heappop(self.heap)[1]
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            if not entry[self.REMOVED]:
+                del self.entries[entry[self.NODE].id]
+                self._nearest = None
+                return entry[self.NODE]
         return None
 
     def push(self, nodes):
@@ -126,23 +177,23 @@ class NodeHeap(object):
             nodes = [nodes]
 
         for node in nodes:
-            if node not in self:
-                distance = self.node.distanceTo(node)
-                heapq.heappush(self.heap, (distance, node))
+            if node.id not in self.entries:
+                entry = [self.node.distanceTo(node), node, False]
+                self.entries[node.id] = entry
+                heapq.heappush(self.heap, entry)
+                self._nearest = None
 
     def __len__(self):
-        return min(len(self.heap), self.maxsize)
+        return min(len(self.entries), self.maxsize)
 
     def __iter__(self):
-        nodes = heapq.nsmallest(self.maxsize, self.heap)
-        return iter(map(itemgetter(1), nodes))
+        if self._nearest is None:
+            entries = heapq.nsmallest(self.maxsize, self.entries.itervalues())
+            self._nearest = [entry[self.NODE] for entry in entries]
+        return iter(self._nearest)
 
     def __contains__(self, node):
-        # pylint: disable=unused-variable
-        for distance, n in self.heap:
-            if node.id == n.id:
-                return True
-        return False
+        return node.id in self.entries
 
     def getUncontacted(self):
         return [n for n in self if n.id not in self.contacted]
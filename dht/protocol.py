@@ -3,12 +3,13 @@ Copyright (c) 2014 Brian Muller
 Copyright (c) 2015 OpenBazaar
 """
 
-import random
-from twisted.internet import reactor
+from twisted.internet import defer, reactor
 from zope.interface import implements
 import nacl.signing
 
+from dht.contacts import ContactCache
 from dht.node import Node
+from dht.distance import PackedIds
 from dht.routing import RoutingTable
 from dht.utils import digest
 from log import Logger
@@ -17,6 +18,9 @@ from interfaces import MessageProcessor
 from protos import objects
 from protos.message import PING, STUN, STORE, DELETE, FIND_NODE, FIND_VALUE, HOLE_PUNCH, INV, VALUES
 
+# maximum number of invs sent to a new node in a single INV message
+INV_BATCH_SIZE = 500
+
 
 class KademliaProtocol(RPCProtocol):
     implements(MessageProcessor)
@@ -24,6 +28,7 @@ class KademliaProtocol(RPCProtocol):
     def __init__(self, sourceNode, storage, ksize, database, signing_key):
         self.ksize = ksize
         self.router = RoutingTable(self, ksize, sourceNode)
+        self.contacts = ContactCache()
         self.storage = storage
         self.sourceNode = sourceNode
         self.multiplexer = None
@@ -36,28 +41,19 @@ class KademliaProtocol(RPCProtocol):
     def connect_multiplexer(self, multiplexer):
         self.multiplexer = multiplexer
 
-    def getRefreshIDs(self):
-        """
-        Get ids to search for to keep old buckets up to date.
-        """
-        ids = []
-        for bucket in self.router.getLonelyBuckets():
-            ids.append(random.randint(*bucket.range))
-        return ids
-
     def rpc_stun(self, sender):
         self.addToRouter(sender)
         return [sender.ip, str(sender.port)]
 
     def rpc_ping(self, sender):
         self.addToRouter(sender)
-        return [self.sourceNode.getProto().SerializeToString()]
+        return [self.sourceNode.getSerializedProto()]
 
     def rpc_store(self, sender, keyword, key, value, ttl):
         self.addToRouter(sender)
         self.log.debug("got a store request from %s, storing value" % str(sender))
         if len(keyword) == 20 and len(key) <= 33 and len(value) <= 2100 and int(ttl) <= 604800:
-            self.storage[keyword] = (key, value, int(ttl))
+            self.storage[keyword] = (key, value, int(ttl), sender.id)
             return ["True"]
         else:
             return ["False"]
@@ -99,9 +95,9 @@ class KademliaProtocol(RPCProtocol):
         nodeList = self.router.findNeighbors(node, exclude=sender)
         ret = []
         if self.sourceNode.id == key:
-            ret.append(self.sourceNode.getProto().SerializeToString())
+            ret.append(self.sourceNode.getSerializedProto())
         for n in nodeList:
-            ret.append(n.getProto().SerializeToString())
+            ret.append(n.getSerializedProto())
         return ret
 
     def rpc_find_value(self, sender, keyword):
@@ -128,13 +124,17 @@ class KademliaProtocol(RPCProtocol):
 
     def rpc_values(self, sender, *serialized_values):
         self.addToRouter(sender)
+        values = []
         for val in serialized_values:
             try:
                 v = objects.Value()
                 v.ParseFromString(val)
-                self.storage[v.keyword] = (v.valueKey, v.serializedData, int(v.ttl))
+                if len(v.keyword) == 20 and len(v.valueKey) <= 33 and len(v.serializedData) <= 2100 \
+                        and v.ttl <= 604800:
+                    values.append((v.keyword, v.valueKey, v.serializedData, int(v.ttl), sender.id))
             except Exception:
                 pass
+        self.storage.store_many(values)
         return ["True"]
 
     def callFindNode(self, nodeToAsk, nodeToFind):
@@ -177,6 +177,12 @@ class KademliaProtocol(RPCProtocol):
         than the furtherst in that list, and the node for this server
         is closer than the closest in that list, then store the key/value
         on the new node (per section 2.5 of the paper)
+
+        The storage is streamed and invs are sent in batches of INV_BATCH_SIZE
+        so the whole table is never held in memory at once.
+
+        Returns a deferred which fires with the number of messages sent once
+        every inv has been answered and any values it asked for sent.
         """
         def send_values(inv_list):
             values = []
@@ -197,30 +203,78 @@ class KademliaProtocol(RPCProtocol):
                         pass
                 if len(values) > 0:
                     self.callValues(node, values)
+                    return 2
+            return 1
+
+        sent = []
 
         inv = []
-        for keyword in self.storage.iterkeys():
+        if getattr(self.storage, "prefixBits", None) is not None:
+            keywords = self.storage.iterkeys(self._shardFilter(node, self.storage.prefixBits))
+        else:
+            keywords = self.storage.iterkeys()
+        contacts = None
+        for keyword in keywords:
             keynode = Node(keyword)
-            neighbors = self.router.findNeighbors(keynode, exclude=node)
-            if len(neighbors) > 0:
-                newNodeClose = node.distanceTo(keynode) < neighbors[-1].distanceTo(keynode)
-                thisNodeClosest = self.sourceNode.distanceTo(keynode) < neighbors[0].distanceTo(keynode)
-            if len(neighbors) == 0 \
+            if contacts is None:
+                contacts = PackedIds(c for b in self.router.buckets for c in b.getNodes() if not c.sameHomeAs(node))
+            if contacts.vectorized:
+                # the same test as below, by counting the contacts closer than us and
+                # than the new node rather than finding the nearest ones
+                transfer = contacts.countWithin(keynode, self.sourceNode.distanceTo(keynode)) == 0
+                if transfer and len(contacts) >= self.ksize:
+                    transfer = contacts.countWithin(keynode, node.distanceTo(keynode)) < self.ksize
+            else:
+                neighbors = self.router.findNeighbors(keynode, exclude=node)
+                if len(neighbors) > 0:
+                    newNodeClose = node.distanceTo(keynode) < neighbors[-1].distanceTo(keynode)
+                    thisNodeClosest = self.sourceNode.distanceTo(keynode) < neighbors[0].distanceTo(keynode)
+                transfer = len(neighbors) == 0 \
                     or (newNodeClose and thisNodeClosest) \
-                    or (thisNodeClosest and len(neighbors) < self.ksize):
+                    or (thisNodeClosest and len(neighbors) < self.ksize)
+            if transfer:
                 # pylint: disable=W0612
                 for k, v in self.storage.iteritems(keyword):
                     i = objects.Inv()
                     i.keyword = keyword
                     i.valueKey = k
                     inv.append(i.SerializeToString())
+                    if len(inv) == INV_BATCH_SIZE:
+                        sent.append(self.callInv(node, inv).addCallback(send_values))
+                        inv = []
         if len(inv) > 0:
-            self.callInv(node, inv).addCallback(send_values)
+            sent.append(self.callInv(node, inv).addCallback(send_values))
+        return defer.gatherResults(sent).addCallback(sum)
+
+    def _shardFilter(self, node, prefixBits):
+        """
+        Return a function telling transferKeyValues whether a storage shard, the
+        keywords starting with a given prefix of prefixBits bits, could hold values
+        for node. We only hand values over when we're closer to the keyword than any
+        other contact. If a contact's id shares more leading bits with a shard's prefix
+        than ours does it's closer to every keyword in the shard, so the shard is
+        skipped without looking at its keywords.
+        """
+        shift = 160 - prefixBits
+        ours = self.sourceNode.long_id >> shift
+        contacts = set()
+        for bucket in self.router.buckets:
+            for contact in bucket.getNodes():
+                if contact.id != node.id:
+                    contacts.add(contact.long_id >> shift)
+        if len(contacts) == 0:
+            return None
+
+        def relevant(prefix):
+            distance = ours ^ prefix
+            return not any(contact ^ prefix < distance for contact in contacts)
+        return relevant
 
     def handleCallResponse(self, result, node):
         """
-        If we get a response, add the node to the routing table.  If
-        we get no response, make sure it's removed from the routing table.
+        If we get a response, add the node to the routing table.  If we
+        get no response the failure has already been counted by timeout(),
+        which removes the node after several in a row.
         """
         if result[0]:
             if self.isNewConnection(node):
@@ -228,8 +282,7 @@ class KademliaProtocol(RPCProtocol):
                 reactor.callLater(1, self.transferKeyValues, node)
             self.router.addContact(node)
         else:
-            self.log.debug("no response from %s, removing from router" % node)
-            self.router.removeContact(node)
+            self.log.debug("no response from %s" % node)
         return result
 
     def addToRouter(self, node):
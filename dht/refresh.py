@@ -0,0 +1,216 @@
+"""
+Spreads the hourly bucket refresh and republish over the refresh period.
+
+Copyright (c) 2015 OpenBazaar
+"""
+
+import time
+import random
+from collections import deque
+
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
+
+from log import Logger
+
+from dht.node import Node
+from dht.crawling import NodeSpiderCrawl
+
+
+class TokenBucket(object):
+    """
+    Allows rate operations a second on average and bursts of up to capacity.
+    """
+
+    def __init__(self, rate, capacity, clock=reactor):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = float(capacity)
+        self.updated = clock.seconds()
+
+    def take(self):
+        """
+        Take a token if there is one and return 0, otherwise return how many seconds
+        until the next one is available.
+        """
+        now = self.clock.seconds()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RefreshScheduler(object):
+    """
+    Refreshes buckets that haven't had any lookups in the last period (per section 2.3
+    of the paper) and republishes our values to every contact, one job at a time.
+
+    Rather than starting every crawl and transferKeyValues at once, jobs are taken off a
+    queue with at most concurrency in flight and a token bucket pacing them so the
+    whole pass is spread over the first SPREAD of the period. A rate can be given to
+    pace jobs at a fixed number a second instead. Buckets which are touched by a lookup
+    after the pass starts are skipped when their turn comes.
+    """
+
+    SPREAD = 0.5
+
+    def __init__(self, protocol, ksize, alpha, period=3600, concurrency=None, rate=None, burst=None,
+                 clock=reactor):
+        """
+        Args:
+            protocol: The :class:`~dht.protocol.KademliaProtocol` to refresh the routing table of.
+            ksize: The k parameter from the paper
+            alpha: The alpha parameter from the paper
+            period: Seconds between refreshes. Buckets with no lookups for this long are refreshed.
+            concurrency: The most crawls or republishes to have running at once, alpha by default.
+            rate: Jobs to start a second. By default the rate spreads each pass over SPREAD of the period.
+            burst: How many jobs can start back to back after a quiet spell, concurrency by default.
+            clock: The reactor used for scheduling.
+        """
+        self.protocol = protocol
+        self.ksize = ksize
+        self.alpha = alpha
+        self.period = period
+        self.concurrency = concurrency or alpha
+        self.rate = rate
+        self.burst = burst or self.concurrency
+        self.clock = clock
+        self.log = Logger(system=self)
+        self.loop = None
+        self.jobs = deque()
+        self.running = 0
+        self.pumping = False
+        self.tokens = None
+        self.wakeup = None
+        self.finished = None
+        self.started = None
+        self.passStarted = None
+        self.report = {}
+        self.lastReport = None
+
+    def start(self, now=True):
+        self.loop = LoopingCall(self.refresh)
+        self.loop.clock = self.clock
+        return self.loop.start(self.period, now=now)
+
+    def stop(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        if self.wakeup is not None and self.wakeup.active():
+            self.wakeup.cancel()
+
+    def refresh(self):
+        """
+        Start a refresh pass, returning a deferred which fires with its report once every
+        job has finished. If the last pass is still going it's left to finish instead.
+        """
+        if self.finished is not None:
+            self.log.warning("previous routing table refresh is still running, skipping this one")
+            return self.finished
+        router = self.protocol.router
+        self.started = time.time()
+        self.passStarted = self.clock.seconds()
+        self.report = {"buckets": 0, "skipped": 0, "republished": 0, "messages": 0}
+        for bucket in router.getLonelyBuckets(self.period):
+            self.jobs.append((self._crawl, Node(_randomId(bucket.range))))
+        # a random id too so we get more diversity
+        self.jobs.append((self._crawl, None))
+        self.jobs.append((self._queueRepublish, None))
+        jobs = len(self.jobs) + sum(len(bucket) for bucket in router.buckets)
+        rate = self.rate or float(jobs) / (self.period * self.SPREAD)
+        self.tokens = TokenBucket(rate, self.burst, self.clock)
+        self.finished = defer.Deferred()
+        d = self.finished
+        self._pump()
+        return d
+
+    def _pump(self):
+        self.wakeup = None
+        self.pumping = True
+        try:
+            while self.jobs and self.running < self.concurrency:
+                job, arg = self.jobs[0]
+                if job == self._queueRepublish:
+                    if self.running:
+                        break
+                    self.jobs.popleft()
+                    self._queueRepublish()
+                    continue
+                if job == self._crawl and self._touched(arg):
+                    self.jobs.popleft()
+                    self.report["skipped"] += 1
+                    continue
+                wait = self.tokens.take()
+                if wait > 0:
+                    self.wakeup = self.clock.callLater(wait, self._pump)
+                    return
+                self.jobs.popleft()
+                self.running += 1
+                # jobs which finish straight away are picked up by this loop
+                defer.maybeDeferred(job, arg).addBoth(self._jobDone)
+        finally:
+            self.pumping = False
+        if not self.jobs and self.running == 0:
+            self._finish()
+
+    def _jobDone(self, result):
+        self.running -= 1
+        if isinstance(result, int):
+            self.report["messages"] += result
+        else:
+            self.log.warning("routing table refresh job failed: %s" % result)
+        if not self.pumping and self.wakeup is None:
+            self._pump()
+
+    def _finish(self):
+        self.report["duration"] = self.clock.seconds() - self.passStarted
+        self.log.info("refreshed %(buckets)d buckets (%(skipped)d skipped) and republished to %(republished)d "
+                      "contacts in %(duration).1fs, sending %(messages)d messages" % self.report)
+        self.lastReport = self.report
+        d, self.finished = self.finished, None
+        d.callback(self.report)
+
+    def _touched(self, node):
+        """
+        Whether the bucket node falls in has been used by a lookup since the pass started,
+        in which case it doesn't need refreshing.
+        """
+        if node is None:
+            return False
+        router = self.protocol.router
+        return router.buckets[router.getBucketFor(node)].lastUpdated >= self.started
+
+    def _crawl(self, node):
+        if node is None:
+            node = Node(_randomId((0, 2 ** 160)))
+        else:
+            self.report["buckets"] += 1
+        nearest = self.protocol.router.findNeighbors(node, self.alpha)
+        spider = NodeSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha)
+        return spider.find().addCallback(lambda _: spider.queries)
+
+    def _queueRepublish(self):
+        """
+        Once the crawls are done queue a republish to every contact, which now includes
+        the ones they found.
+        """
+        for bucket in self.protocol.router.buckets:
+            for node in bucket.getNodes():
+                self.jobs.append((self._republish, node))
+
+    def _republish(self, node):
+        if self.protocol.router.getStats(node) is None:
+            return 0
+        self.report["republished"] += 1
+        return self.protocol.transferKeyValues(node)
+
+
+def _randomId(bucketRange):
+    """
+    A random 20 byte id within the inclusive range of a bucket.
+    """
+    lower, upper = bucketRange
+    return ("%040x" % random.randint(lower, min(upper, 2 ** 160 - 1))).decode("hex")
@@ -4,19 +4,137 @@ Copyright (c) 2014 Brian Muller
 
 import heapq
 import time
+import zlib
+import struct
 import operator
+from binascii import hexlify
+from bisect import bisect_left
 from collections import OrderedDict
 
-from dht.utils import OrderedSet, sharedPrefix
+from dht.node import Node
+from dht.utils import sharedPrefix
+from protos import objects
+
+
+class SnapshotError(Exception):
+    """
+    Raised when a routing table snapshot can't be restored.
+    """
+
+
+class ContactStats(object):
+    """
+    How a contact has answered our requests: when it was last seen, a moving
+    average of its round trip time, and how many requests it has answered and
+    failed to answer.
+    """
+    __slots__ = ("lastSeen", "rtt", "successes", "failures", "consecutiveFailures", "cost")
+
+    # weight of a new round trip time sample in the average, as in TCP's SRTT
+    RTT_WEIGHT = 0.125
+    # round trip time assumed for a contact which hasn't answered a request yet
+    DEFAULT_RTT = 1.0
+    # cost of a contact we know nothing about
+    DEFAULT_COST = 2 * DEFAULT_RTT
+
+    def __init__(self, lastSeen=None, rtt=None, successes=0, failures=0):
+        self.lastSeen = time.time() if lastSeen is None else lastSeen
+        self.rtt = rtt
+        self.successes = successes
+        self.failures = failures
+        self.consecutiveFailures = 0
+        self.cost = self._cost()
+
+    def seen(self):
+        self.lastSeen = time.time()
+        self.consecutiveFailures = 0
+
+    def response(self, rtt):
+        self.seen()
+        self.successes += 1
+        self.rtt = rtt if self.rtt is None else self.rtt + self.RTT_WEIGHT * (rtt - self.rtt)
+        self.cost = self._cost()
+
+    def failure(self):
+        self.failures += 1
+        self.consecutiveFailures += 1
+        self.cost = self._cost()
+
+    def _cost(self):
+        """
+        The expected time to get an answer from the contact: its round trip time
+        divided by the fraction of requests it answers, estimated so that a new
+        contact counts as answering half of them.
+        """
+        rtt = self.DEFAULT_RTT if self.rtt is None else self.rtt
+        return rtt * (self.successes + self.failures + 2.0) / (self.successes + 1.0)
+
+
+class ReplacementCache(object):
+    """
+    The contacts seen for a full bucket, keyed by id and ordered from least to most
+    recently seen. Once there are more than maxsize the least recently seen is
+    dropped. All operations are O(1).
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.nodes = OrderedDict()
+        # node id -> time it was last seen
+        self.lastSeen = {}
+
+    def push(self, node, seen=None):
+        """
+        Add node as the most recently seen contact, replacing any entry with its id.
+        """
+        self.nodes.pop(node.id, None)
+        self.nodes[node.id] = node
+        self.lastSeen[node.id] = time.time() if seen is None else seen
+        if len(self.nodes) > self.maxsize:
+            del self.lastSeen[self.nodes.popitem(last=False)[0]]
+
+    def pop(self):
+        """
+        Remove the most recently seen contact and return it with the time it was seen.
+        """
+        node_id, node = self.nodes.popitem()
+        return node, self.lastSeen.pop(node_id)
+
+    def remove(self, node):
+        """
+        Remove the contact with node's id, if there is one.
+        """
+        if self.nodes.pop(node.id, None) is not None:
+            del self.lastSeen[node.id]
+
+    def items(self):
+        """
+        Return (node, last seen) pairs from least to most recently seen.
+        """
+        return [(node, self.lastSeen[node_id]) for node_id, node in self.nodes.iteritems()]
+
+    def __contains__(self, node):
+        return node.id in self.nodes
+
+    def __iter__(self):
+        return self.nodes.itervalues()
+
+    def __len__(self):
+        return len(self.nodes)
 
 
 class KBucket(object):
-    def __init__(self, range_lower, range_upper, ksize):
+    def __init__(self, range_lower, range_upper, ksize, addresses=None, replacementSize=None):
         self.range = (range_lower, range_upper)
         self.nodes = OrderedDict()
-        self.replacementNodes = OrderedSet()
+        # node id -> ContactStats for the nodes in the bucket
+        self.stats = {}
+        self.replacementNodes = ReplacementCache(ksize if replacementSize is None else replacementSize)
         self.touchLastUpdated()
         self.ksize = ksize
+        # (ip, port) -> node for the nodes in the bucket. All the buckets in a
+        # routing table share one dict.
+        self.addresses = {} if addresses is None else addresses
 
     def touchLastUpdated(self):
         self.lastUpdated = time.time()
@@ -26,22 +144,34 @@ class KBucket(object):
 
     def split(self):
         midpoint = self.range[1] - ((self.range[1] - self.range[0]) / 2)
-        one = KBucket(self.range[0], midpoint, self.ksize)
-        two = KBucket(midpoint + 1, self.range[1], self.ksize)
+        size = self.replacementNodes.maxsize
+        one = KBucket(self.range[0], midpoint, self.ksize, self.addresses, size)
+        two = KBucket(midpoint + 1, self.range[1], self.ksize, self.addresses, size)
         for node in self.nodes.values():
             bucket = one if node.long_id <= midpoint else two
             bucket.nodes[node.id] = node
+            bucket.stats[node.id] = self.stats[node.id]
+        for node, seen in self.replacementNodes.items():
+            bucket = one if node.long_id <= midpoint else two
+            bucket.replacementNodes.push(node, seen)
         return one, two
 
     def removeNode(self, node):
         if node.id not in self.nodes:
+            self.replacementNodes.remove(node)
             return
 
-        # delete node, and see if we can add a replacement
-        del self.nodes[node.id]
-        if len(self.replacementNodes) > 0:
-            newnode = self.replacementNodes.pop()
-            self.nodes[newnode.id] = newnode
+        # delete node, and promote the most recently seen replacement that no
+        # other contact has taken the address of
+        self._unindex(self.nodes.pop(node.id))
+        del self.stats[node.id]
+        while len(self.replacementNodes) > 0:
+            newnode, seen = self.replacementNodes.pop()
+            if self.addresses.get((newnode.ip, newnode.port), newnode).id == newnode.id:
+                self.nodes[newnode.id] = newnode
+                self.stats[newnode.id] = ContactStats(seen)
+                self._index(newnode)
+                break
 
     def hasInRange(self, node):
         return self.range[0] <= node.long_id <= self.range[1]
@@ -54,19 +184,30 @@ class KBucket(object):
         Add a C{Node} to the C{KBucket}.  Return True if successful,
         False if the bucket is full.
 
-        If the bucket is full, keep track of node in a replacement list,
+        If the bucket is full, keep track of node in the replacement cache,
         per section 4.1 of the paper.
         """
         if node.id in self.nodes:
-            del self.nodes[node.id]
+            self._unindex(self.nodes.pop(node.id))
             self.nodes[node.id] = node
+            self.stats[node.id].seen()
         elif len(self) < self.ksize:
             self.nodes[node.id] = node
+            self.stats[node.id] = ContactStats()
         else:
             self.replacementNodes.push(node)
             return False
+        self._index(node)
         return True
 
+    def _index(self, node):
+        self.addresses[(node.ip, node.port)] = node
+
+    def _unindex(self, node):
+        address = (node.ip, node.port)
+        if address in self.addresses and self.addresses[address].id == node.id:
+            del self.addresses[address]
+
     def depth(self):
         sp = sharedPrefix([n.id for n in self.nodes.values()])
         return len(sp)
@@ -81,66 +222,89 @@ class KBucket(object):
         return len(self.nodes)
 
 
-class TableTraverser(object):
-    def __init__(self, table, startNode):
-        index = table.getBucketFor(startNode)
-        table.buckets[index].touchLastUpdated()
-        self.currentNodes = table.buckets[index].getNodes()
-        self.leftBuckets = table.buckets[:index]
-        self.rightBuckets = table.buckets[(index + 1):]
-        self.left = True
-
-    def __iter__(self):
-        return self
-
-    def next(self):
-        """
-        Pop an item from the left subtree, then right, then left, etc.
-        """
-        if len(self.currentNodes) > 0:
-            return self.currentNodes.pop()
-
-        if self.left and len(self.leftBuckets) > 0:
-            self.currentNodes = self.leftBuckets.pop().getNodes()
-            self.left = False
-            return self.next()
-
-        if len(self.rightBuckets) > 0:
-            self.currentNodes = self.rightBuckets.pop().getNodes()
-            self.left = True
-            return self.next()
-
-        raise StopIteration
-
-
 class RoutingTable(object):
-    def __init__(self, protocol, ksize, node):
+    SNAPSHOT_HEADER = struct.Struct("<8sB20sHdI")  # magic, version, our id, ksize, time saved, bucket count
+    SNAPSHOT_BUCKET = struct.Struct("<21s21sdHH")  # range, last updated, node and replacement counts
+    # last seen, round trip time (-1 if unknown), successes, failures, length of the serialized objects.Node
+    SNAPSHOT_CONTACT = struct.Struct("<dfIIH")
+    SNAPSHOT_MAGIC = "OBROUTES"
+    SNAPSHOT_VERSION = 2
+    # consecutive failed requests after which a contact is removed
+    MAX_FAILURES = 3
+
+    def __init__(self, protocol, ksize, node, replacementSize=None):
         """
         @param node: The node that represents this server.  It won't
         be added to the routing table, but will be needed later to
         determine which buckets to split or not.
+        @param replacementSize: How many replacement contacts to keep per
+        bucket, ksize by default.
         """
         self.node = node
         self.protocol = protocol
         self.ksize = ksize
+        self.replacementSize = replacementSize
         self.flush()
 
     def flush(self):
-        self.buckets = [KBucket(0, 2 ** 160, self.ksize)]
+        # (ip, port) -> node for every contact, maintained by the buckets
+        self.addresses = {}
+        self.buckets = [KBucket(0, 2 ** 160, self.ksize, self.addresses, self.replacementSize)]
+        # upper end of each bucket's range, in the same order as self.buckets
+        self.upperBounds = [2 ** 160]
+        # node id -> node for the contacts restored from a snapshot which haven't
+        # been heard from since. One failed request removes them.
+        self.stale = {}
 
     def splitBucket(self, index):
         one, two = self.buckets[index].split()
         self.buckets[index] = one
         self.buckets.insert(index + 1, two)
+        self.upperBounds[index] = one.range[1]
+        self.upperBounds.insert(index + 1, two.range[1])
 
-    def getLonelyBuckets(self):
+    def getLonelyBuckets(self, age=3600):
         """
         Get all of the buckets that haven't been updated in over
-        an hour.
+        age seconds, an hour by default.
         """
-        return [b for b in self.buckets if b.lastUpdated < (time.time() - 3600)]
+        return [b for b in self.buckets if b.lastUpdated < (time.time() - age)]
+
+    def getStats(self, node):
+        """
+        Return the ContactStats for node, or None if it isn't in a bucket.
+        """
+        return self.buckets[self.getBucketFor(node)].stats.get(node.id)
+
+    def recordResponse(self, node, rtt):
+        """
+        Record that node answered a request after rtt seconds.
+        """
+        stats = self.getStats(node)
+        if stats is not None:
+            stats.response(rtt)
+
+    def recordFailure(self, node):
+        """
+        Record that node didn't answer a request. Returns True once it has failed
+        MAX_FAILURES requests in a row, or if it isn't in a bucket, meaning it should
+        be removed.
+        """
+        stats = self.getStats(node)
+        if stats is None:
+            return True
+        stats.failure()
+        return stats.consecutiveFailures >= self.MAX_FAILURES
+
+    def cost(self, node):
+        """
+        The expected time for node to answer a request, see ContactStats._cost.
+        """
+        stats = self.getStats(node)
+        return ContactStats.DEFAULT_COST if stats is None else stats.cost
 
     def removeContact(self, node):
+        self.stale.pop(node.id, None)
         index = self.getBucketFor(node)
         self.buckets[index].removeNode(node)
 
@@ -149,12 +313,15 @@ class RoutingTable(object):
         return self.buckets[index].isNewNode(node)
 
     def checkAndRemoveDuplicate(self, node):
-        for bucket in self.buckets:
-            for n in bucket.getNodes():
-                if (n.ip, n.port) == (node.ip, node.port) and n.id != node.id:
-                    self.removeContact(n)
+        """
+        Remove the contact at node's address if it has a different id.
+        """
+        n = self.addresses.get((node.ip, node.port))
+        if n is not None and n.id != node.id:
+            self.removeContact(n)
 
     def addContact(self, node):
+        self.stale.pop(node.id, None)
         self.checkAndRemoveDuplicate(node)
         index = self.getBucketFor(node)
         bucket = self.buckets[index]
@@ -169,23 +336,171 @@ class RoutingTable(object):
             self.splitBucket(index)
             self.addContact(node)
         else:
-            self.protocol.callPing(bucket.head())
+            # check a contact we haven't heard from since restarting, then the one
+            # which has failed the most requests in a row, before the least recently
+            # seen one
+            for contact in bucket.nodes.itervalues():
+                if contact.id in self.stale:
+                    self.protocol.callPing(contact)
+                    return
+            failing = max(bucket.nodes.itervalues(), key=lambda n: bucket.stats[n.id].consecutiveFailures)
+            self.protocol.callPing(failing if bucket.stats[failing.id].consecutiveFailures > 0 else bucket.head())
+
+    def popStale(self, count):
+        """
+        Remove and return up to count of the contacts which haven't been heard from
+        since they were restored, so they can be checked.
+        """
+        nodes = []
+        while self.stale and len(nodes) < count:
+            nodes.append(self.stale.popitem()[1])
+        return nodes
+
+    def snapshot(self):
+        """
+        Return the buckets, their replacement caches and the ContactStats of each
+        contact as a compact binary string for restore().
+        """
+        def contact(node, stats):
+            proto = node.getSerializedProto()
+            return self.SNAPSHOT_CONTACT.pack(stats.lastSeen, -1 if stats.rtt is None else stats.rtt,
+                                              stats.successes, stats.failures, len(proto)) + proto
+
+        parts = [self.SNAPSHOT_HEADER.pack(self.SNAPSHOT_MAGIC, self.SNAPSHOT_VERSION, self.node.id,
+                                           self.ksize, time.time(), len(self.buckets))]
+        for bucket in self.buckets:
+            parts.append(self.SNAPSHOT_BUCKET.pack(_packId(bucket.range[0]), _packId(bucket.range[1]),
+                                                   bucket.lastUpdated, len(bucket), len(bucket.replacementNodes)))
+            for node in bucket.nodes.itervalues():
+                parts.append(contact(node, bucket.stats[node.id]))
+            for node, seen in bucket.replacementNodes.items():
+                parts.append(contact(node, ContactStats(seen)))
+        data = "".join(parts)
+        return data + struct.pack("<I", zlib.crc32(data) & 0xffffffff)
+
+    def restore(self, data):
+        """
+        Replace the table with one saved by snapshot(). The restored contacts are
+        marked stale until they're heard from again, and a single failed request
+        removes them. Returns the number of contacts in the buckets.
+        """
+        if len(data) < self.SNAPSHOT_HEADER.size + 4 or \
+                struct.unpack("<I", data[-4:])[0] != zlib.crc32(data[:-4]) & 0xffffffff:
+            raise SnapshotError("routing table snapshot is truncated or corrupt")
+        magic, version, node_id, ksize, _, count = self.SNAPSHOT_HEADER.unpack_from(data)
+        if magic != self.SNAPSHOT_MAGIC or version != self.SNAPSHOT_VERSION:
+            raise SnapshotError("not a version %d routing table snapshot" % self.SNAPSHOT_VERSION)
+        if node_id != self.node.id or ksize != self.ksize:
+            raise SnapshotError("routing table snapshot is for a different node id or ksize")
+
+        offset = self.SNAPSHOT_HEADER.size
+
+        def contact():
+            seen, rtt, successes, failures, length = self.SNAPSHOT_CONTACT.unpack_from(data, offset)
+            start = offset + self.SNAPSHOT_CONTACT.size
+            n = objects.Node()
+            n.ParseFromString(data[start:start + length])
+            node = Node(n.guid, n.nodeAddress.ip, n.nodeAddress.port, n.publicKey,
+                        None if not n.HasField("relayAddress") else (n.relayAddress.ip, n.relayAddress.port),
+                        n.natType, n.vendor)
+            return node, ContactStats(seen, None if rtt < 0 else rtt, successes, failures), start + length
+
+        addresses = {}
+        buckets = []
+        stale = {}
+        try:
+            for _ in range(count):
+                lower, upper, lastUpdated, nodes, replacements = self.SNAPSHOT_BUCKET.unpack_from(data, offset)
+                offset += self.SNAPSHOT_BUCKET.size
+                bucket = KBucket(_unpackId(lower), _unpackId(upper), self.ksize, addresses, self.replacementSize)
+                bucket.lastUpdated = lastUpdated
+                for _ in range(nodes):
+                    node, stats, offset = contact()
+                    stats.consecutiveFailures = self.MAX_FAILURES - 1
+                    bucket.nodes[node.id] = node
+                    bucket.stats[node.id] = stats
+                    bucket._index(node)  # pylint: disable=protected-access
+                    stale[node.id] = node
+                for _ in range(replacements):
+                    node, stats, offset = contact()
+                    bucket.replacementNodes.push(node, stats.lastSeen)
+                buckets.append(bucket)
+        except struct.error:
+            raise SnapshotError("routing table snapshot is truncated or corrupt")
+
+        ranges = [b.range for b in buckets]
+        if offset != len(data) - 4 or len(ranges) == 0 or ranges[0][0] != 0 or ranges[-1][1] != 2 ** 160 or \
+                any(ranges[i][1] + 1 != ranges[i + 1][0] for i in range(len(ranges) - 1)):
+            raise SnapshotError("routing table snapshot doesn't cover the id space")
+        self.addresses = addresses
+        self.buckets = buckets
+        self.upperBounds = [upper for _, upper in ranges]
+        self.stale = stale
+        return len(stale)
 
     def getBucketFor(self, node):
         """
         Get the index of the bucket that the given node would fall into.
         """
-        for index, bucket in enumerate(self.buckets):
-            if node.long_id < bucket.range[1]:
-                return index
+        return bisect_left(self.upperBounds, node.long_id)
 
     def findNeighbors(self, node, k=None, exclude=None):
+        """
+        Return the k contacts closest to node, closest first, leaving out any at the
+        same address as exclude.
+
+        The ids within distance 2 ** m of node form an aligned block of 2 ** m ids
+        around it, so buckets are visited outwards from node's bucket a level of that
+        block at a time. Once every bucket overlapping the block has been visited and
+        the k-th closest contact found is nearer than 2 ** m, no other contact can be
+        closer and the walk stops, so the result is exact.
+        """
         k = k or self.ksize
-        nodes = []
-        for neighbor in TableTraverser(self, node):
-            if exclude is None or not neighbor.sameHomeAs(exclude):
-                heapq.heappush(nodes, (node.distanceTo(neighbor), neighbor))
-            if len(nodes) == k:
+        target = node.long_id
+        index = self.getBucketFor(node)
+        self.buckets[index].touchLastUpdated()
+        last = len(self.buckets) - 1
+        # max heap of the k closest so far, as (-distance, node)
+        closest = []
+
+        def visit(bucket):
+            for neighbor in bucket.nodes.itervalues():
+                if exclude is not None and neighbor.sameHomeAs(exclude):
+                    continue
+                distance = target ^ neighbor.long_id
+                if len(closest) < k:
+                    heapq.heappush(closest, (-distance, neighbor))
+                elif distance < -closest[0][0]:
+                    heapq.heapreplace(closest, (-distance, neighbor))
+
+        visit(self.buckets[index])
+        left = right = index
+        while left > 0 or right < last:
+            # the largest aligned block around target covered by the visited buckets
+            lower, upper = self.buckets[left].range[0], self.buckets[right].range[1]
+            level = (target ^ (upper + 1)).bit_length() - 1
+            if lower > 0:
+                level = min(level, (target ^ (lower - 1)).bit_length() - 1)
+            if len(closest) == k and -closest[0][0] < 2 ** level:
                 break
-
-        return map(operator.itemgetter(1), heapq.nsmallest(k, nodes))
+            start = target >> (level + 1) << (level + 1)
+            end = start + 2 ** (level + 1) - 1
+            while left > 0 and self.buckets[left - 1].range[1] >= start:
+                left -= 1
+                visit(self.buckets[left])
+            while right < last and self.buckets[right + 1].range[0] <= end:
+                right += 1
+                visit(self.buckets[right])
+        closest.sort(reverse=True)
+        return map(operator.itemgetter(1), closest)
+
+
+def _packId(long_id):
+    """
+    Pack an id or bucket bound, which can be up to 2 ** 160, into 21 bytes.
+    """
+    return ("%042x" % long_id).decode("hex")
+
+
+def _unpackId(packed):
+    return long(hexlify(packed), 16)
@@ -3,13 +3,23 @@ Copyright (c) 2014 Brian Muller
 Copyright (c) 2015 OpenBazaar
 """
 
+import os
 import time
+import mmap
+import zlib
+import heapq
+import struct
 import sqlite3 as lite
-from collections import OrderedDict, MutableMapping
+from array import array
+from collections import Counter, OrderedDict, Mapping, MutableMapping
+from twisted.internet import reactor, task
 from zope.interface import implements, Interface
 from protos.objects import Value
+from db.migrations import migration1, migration2
 from threading import RLock
 
+INFINITY = float("inf")
+
 
 class IStorage(Interface):
     """
@@ -26,6 +36,13 @@ class IStorage(Interface):
         Get the given key.  If item doesn't exist, raises C{KeyError}
         """
 
+    def store_many(self, values):
+        """
+        Store each (keyword, key, value, ttl) tuple in values, optionally followed by the
+        id of the node the value came from. This should be done in a single transaction
+        and a single pass over the expired values rather than one per value.
+        """
+
     def get(self, key, default=None):
         """
         Get given key.  If not found, return default.
@@ -48,12 +65,15 @@ class IStorage(Interface):
 
     def iterkeys(self):
         """
-        Get the key iterator for this storage, should yield a list of keys
+        Get the key iterator for this storage, should yield each keyword. This should be
+        a generator which reads the backing store in bounded pages rather than building
+        a list of the whole table.
         """
 
     def iteritems(self, keyword):
         """
-        Get the value iterator for the given keyword, should yield a tuple of (key, value)
+        Get the value iterator for the given keyword, should yield a tuple of (key, value).
+        Like iterkeys() this should stream rather than materialize every value.
         """
 
     def get_ttl(self, keyword, key):
@@ -62,54 +82,270 @@ class IStorage(Interface):
         """
 
 
+class StorageQuota(object):
+    """
+    Limits on how much a storage will hold. Limits left as `None` are not enforced.
+
+    A store is refused if its keyword already holds `max_per_keyword` values or its
+    origin (the node which sent it) already stored `max_per_origin` values. When
+    `max_entries` or `max_bytes` is exceeded, values are evicted starting with the
+    keywords farthest from `node_id`, since the closer nodes are the ones the
+    network expects to find them on.
+    """
+
+    # number of bits dropped from a 160 bit distance so it fits in an sqlite INTEGER
+    DISTANCE_SHIFT = 97
+
+    def __init__(self, node_id, max_bytes=None, max_entries=None, max_per_keyword=None, max_per_origin=None):
+        self.node_id = node_id
+        self.long_id = long(node_id.encode('hex'), 16)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.max_per_keyword = max_per_keyword
+        self.max_per_origin = max_per_origin
+        # number of values evicted and stores refused, by the limit which caused it
+        self.evictions = Counter()
+        self.rejections = Counter()
+
+    def distance(self, keyword):
+        return self.long_id ^ long(keyword.encode('hex'), 16)
+
+    def exceeded(self, entries, size):
+        """
+        Return the name of the global limit exceeded by the given totals, or None.
+        """
+        if self.max_entries is not None and entries > self.max_entries:
+            return "entries"
+        if self.max_bytes is not None and size > self.max_bytes:
+            return "bytes"
+        return None
+
+
+class ValueCache(object):
+    """
+    Serialized `Value` responses for the most recently fetched keywords.
+
+    The ttl is the last field of a `Value`, so each value is kept encoded without
+    it and a hit only has to append the remaining ttl rather than build and encode
+    every protobuf again. The storage invalidates a keyword whenever it changes,
+    and an entry is ignored once the first of its values expires.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, keyword, now):
+        """
+        Return the serialized values for keyword with their ttl as of now, or
+        None if the keyword isn't cached.
+        """
+        entry = self.entries.pop(keyword, None)
+        if entry is None or entry[0] < now:
+            self.misses += 1
+            return None
+        self.entries[keyword] = entry
+        self.hits += 1
+        return [encoded + _encodeTTL(int(round(expires_at - now))) for encoded, expires_at in entry[1]]
+
+    def put(self, keyword, values, now):
+        """
+        Cache values, a list of (key, value, expires_at), for keyword and return
+        them serialized with their ttl as of now. An empty list isn't cached.
+        """
+        if not values:
+            return []
+        encoded = []
+        for k, v, expires_at in values:
+            value = Value()
+            value.valueKey = k
+            value.serializedData = v
+            encoded.append((value.SerializeToString(), expires_at))
+        self.entries.pop(keyword, None)
+        self.entries[keyword] = (min(expires_at for _, expires_at in encoded), encoded)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return [e + _encodeTTL(int(round(expires_at - now))) for e, expires_at in encoded]
+
+    def invalidate(self, keyword):
+        self.entries.pop(keyword, None)
+
+
+def _encodeTTL(ttl):
+    """
+    Encode ttl as field 4 of a `Value`. Like protobuf we leave it out when it's zero.
+    """
+    if ttl <= 0:
+        return ""
+    encoded = [chr(0x20)]
+    while ttl > 0x7f:
+        encoded.append(chr(0x80 | (ttl & 0x7f)))
+        ttl >>= 7
+    encoded.append(chr(ttl))
+    return "".join(encoded)
+
+
 class ForgetfulStorage(object):
     implements(IStorage)
 
-    def __init__(self, ttl=604800):
+    def __init__(self, ttl=604800, quota=None):
         """
-        By default, max age is a week.
+        By default, max age is a week and there is no quota.
         """
         self.data = OrderedDict()
         self.ttl = ttl
+        self.quota = quota
+        # heap of (expiration, keyword, key) so cull() only needs to look at the
+        # values which have actually expired rather than walking the whole table.
+        self.expirations = []
+        # heap of (-distance, keyword) so the farthest keyword is evicted first, and
+        # the keywords in it. Keywords which have emptied out stay until they reach the top.
+        self.farthest = []
+        self.ranked = set()
+        self.origins = {}
+        self.originCounts = Counter()
+        self.entries = 0
+        self.size = 0
+        self.cache = ValueCache()
 
     def __setitem__(self, keyword, values):
-        valueDic = TTLDict(self.ttl)
-        if keyword in self.data:
-            valueDic = self.data[keyword]
-            if values[0] not in valueDic:
-                valueDic[values[0]] = values[1]
-                valueDic.set_ttl(values[0], values[2])
-        else:
-            valueDic[values[0]] = values[1]
-            valueDic.set_ttl(values[0], values[2])
-            self.data[keyword] = valueDic
+        """
+        Store values, a tuple of (key, value, ttl) and optionally the id of the node
+        the value came from, at keyword.
+        """
+        self.cull()
+        self._store(keyword, values, time.time())
+        self.cull()
+
+    def store_many(self, values):
         self.cull()
+        now = time.time()
+        for value in values:
+            self._store(value[0], value[1:], now)
+        self.cull()
+
+    def _store(self, keyword, values, now):
+        key, value, ttl = values[:3]
+        origin = values[3] if len(values) > 3 else None
+        if keyword in self.data:
+            try:
+                if not self.data[keyword].is_expired(key, now):
+                    return
+                self._forget(keyword, key, self.data[keyword].pop(key))
+            except KeyError:
+                pass
+        if self.quota is not None and not self._admit(keyword, origin):
+            return
+        if keyword not in self.data:
+            self.data[keyword] = TTLMap(self.ttl)
+            if self.quota is not None and keyword not in self.ranked:
+                self._rank(keyword)
+        valueDic = self.data[keyword]
+        valueDic[key] = value
+        valueDic.set_ttl(key, ttl, now)
+        self.cache.invalidate(keyword)
+        expiration = (now + ttl, keyword, key)
+        heapq.heappush(self.expirations, expiration)
+        self.entries += 1
+        self.size += len(key) + len(value)
+        if origin is not None:
+            self.origins[(keyword, key)] = origin
+            self.originCounts[origin] += 1
+        self._added(keyword, key, value, expiration)
+        if self.quota is not None:
+            self._evict()
+
+    def _added(self, keyword, key, value, expiration):
+        """
+        Called after a value is stored, with its entry in the expiration heap.
+        """
+
+    def _admit(self, keyword, origin):
+        quota = self.quota
+        if quota.max_per_keyword is not None and keyword in self.data \
+                and len(self.data[keyword]) >= quota.max_per_keyword:
+            quota.rejections["keyword"] += 1
+            return False
+        if quota.max_per_origin is not None and origin is not None \
+                and self.originCounts[origin] >= quota.max_per_origin:
+            quota.rejections["origin"] += 1
+            return False
+        return True
+
+    def _rank(self, keyword):
+        # drop the keywords which have emptied out once they make up most of the heap
+        if len(self.farthest) > 2 * len(self.data):
+            self.farthest = [entry for entry in self.farthest if entry[1] in self.data]
+            heapq.heapify(self.farthest)
+            self.ranked = set(entry[1] for entry in self.farthest)
+        heapq.heappush(self.farthest, (-self.quota.distance(keyword), keyword))
+        self.ranked.add(keyword)
+
+    def _evict(self):
+        limit = self.quota.exceeded(self.entries, self.size)
+        while limit is not None:
+            keyword = self.farthest[0][1]
+            if keyword not in self.data:
+                heapq.heappop(self.farthest)
+                self.ranked.discard(keyword)
+                continue
+            key, value = self.data[keyword].popitem()
+            self._forget(keyword, key, value)
+            self.quota.evictions[limit] += 1
+            limit = self.quota.exceeded(self.entries, self.size)
+
+    def _forget(self, keyword, key, value):
+        """
+        Update the bookkeeping for a value which was removed from keyword.
+        """
+        self.entries -= 1
+        self.size -= len(key) + len(value)
+        self.cache.invalidate(keyword)
+        origin = self.origins.pop((keyword, key), None)
+        if origin is not None:
+            self.originCounts[origin] -= 1
+            if self.originCounts[origin] == 0:
+                del self.originCounts[origin]
+        if len(self.data[keyword]) == 0:
+            del self.data[keyword]
 
     def cull(self):
-        for key in self.data.iterkeys():
-            self.data[key].cull()
-            if len(self.data[key]) == 0:
-                del self.data[key]
+        """
+        Pop expired entries off the expiration heap and remove them. Entries for values
+        which were deleted (or deleted and stored again) are simply skipped.
+        """
+        now = time.time()
+        while len(self.expirations) > 0 and self.expirations[0][0] < now:
+            # pylint: disable=unused-variable
+            expiration, keyword, key = heapq.heappop(self.expirations)
+            if keyword not in self.data:
+                continue
+            try:
+                if self.data[keyword].is_expired(key, now):
+                    self._forget(keyword, key, self.data[keyword].pop(key))
+            except KeyError:
+                pass
 
     def get(self, keyword, default=None):
         self.cull()
-        if keyword in self.data:
-            ret = []
-            for k, v in self[keyword].items():
-                value = Value()
-                value.valueKey = k
-                value.serializedData = v
-                value.ttl = int(round(self.data[keyword].get_ttl(k)))
-                ret.append(value.SerializeToString())
-            return ret
-        return default
+        if keyword not in self.data:
+            return default
+        now = time.time()
+        ret = self.cache.get(keyword, now)
+        if ret is None:
+            valueDic = self.data[keyword]
+            # a value may have expired since cull()
+            ret = self.cache.put(keyword, [(k, v, valueDic.get_ttl(k, 0)) for k, v in valueDic.items()], now)
+        return ret or default
 
     def getSpecific(self, keyword, key):
         if keyword in self.data and key in self.data[keyword]:
             return self.data[keyword][key]
 
     def delete(self, keyword, key):
-        del self.data[keyword][key]
+        self._forget(keyword, key, self.data[keyword].pop(key))
         self.cull()
 
     def __getitem__(self, keyword):
@@ -126,7 +362,10 @@ class ForgetfulStorage(object):
 
     def iterkeys(self):
         self.cull()
-        return self.data.iterkeys()
+        # iterate over a snapshot since keywords may expire while the caller is iterating
+        for keyword in self.data.keys():
+            if keyword in self.data:
+                yield keyword
 
     def iteritems(self, keyword):
         self.cull()
@@ -137,102 +376,752 @@ class ForgetfulStorage(object):
             return self.data[keyword].get_ttl(key)
 
 
+class ShardedStorage(ForgetfulStorage):
+    """
+    A `ForgetfulStorage` which partitions keywords into 2 ** `prefix_bits` shards by
+    their leading bits and keeps the number of values, their size and the oldest
+    expiration of each shard up to date as values come and go.
+
+    `stats()` reports the counters without walking the table, and `iterkeys()` can be
+    told which shards to visit so `transferKeyValues` skips the parts of the keyspace
+    a new node can't be responsible for.
+    """
+
+    def __init__(self, ttl=604800, quota=None, prefix_bits=8):
+        ForgetfulStorage.__init__(self, ttl, quota)
+        self.prefixBits = prefix_bits
+        self.shards = [_Shard() for _ in range(2 ** prefix_bits)]
+        self._prefixBytes = (prefix_bits + 7) / 8
+        self._prefixShift = self._prefixBytes * 8 - prefix_bits
+
+    def prefix(self, keyword):
+        """
+        Return the index of the shard keyword belongs to.
+        """
+        return int(keyword[:self._prefixBytes].encode('hex'), 16) >> self._prefixShift
+
+    def _added(self, keyword, key, value, expiration):
+        shard = self.shards[self.prefix(keyword)]
+        shard.keywords.add(keyword)
+        shard.entries += 1
+        shard.size += len(key) + len(value)
+        heapq.heappush(shard.expirations, expiration)
+
+    def _forget(self, keyword, key, value):
+        ForgetfulStorage._forget(self, keyword, key, value)
+        shard = self.shards[self.prefix(keyword)]
+        shard.entries -= 1
+        shard.size -= len(key) + len(value)
+        if keyword not in self.data:
+            shard.keywords.discard(keyword)
+
+    def oldest(self, prefix):
+        """
+        Return when the first value in a shard expires, or None if it's empty.
+        """
+        expirations = self.shards[prefix].expirations
+        while len(expirations) > 0:
+            expiration, keyword, key = expirations[0]
+            valueDic = self.data.get(keyword)
+            if valueDic is not None and key in valueDic and valueDic.get_ttl(key, 0) == expiration:
+                return expiration
+            # the value was deleted, evicted or stored again since
+            heapq.heappop(expirations)
+        return None
+
+    def stats(self):
+        """
+        Return a dict for each shard holding any values with its prefix, the number of
+        values and bytes stored in it and when its oldest value expires.
+        """
+        self.cull()
+        return [{"prefix": prefix, "values": shard.entries, "bytes": shard.size, "oldest": self.oldest(prefix)}
+                for prefix, shard in enumerate(self.shards) if shard.entries > 0]
+
+    def iterkeys(self, shards=None):  # pylint: disable=arguments-differ
+        """
+        Yield each keyword, shard by shard. If shards is given it's called with each
+        non-empty shard's prefix and only the shards it returns True for are visited.
+        """
+        self.cull()
+        for prefix, shard in enumerate(self.shards):
+            if shard.entries == 0 or (shards is not None and not shards(prefix)):
+                continue
+            for keyword in list(shard.keywords):
+                if keyword in self.data:
+                    yield keyword
+
+
+class _Shard(object):
+    __slots__ = ['keywords', 'entries', 'size', 'expirations']
+
+    def __init__(self):
+        self.keywords = set()
+        self.entries = 0
+        self.size = 0
+        # heap of (expiration, keyword, key), sharing its tuples with the storage's heap
+        self.expirations = []
+
+
 class PersistentStorage(object):
     implements(IStorage)
 
-    def __init__(self, filename, ttl=604800):
-
+    def __init__(self, filename, ttl=604800, flush_interval=0.05, page_size=1000, quota=None):
+        """
+        Stores are queued and written to the database in a single transaction
+        `flush_interval` seconds after the first one. Anything reading from the
+        table flushes first, so stores are visible right away. Expired values are
+        filtered out of reads and deleted by `cull()`, which the `Server` calls
+        from a `LoopingCall`. `iterkeys()` and `iteritems()` read at most
+        `page_size` rows at a time. If a `StorageQuota` is given it's enforced
+        when the pending stores are flushed.
+        """
         self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.page_size = page_size
+        self.quota = quota
+        self.cache = ValueCache()
+        self.pending = []
+        self.flushCall = None
         self.db = lite.connect(filename)
         self.db.text_factory = str
-        try:
-            cursor = self.db.cursor()
-            cursor.execute('''CREATE TABLE dht(keyword TEXT, id BLOB, value BLOB, birthday FLOAT)''')
-            cursor.execute('''CREATE INDEX idx1 ON dht(keyword);CREATE INDEX idx2 ON dht(birthday);''')
-            self.db.commit()
-        except Exception:
-            self.cull()
+        self.db.execute('''PRAGMA journal_mode=WAL''')
+        self.db.execute('''PRAGMA synchronous=NORMAL''')
+        cursor = self.db.cursor()
+        cursor.execute('''PRAGMA table_info(dht)''')
+        columns = [column[1] for column in cursor.fetchall()]
+        if "birthday" in columns:
+            migration1.migrate(filename, ttl)
+        if len(columns) > 0 and "origin" not in columns:
+            migration2.migrate(filename)
+        cursor.execute('''CREATE TABLE IF NOT EXISTS dht(keyword BLOB, id BLOB, value BLOB, expires_at FLOAT,
+                          origin BLOB, distance INTEGER)''')
+        cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS index_dht_keyword_id ON dht(keyword, id)''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS index_dht_expires_at ON dht(expires_at)''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS index_dht_origin ON dht(origin)''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS index_dht_distance ON dht(distance)''')
+        if self.quota is not None:
+            self._fill_distances(cursor)
+        self.db.commit()
+        cursor.execute('''SELECT COUNT(*), TOTAL(LENGTH(id) + LENGTH(value)) FROM dht''')
+        self.entries, size = cursor.fetchone()
+        self.size = int(size)
+        self.cull()
+
+    def _fill_distances(self, cursor):
+        """
+        Set the distance of rows stored before there was a quota.
+        """
+        while True:
+            cursor.execute('''SELECT rowid, keyword FROM dht WHERE distance IS NULL LIMIT ?''', (self.page_size,))
+            rows = cursor.fetchall()
+            if len(rows) == 0:
+                return
+            cursor.executemany('''UPDATE dht SET distance=? WHERE rowid=?''',
+                               [(self._distance(str(keyword)), rowid) for rowid, keyword in rows])
+
+    def _distance(self, keyword):
+        if self.quota is None:
+            return None
+        return self.quota.distance(keyword) >> StorageQuota.DISTANCE_SHIFT
 
     def __setitem__(self, keyword, values):
+        """
+        Store values, a tuple of (key, value, ttl) and optionally the id of the node
+        the value came from, at keyword.
+        """
+        origin = lite.Binary(values[3]) if len(values) > 3 else None
+        self.pending.append((lite.Binary(keyword), lite.Binary(values[0]), lite.Binary(values[1]),
+                             time.time() + values[2], origin, self._distance(keyword)))
+        if self.flushCall is None:
+            self.flushCall = reactor.callLater(self.flush_interval, self.flush)
+
+    def store_many(self, values):
+        """
+        Queue every value and write them all in one transaction right away.
+        """
+        now = time.time()
+        for value in values:
+            keyword = value[0]
+            origin = lite.Binary(value[4]) if len(value) > 4 else None
+            self.pending.append((lite.Binary(keyword), lite.Binary(value[1]), lite.Binary(value[2]),
+                                 now + value[3], origin, self._distance(keyword)))
+        self.flush()
+
+    def flush(self):
+        """
+        Write all pending stores to the database in one transaction.
+        """
+        if self.flushCall is not None:
+            if self.flushCall.active():
+                self.flushCall.cancel()
+            self.flushCall = None
+        if len(self.pending) == 0:
+            return
+        pending, self.pending = self.pending, []
+        now = time.time()
         cursor = self.db.cursor()
-        cursor.execute('''SELECT id, value FROM dht WHERE keyword=? AND id=? AND value=?''',
-                       (keyword.encode("hex"), values[0], values[1]))
-        if cursor.fetchone() is None:
-            birthday = time.time() - (self.ttl - values[2])
-            cursor.execute('''INSERT OR IGNORE INTO dht(keyword, id, value, birthday)
-                          VALUES (?,?,?,?)''', (keyword.encode("hex"), values[0], values[1], birthday))
-            self.db.commit()
-        self.cull()
+        for row in pending:
+            if self.quota is not None and not self._admit(cursor, row[0], row[4]):
+                continue
+            cursor.execute('''INSERT OR IGNORE INTO dht(keyword, id, value, expires_at, origin, distance)
+                              VALUES (?,?,?,?,?,?)''', row)
+            if cursor.rowcount == 0 and self._removeExpired(cursor, row[0], row[1], now):
+                cursor.execute('''INSERT INTO dht(keyword, id, value, expires_at, origin, distance)
+                                  VALUES (?,?,?,?,?,?)''', row)
+            if cursor.rowcount == 1:
+                self.entries += 1
+                self.size += len(row[1]) + len(row[2])
+                self.cache.invalidate(str(row[0]))
+        if self.quota is not None:
+            self._evict(cursor)
+        self.db.commit()
+
+    def _removeExpired(self, cursor, keyword, key, now):
+        """
+        Delete the value stored at keyword and key if it has expired but hasn't been
+        culled yet, so a new store of it isn't ignored. Returns whether it did.
+        """
+        cursor.execute('''SELECT rowid, LENGTH(id) + LENGTH(value) FROM dht
+                          WHERE keyword=? AND id=? AND expires_at<?''', (keyword, key, now))
+        expired = cursor.fetchone()
+        if expired is None:
+            return False
+        cursor.execute('''DELETE FROM dht WHERE rowid=?''', (expired[0],))
+        self.entries -= 1
+        self.size -= expired[1]
+        return True
+
+    def _admit(self, cursor, keyword, origin):
+        quota = self.quota
+        if quota.max_per_keyword is not None:
+            cursor.execute('''SELECT COUNT(*) FROM dht WHERE keyword=?''', (keyword,))
+            if cursor.fetchone()[0] >= quota.max_per_keyword:
+                quota.rejections["keyword"] += 1
+                return False
+        if quota.max_per_origin is not None and origin is not None:
+            cursor.execute('''SELECT COUNT(*) FROM dht WHERE origin=?''', (origin,))
+            if cursor.fetchone()[0] >= quota.max_per_origin:
+                quota.rejections["origin"] += 1
+                return False
+        return True
+
+    def _evict(self, cursor):
+        limit = self.quota.exceeded(self.entries, self.size)
+        while limit is not None:
+            cursor.execute('''SELECT rowid, keyword, LENGTH(id) + LENGTH(value) FROM dht
+                              ORDER BY distance DESC LIMIT ?''', (self.page_size,))
+            rows = cursor.fetchall()
+            if len(rows) == 0:
+                return
+            for rowid, keyword, size in rows:
+                cursor.execute('''DELETE FROM dht WHERE rowid=?''', (rowid,))
+                self.cache.invalidate(str(keyword))
+                self.entries -= 1
+                self.size -= size
+                self.quota.evictions[limit] += 1
+                limit = self.quota.exceeded(self.entries, self.size)
+                if limit is None:
+                    return
 
     def __getitem__(self, keyword):
-        self.cull()
+        self.flush()
         cursor = self.db.cursor()
-        cursor.execute('''SELECT id, value, birthday FROM dht WHERE keyword=?''', (keyword.encode("hex"),))
-        return cursor.fetchall()
+        cursor.execute('''SELECT id, value, expires_at FROM dht WHERE keyword=? AND expires_at>=?
+                          ORDER BY rowid''', (lite.Binary(keyword), time.time()))
+        return [(str(k), str(v), expires_at) for k, v, expires_at in cursor.fetchall()]
 
     def get(self, keyword, default=None):
-        self.cull()
-        if len(self[keyword]) > 0:
-            ret = []
-            for k, v, birthday in self[keyword]:
-                value = Value()
-                value.valueKey = k
-                value.serializedData = v
-                value.ttl = int(round(self.ttl - (time.time() - birthday)))
-                ret.append(value.SerializeToString())
-            return ret
-        return default
+        self.flush()
+        now = time.time()
+        ret = self.cache.get(keyword, now)
+        if ret is None:
+            rows = self[keyword]
+            if len(rows) == 0:
+                return default
+            ret = self.cache.put(keyword, rows, now)
+        return ret
 
     def getSpecific(self, keyword, key):
+        self.flush()
         try:
             cursor = self.db.cursor()
-            cursor.execute('''SELECT value FROM dht WHERE keyword=? AND id=?''', (keyword.encode("hex"), key))
-            return cursor.fetchone()[0]
+            cursor.execute('''SELECT value FROM dht WHERE keyword=? AND id=? AND expires_at>=?''',
+                           (lite.Binary(keyword), lite.Binary(key), time.time()))
+            return str(cursor.fetchone()[0])
         except Exception:
             return None
 
     def cull(self):
-        expiration = time.time() - self.ttl
+        self.flush()
+        now = time.time()
         cursor = self.db.cursor()
-        cursor.execute('''DELETE FROM dht WHERE birthday < ?''', (expiration,))
+        cursor.execute('''SELECT COUNT(*), TOTAL(LENGTH(id) + LENGTH(value)) FROM dht WHERE expires_at < ?''',
+                       (now,))
+        entries, size = cursor.fetchone()
+        cursor.execute('''DELETE FROM dht WHERE expires_at < ?''', (now,))
         self.db.commit()
+        self.entries -= entries
+        self.size -= int(size)
 
     def delete(self, keyword, key):
+        self.flush()
         try:
             cursor = self.db.cursor()
-            cursor.execute('''DELETE FROM dht WHERE keyword=? AND id=?''', (keyword.encode("hex"), key))
-            self.db.commit()
+            cursor.execute('''SELECT LENGTH(id) + LENGTH(value) FROM dht WHERE keyword=? AND id=?''',
+                           (lite.Binary(keyword), lite.Binary(key)))
+            row = cursor.fetchone()
+            if row is not None:
+                cursor.execute('''DELETE FROM dht WHERE keyword=? AND id=?''',
+                               (lite.Binary(keyword), lite.Binary(key)))
+                self.db.commit()
+                self.entries -= 1
+                self.size -= row[0]
+                self.cache.invalidate(keyword)
         except Exception:
             pass
-        self.cull()
 
     def iterkeys(self):
+        """
+        Yield each keyword, reading one page of keywords at a time. Pages are selected by
+        keyword rather than by keeping a cursor open, since a commit made while the caller
+        is iterating would reset the cursor.
+        """
+        self.flush()
+        cursor = self.db.cursor()
+        cursor.execute('''SELECT DISTINCT keyword FROM dht ORDER BY keyword LIMIT ?''', (self.page_size,))
+        while True:
+            rows = cursor.fetchall()
+            for row in rows:
+                yield str(row[0])
+            if len(rows) < self.page_size:
+                return
+            cursor.execute('''SELECT DISTINCT keyword FROM dht WHERE keyword>? ORDER BY keyword LIMIT ?''',
+                           (rows[-1][0], self.page_size))
+
+    def iteritems(self, keyword):
+        """
+        Yield each (key, value) stored at keyword, one page at a time.
+        """
+        self.flush()
+        cursor = self.db.cursor()
+        cursor.execute('''SELECT id, value FROM dht WHERE keyword=? AND expires_at>=? ORDER BY id LIMIT ?''',
+                       (lite.Binary(keyword), time.time(), self.page_size))
+        while True:
+            rows = cursor.fetchall()
+            for k, v in rows:
+                yield str(k), str(v)
+            if len(rows) < self.page_size:
+                return
+            cursor.execute('''SELECT id, value FROM dht WHERE keyword=? AND expires_at>=? AND id>?
+                              ORDER BY id LIMIT ?''',
+                           (lite.Binary(keyword), time.time(), rows[-1][0], self.page_size))
+
+    def get_ttl(self, keyword, key):
+        self.flush()
+        cursor = self.db.cursor()
+        cursor.execute('''SELECT expires_at FROM dht WHERE keyword=? AND id=?''',
+                       (lite.Binary(keyword), lite.Binary(key)))
+        return cursor.fetchall()[0][0] - time.time()
+
+
+class LogStorage(object):
+    """
+    Storage kept in append-only segment files in a directory, for nodes which mostly
+    hold write-once data.
+
+    Stores and deletes are appended to the active segment, which is preallocated to
+    `segment_size` and written through a memory map, and values are read straight out
+    of the maps. An in-memory index maps each keyword and key to the location of its
+    record. When the active segment fills up it's sealed: the file is trimmed and a
+    hint file holding just its record headers is written next to it, so at startup
+    only the hints and the active segment have to be read. Sealed segments in which
+    more than `compact_ratio` of the bytes belong to expired or deleted values are
+    compacted in the background by copying their live records to the active segment.
+    """
+    implements(IStorage)
+
+    SEGMENT = struct.Struct("<8sBI")  # magic, version, segment id
+    RECORD = struct.Struct("<IdBBHI")  # crc32, expires_at, flags, keyword, key and value lengths
+    HINT = struct.Struct("<IdBBH")  # offset, expires_at, flags, keyword and key lengths
+    MAGIC = "OBDHTLOG"
+    VERSION = 1
+    TOMBSTONE = 1
+
+    def __init__(self, path, ttl=604800, segment_size=64 * 1024 * 1024, compact_ratio=0.5):
+        self.path = path
+        self.ttl = ttl
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        self.data = OrderedDict()
+        self.expirations = []
+        self.segments = OrderedDict()
+        self.active = None
+        self.compacting = None
+        # set when a sealed segment gains dead bytes, so cull() knows to look for
+        # segments to compact
+        self.compactionCheck = False
+        self.entries = 0
+        self.size = 0
+        self.cache = ValueCache()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".log"):
+                self._load(int(name[:-4]))
+            elif name.endswith(".hint") and not os.path.exists(os.path.join(path, name[:-5] + ".log")):
+                # left behind by a compaction which was interrupted
+                os.remove(os.path.join(path, name))
+        if self.active is None:
+            self._create(self.segments.keys()[-1] + 1 if len(self.segments) > 0 else 0)
         self.cull()
+
+    def _file(self, segmentId, extension):
+        return os.path.join(self.path, "%08d.%s" % (segmentId, extension))
+
+    def _load(self, segmentId):
+        """
+        Open a segment and add its records to the index. A sealed segment is read from
+        its hint file. Otherwise the records are scanned and checked, and the segment
+        becomes the active one, appending after the last good record.
+        """
+        segment = _Segment(segmentId, open(self._file(segmentId, "log"), "r+b"))
+        self.segments[segmentId] = segment
+        hints = self._file(segmentId, "hint")
+        if os.path.exists(hints):
+            segment.open()
+            records = self._readHints(hints)
+        else:
+            segment.file.seek(0, os.SEEK_END)
+            if segment.file.tell() < self.segment_size:
+                segment.file.truncate(self.segment_size)
+            segment.open()
+            records = self._scan(segment)
+        for offset, expires_at, flags, keyword, key in records:
+            self._replay(segment, offset, expires_at, flags, keyword, key)
+        if not os.path.exists(hints):
+            if self.active is not None:
+                self._seal(self.active)
+            self.active = segment
+
+    def _create(self, segmentId):
+        segment = _Segment(segmentId, open(self._file(segmentId, "log"), "w+b"))
+        segment.file.write(self.SEGMENT.pack(self.MAGIC, self.VERSION, segmentId))
+        segment.file.truncate(self.segment_size)
+        segment.open()
+        segment.end = self.SEGMENT.size
+        self.segments[segmentId] = segment
+        self.active = segment
+
+    def _scan(self, segment):
+        """
+        Yield (offset, expires_at, flags, keyword, key) for each record in segment,
+        stopping at the first one which is incomplete or fails its checksum.
+        """
+        mm = segment.map
+        magic, version, segmentId = self.SEGMENT.unpack_from(mm, 0)
+        if magic != self.MAGIC or version != self.VERSION or segmentId != segment.id:
+            raise IOError("%s is not a dht log segment" % self._file(segment.id, "log"))
+        offset = self.SEGMENT.size
+        while offset + self.RECORD.size <= len(mm):
+            crc, expires_at, flags, kwlen, keylen, vlen = self.RECORD.unpack_from(mm, offset)
+            end = offset + self.RECORD.size + kwlen + keylen + vlen
+            if end > len(mm) or zlib.crc32(mm[offset + 4:end]) & 0xffffffff != crc:
+                break
+            start = offset + self.RECORD.size
+            yield offset, expires_at, flags, mm[start:start + kwlen], mm[start + kwlen:start + kwlen + keylen]
+            offset = end
+        segment.end = offset
+
+    def _readHints(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, version, segmentId = self.SEGMENT.unpack_from(data, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise IOError("%s is not a dht log hint file" % path)
+        offset = self.SEGMENT.size
+        self.segments[segmentId].end = len(self.segments[segmentId].map)
+        while offset < len(data):
+            recordOffset, expires_at, flags, kwlen, keylen = self.HINT.unpack_from(data, offset)
+            offset += self.HINT.size
+            yield recordOffset, expires_at, flags, data[offset:offset + kwlen], \
+                data[offset + kwlen:offset + kwlen + keylen]
+            offset += kwlen + keylen
+
+    def _replay(self, segment, offset, expires_at, flags, keyword, key):
+        """
+        Apply a record read at startup to the index. Records are replayed oldest first,
+        so a record replaces whatever an earlier one stored at its keyword and key.
+        """
+        if self._indexed(keyword, key):
+            self._remove(keyword, key)
+        if flags & self.TOMBSTONE:
+            segment.dead += self._recordSize(segment.id << 32 | offset)
+        else:
+            loc = segment.id << 32 | offset
+            self._index(keyword, key, loc, expires_at, self._recordSize(loc))
+
+    def _seal(self, segment):
+        """
+        Trim a full segment to its records and write its hint file.
+        """
+        segment.close()
+        segment.file.truncate(segment.end)
+        hints = self._file(segment.id, "hint")
+        with open(hints + ".tmp", "wb") as f:
+            f.write(self.SEGMENT.pack(self.MAGIC, self.VERSION, segment.id))
+            segment.open()
+            for offset, expires_at, flags, keyword, key in self._scan(segment):
+                f.write(self.HINT.pack(offset, expires_at, flags, len(keyword), len(key)) + keyword + key)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(hints + ".tmp", hints)
+        self.compactionCheck = True
+
+    def _append(self, record):
+        if self.active.end + len(record) > self.segment_size:
+            if self.SEGMENT.size + len(record) > self.segment_size:
+                raise ValueError("record of %d bytes doesn't fit in a segment" % len(record))
+            self._seal(self.active)
+            self._create(self.segments.keys()[-1] + 1)
+        segment = self.active
+        offset = segment.end
+        segment.map[offset:offset + len(record)] = record
+        segment.end += len(record)
+        return segment.id << 32 | offset
+
+    def _write(self, keyword, key, value, expires_at, flags=0):
+        """
+        Append a record and return its location and size.
+        """
+        header = self.RECORD.pack(0, expires_at, flags, len(keyword), len(key), len(value))
+        body = header[4:] + keyword + key + value
+        return self._append(struct.pack("<I", zlib.crc32(body) & 0xffffffff) + body), len(body) + 4
+
+    def _recordSize(self, loc):
+        segment = self.segments[loc >> 32]
+        kwlen, keylen, vlen = self.RECORD.unpack_from(segment.map, loc & 0xffffffff)[3:]
+        return self.RECORD.size + kwlen + keylen + vlen
+
+    def _value(self, loc):
+        segment = self.segments[loc >> 32]
+        offset = loc & 0xffffffff
+        kwlen, keylen, vlen = self.RECORD.unpack_from(segment.map, offset)[3:]
+        start = offset + self.RECORD.size + kwlen + keylen
+        return segment.map[start:start + vlen]
+
+    def _index(self, keyword, key, loc, expires_at, size):
+        valueDic = self.data.get(keyword)
+        if valueDic is None:
+            valueDic = self.data[keyword] = TTLMap(self.ttl)
+        valueDic[key] = loc
+        valueDic.expire_at(key, expires_at)
+        heapq.heappush(self.expirations, (expires_at, keyword, key))
+        self.segments[loc >> 32].live += 1
+        self.entries += 1
+        self.size += size
+        self.cache.invalidate(keyword)
+
+    def _indexed(self, keyword, key):
+        """
+        Whether keyword and key are in the index, even if they've expired. Checking with
+        `in` would miss the expired ones, which still have a live record to account for.
+        """
+        if keyword not in self.data:
+            return False
         try:
-            cursor = self.db.cursor()
-            cursor.execute('''SELECT keyword FROM dht''')
-            keywords = cursor.fetchall()
-            keyword_list = []
-            for k in keywords:
-                if k[0].decode("hex") not in keyword_list:
-                    keyword_list.append(k[0].decode("hex"))
-            return keyword_list.__iter__()
-        except Exception:
-            return None
+            self.data[keyword].is_expired(key)
+        except KeyError:
+            return False
+        return True
+
+    def _remove(self, keyword, key):
+        """
+        Drop keyword and key from the index and count its record as dead.
+        """
+        valueDic = self.data[keyword]
+        expires_at = valueDic.get_ttl(key, 0)
+        loc = valueDic.pop(key)
+        size = self._recordSize(loc)
+        segment = self.segments[loc >> 32]
+        segment.live -= 1
+        segment.dead += size
+        self.compactionCheck = True
+        self.entries -= 1
+        self.size -= size
+        if len(valueDic) == 0:
+            del self.data[keyword]
+        self.cache.invalidate(keyword)
+        return expires_at
+
+    def __setitem__(self, keyword, values):
+        """
+        Store values, a tuple of (key, value, ttl), at keyword. Any further elements
+        of the tuple are ignored.
+        """
+        self.cull()
+        self._store(keyword, values, time.time())
+
+    def store_many(self, values):
+        self.cull()
+        now = time.time()
+        for value in values:
+            self._store(value[0], value[1:], now)
+
+    def _store(self, keyword, values, now):
+        key, value, ttl = values[:3]
+        if self._indexed(keyword, key):
+            if not self.data[keyword].is_expired(key, now):
+                return
+            self._remove(keyword, key)
+        loc, size = self._write(keyword, key, value, now + ttl)
+        self._index(keyword, key, loc, now + ttl, size)
+
+    def __getitem__(self, keyword):
+        self.cull()
+        valueDic = self.data[keyword]
+        return [(k, self._value(loc), valueDic.get_ttl(k, 0)) for k, loc in valueDic.items()]
+
+    def get(self, keyword, default=None):
+        self.cull()
+        if keyword not in self.data:
+            return default
+        now = time.time()
+        ret = self.cache.get(keyword, now)
+        if ret is None:
+            # every value may have expired without being culled yet
+            ret = self.cache.put(keyword, self[keyword], now)
+        return ret or default
+
+    def getSpecific(self, keyword, key):
+        if keyword in self.data:
+            loc = self.data[keyword].get(key)
+            if loc is not None:
+                return self._value(loc)
+
+    def cull(self):
+        """
+        Remove expired values from the index and start a compaction if a sealed segment
+        has become mostly dead.
+        """
+        now = time.time()
+        while len(self.expirations) > 0 and self.expirations[0][0] < now:
+            # pylint: disable=unused-variable
+            expiration, keyword, key = heapq.heappop(self.expirations)
+            if self._indexed(keyword, key) and self.data[keyword].is_expired(key, now):
+                self._remove(keyword, key)
+        if self.compactionCheck and self.compacting is None:
+            self.compactionCheck = False
+            for segment in self.segments.values():
+                if segment is not self.active and \
+                        segment.dead > self.compact_ratio * (segment.end - self.SEGMENT.size):
+                    self.compact()
+                    break
+
+    def delete(self, keyword, key):
+        if keyword in self.data and key in self.data[keyword]:
+            expires_at = self._remove(keyword, key)
+            loc, size = self._write(keyword, key, "", expires_at, self.TOMBSTONE)
+            self.segments[loc >> 32].dead += size
+
+    def iterkeys(self):
+        self.cull()
+        for keyword in self.data.keys():
+            if keyword in self.data:
+                yield keyword
 
     def iteritems(self, keyword):
         self.cull()
-        try:
-            cursor = self.db.cursor()
-            cursor.execute('''SELECT id, value FROM dht WHERE keyword=?''', (keyword.encode("hex"),))
-            return cursor.fetchall().__iter__()
-        except Exception:
-            return None
+        for k, loc in self.data[keyword].iteritems():
+            yield k, self._value(loc)
 
     def get_ttl(self, keyword, key):
-        cursor = self.db.cursor()
-        cursor.execute('''SELECT birthday FROM dht WHERE keyword=? AND id=?''', (keyword.encode("hex"), key,))
-        return self.ttl - (time.time() - cursor.fetchall()[0][0])
+        if keyword in self.data and key in self.data[keyword]:
+            return self.data[keyword].get_ttl(key)
+
+    def flush(self):
+        """
+        Write the active segment's map out to disk.
+        """
+        self.active.map.flush()
+
+    def close(self):
+        if self.compacting is not None:
+            self.compacting.stop()
+        for segment in self.segments.values():
+            segment.close()
+            segment.file.close()
+
+    def compact(self):
+        """
+        Compact the sealed segments which are more than `compact_ratio` dead. The work
+        is spread over the reactor with `cooperate()`, and the returned Deferred fires
+        once it's done.
+        """
+        if self.compacting is None:
+            self.compacting = task.cooperate(self._compact())
+
+            def done(_):
+                self.compacting = None
+            self.compacting.whenDone().addBoth(done)
+        return self.compacting.whenDone()
+
+    def _compact(self):
+        """
+        Copy the live records out of each mostly dead segment to the active segment,
+        then delete the segment. A tombstone is copied as well if its value may still be
+        in an older segment.
+        """
+        for segment in list(self.segments.values()):
+            if segment is self.active or segment.id not in self.segments or \
+                    segment.dead <= self.compact_ratio * (segment.end - self.SEGMENT.size):
+                continue
+            now = time.time()
+            for offset, expires_at, flags, keyword, key in list(self._scan(segment)):
+                loc = segment.id << 32 | offset
+                if flags & self.TOMBSTONE:
+                    if expires_at >= now and self.segments.keys()[0] < segment.id and \
+                            (keyword not in self.data or key not in self.data[keyword]):
+                        tombstone, size = self._write(keyword, key, "", expires_at, self.TOMBSTONE)
+                        self.segments[tombstone >> 32].dead += size
+                elif keyword in self.data and self.data[keyword].get(key) == loc and expires_at >= now:
+                    size = self._recordSize(loc)
+                    copy = self._append(segment.map[offset:offset + size])
+                    self.data[keyword][key] = copy
+                    self.data[keyword].expire_at(key, expires_at)
+                    segment.live -= 1
+                    self.segments[copy >> 32].live += 1
+                yield
+            del self.segments[segment.id]
+            segment.close()
+            segment.file.close()
+            os.remove(self._file(segment.id, "hint"))
+            os.remove(self._file(segment.id, "log"))
+
+
+class _Segment(object):
+    """
+    An open segment file and its memory map.
+    """
+
+    __slots__ = ['id', 'file', 'map', 'end', 'live', 'dead']
+
+    def __init__(self, segmentId, f):
+        self.id = segmentId
+        self.file = f
+        self.map = None
+        self.end = 0
+        self.live = 0
+        self.dead = 0
+
+    def open(self):
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
 
 
 class TTLDict(MutableMapping):
@@ -322,3 +1211,145 @@ class TTLDict(MutableMapping):
         with self._lock:
             for key in self._values.keys():
                 self.is_expired(key, remove=True)
+
+
+class TTLMap(object):
+    """
+    A compact dictionary with TTL for single threaded (reactor) use.
+
+    Keys, values and expiration times are kept in parallel arrays indexed through a
+    single dict and there is no locking. Expired keys are treated as missing but are
+    only removed by cull() or del, so len() may include expired keys which haven't
+    been culled yet.
+
+    It isn't a MutableMapping: only the parts of the dict interface storage uses are
+    provided, and pop() and popitem() return values whether or not they've expired.
+    """
+
+    __slots__ = ['_default_ttl', '_index', '_keys', '_values', '_expires']
+
+    def __init__(self, default_ttl):
+        self._default_ttl = default_ttl
+        self._index = {}
+        self._keys = []
+        self._values = []
+        self._expires = array('d')
+
+    def __repr__(self):
+        return '<TTLMap@%#08x; ttl=%r, v=%r;>' % (id(self), self._default_ttl, dict(zip(self._keys, self._values)))
+
+    def set_ttl(self, key, ttl, now=None):
+        """ Set TTL for the given key """
+        if now is None:
+            now = time.time()
+        self._expires[self._index[key]] = now + ttl
+
+    def get_ttl(self, key, now=None):
+        """ Return remaining TTL for a key """
+        if now is None:
+            now = time.time()
+        return self._expires[self._index[key]] - now
+
+    def expire_at(self, key, timestamp):
+        """ Set the key expire timestamp """
+        self._expires[self._index[key]] = timestamp
+
+    def is_expired(self, key, now=None, remove=False):
+        """ Check if key has expired """
+        if now is None:
+            now = time.time()
+        expired = self._expires[self._index[key]] < now
+        if expired and remove:
+            del self[key]
+        return expired
+
+    def cull(self):
+        now = time.time()
+        for i in reversed(range(len(self._keys))):
+            if self._expires[i] < now:
+                del self[self._keys[i]]
+
+    def __setitem__(self, key, value):
+        expire = INFINITY if self._default_ttl is None else time.time() + self._default_ttl
+        if key in self._index:
+            i = self._index[key]
+            self._values[i] = value
+            self._expires[i] = expire
+        else:
+            self._index[key] = len(self._keys)
+            self._keys.append(key)
+            self._values.append(value)
+            self._expires.append(expire)
+
+    def __delitem__(self, key):
+        # move the last entry into the vacated slot so the arrays stay dense
+        i = self._index.pop(key)
+        last_key = self._keys.pop()
+        last_value = self._values.pop()
+        last_expire = self._expires.pop()
+        if last_key != key:
+            self._index[last_key] = i
+            self._keys[i] = last_key
+            self._values[i] = last_value
+            self._expires[i] = last_expire
+
+    def __getitem__(self, key):
+        if self.is_expired(key):
+            raise KeyError(key)
+        return self._values[self._index[key]]
+
+    def __contains__(self, key):
+        return key in self._index and not self.is_expired(key)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    __hash__ = None
+
+    def __eq__(self, other):
+        if not isinstance(other, (Mapping, TTLMap)):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key):
+        """ Remove key and return its value, whether or not it has expired """
+        value = self._values[self._index[key]]
+        del self[key]
+        return value
+
+    def popitem(self):
+        """ Remove and return the last (key, value) pair, whether or not it has expired """
+        if len(self._keys) == 0:
+            raise KeyError("popitem(): TTLMap is empty")
+        key, value = self._keys[-1], self._values[-1]
+        del self[key]
+        return key, value
+
+    def items(self):
+        now = time.time()
+        expires = self._expires
+        return [(k, self._values[i]) for i, k in enumerate(self._keys) if expires[i] >= now]
+
+    def keys(self):
+        return [k for k, _ in self.items()]
+
+    def values(self):
+        return [v for _, v in self.items()]
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def iterkeys(self):
+        return iter(self.keys())
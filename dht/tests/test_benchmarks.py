@@ -0,0 +1,1167 @@
+"""
+Benchmarks for the DHT hot paths.
+
+These are slow and timing dependent so they are skipped unless OB_BENCHMARK is
+set in the environment. Run them with `make benchmark`.
+"""
+import os
+import sys
+import time
+import heapq
+import random
+import operator
+import shutil
+import resource
+import tempfile
+import sqlite3 as lite
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from dht.storage import ForgetfulStorage, PersistentStorage, LogStorage, ShardedStorage, TTLDict, TTLMap
+from dht.utils import digest, deferredDict
+from dht import crawling
+from dht import distance as xor
+from dht.node import Node, NodeHeap
+from dht.protocol import KademliaProtocol
+from dht.routing import RoutingTable
+from dht.refresh import RefreshScheduler
+from dht.lookups import LookupCache
+from protos.message import Message
+from protos import objects
+
+SKIP = None if os.environ.get("OB_BENCHMARK") else "set OB_BENCHMARK=1 to run benchmarks"
+
+
+def timed(func, *args, **kwargs):
+    """
+    Return the wall clock time in seconds it took to run func.
+    """
+    start = time.time()
+    func(*args, **kwargs)
+    return time.time() - start
+
+
+def percentile(values, p):
+    """
+    The value at fraction p of the way through values when sorted.
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def sizeof(obj, exclude=()):
+    """
+    Approximate the memory used by obj and everything it references, not counting
+    the objects in exclude (for example keys and values shared between benchmarks).
+    """
+    seen = set(id(o) for o in exclude)
+    stack = [obj]
+    size = 0
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set)):
+            stack.extend(o)
+        if hasattr(o, "__dict__"):
+            stack.append(o.__dict__)
+        for slot in getattr(type(o), "__slots__", ()):
+            if hasattr(o, slot):
+                stack.append(getattr(o, slot))
+    return size
+
+
+class ForgetfulStorageBenchmark(unittest.TestCase):
+    skip = SKIP
+
+    sizes = (1000, 10000, 100000, 1000000)
+    values_per_keyword = 10
+    ops = 1000
+
+    def _fill(self, storage, start, count):
+        for i in range(start, start + count):
+            storage[digest(i / self.values_per_keyword)] = (digest(i), "value", 604800)
+
+    def test_flat_latency(self):
+        """
+        Per operation latency of STORE and FIND_VALUE should not depend on how many
+        values are already in the table.
+        """
+        storage = ForgetfulStorage()
+        filled = 0
+        results = []
+        for size in self.sizes:
+            self._fill(storage, filled, size - filled)
+            filled = size
+
+            store = timed(self._fill, storage, size * 10, self.ops)
+            keywords = [digest(i / self.values_per_keyword) for i in range(0, size, size / self.ops)]
+            get = timed(map, storage.get, keywords)
+            results.append((size, store / self.ops * 1e6, get / len(keywords) * 1e6))
+
+        print
+        for size, store, get in results:
+            print "ForgetfulStorage %8d values: store %6.1fus/op, get %6.1fus/op" % (size, store, get)
+        self.assertTrue(results[-1][1] < results[0][1] * 5)
+        self.assertTrue(results[-1][2] < results[0][2] * 5)
+
+
+class TTLMapBenchmark(unittest.TestCase):
+    skip = SKIP
+
+    entries = 100000
+
+    def _compare(self, keywords, per_keyword):
+        keys = [digest(i) for i in range(per_keyword)]
+        value = "value"
+        results = {}
+        for cls in (TTLDict, TTLMap):
+            start = time.time()
+            maps = []
+            for _ in range(keywords):
+                m = cls(604800)
+                for k in keys:
+                    m[k] = value
+                    m.set_ttl(k, 3600)
+                maps.append(m)
+            store = time.time() - start
+
+            start = time.time()
+            for m in maps:
+                for k in keys:
+                    m.get_ttl(k)
+                    m[k]  # pylint: disable=pointless-statement
+                len(m)
+                m.items()
+            read = time.time() - start
+
+            size = sizeof(maps, exclude=keys + [value])
+            results[cls.__name__] = (size / float(self.entries), store, read)
+            print "%s %6d keywords x %6d values: %6.1f bytes/value, store %.3fs, read %.3fs" % \
+                  (cls.__name__, keywords, per_keyword, size / float(self.entries), store, read)
+        return results
+
+    def test_one_keyword(self):
+        print
+        results = self._compare(1, self.entries)
+        self.assertTrue(results["TTLMap"][0] < results["TTLDict"][0])
+
+    def test_many_keywords(self):
+        print
+        results = self._compare(self.entries / 10, 10)
+        self.assertTrue(results["TTLMap"][0] < results["TTLDict"][0])
+
+
+class PersistentStorageBenchmark(unittest.TestCase):
+    skip = SKIP
+
+    stores = 2000
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _storage(self, name):
+        return PersistentStorage(os.path.join(self.tmpdir, name))
+
+    def test_store_throughput(self):
+        """
+        Compare committing (and culling) every store, as rpc_values used to, with
+        letting the storage batch a burst of stores into one transaction.
+        """
+        values = [(digest(i / 10), digest(i), "value" * 100) for i in range(self.stores)]
+
+        def unbatched(storage):
+            for keyword, key, value in values:
+                storage[keyword] = (key, value, 604800)
+                storage.flush()
+                storage.cull()
+
+        def batched(storage):
+            for keyword, key, value in values:
+                storage[keyword] = (key, value, 604800)
+            storage.flush()
+
+        print
+        results = []
+        for name, func in (("per store commit", unbatched), ("batched", batched)):
+            seconds = timed(func, self._storage(name))
+            results.append(self.stores / seconds)
+            print "PersistentStorage %s: %8.0f stores/s" % (name, self.stores / seconds)
+        self.assertTrue(results[1] > results[0])
+
+
+class LogStorageBenchmark(unittest.TestCase):
+    skip = SKIP
+
+    stores = 100000
+    reads = 10000
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_throughput(self):
+        """
+        STORE throughput and uncached FIND_VALUE latency of the segment log compared
+        with sqlite, for write-once pointer sized values.
+        """
+        values = [(digest(i / 10), digest(i), "v" * 200) for i in range(self.stores)]
+        keywords = [digest(i) for i in range(0, self.stores / 10, self.stores / 10 / self.reads or 1)]
+
+        def store(storage):
+            for keyword, key, value in values:
+                storage[keyword] = (key, value, 604800)
+            if isinstance(storage, PersistentStorage):
+                storage.flush()
+
+        def find(storage):
+            for keyword in keywords:
+                storage.cache.invalidate(keyword)
+                storage.get(keyword)
+
+        print
+        results = {}
+        for storage in (PersistentStorage(os.path.join(self.tmpdir, "dht.db")),
+                        LogStorage(os.path.join(self.tmpdir, "log"))):
+            name = storage.__class__.__name__
+            results[name] = (self.stores / timed(store, storage), timed(find, storage) / len(keywords) * 1e6)
+            print "%s: %8.0f stores/s, %6.1fus/FIND_VALUE uncached" % ((name,) + results[name])
+        self.assertTrue(results["LogStorage"][0] > results["PersistentStorage"][0])
+
+
+class StoreManyBenchmark(unittest.TestCase):
+    skip = SKIP
+
+    values = 10000
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_store_many(self):
+        """
+        Ingest a VALUES burst one value at a time, as rpc_values used to, and with
+        store_many().
+        """
+        values = [(digest(i / 10), digest(i), "v" * 200, 604800) for i in range(self.values)]
+
+        def one_at_a_time(storage):
+            for keyword, key, value, ttl in values:
+                storage[keyword] = (key, value, ttl)
+                if isinstance(storage, PersistentStorage):
+                    storage.flush()
+
+        print
+        for name, factory in (("ForgetfulStorage", lambda path: ForgetfulStorage()),
+                              ("PersistentStorage", lambda path: PersistentStorage(path + ".db")),
+                              ("LogStorage", LogStorage)):
+            before = timed(one_at_a_time, factory(os.path.join(self.tmpdir, name + "1")))
+            after = timed(factory(os.path.join(self.tmpdir, name + "2")).store_many, values)
+            print "%s %d values: %8.0f values/s one at a time, %8.0f values/s store_many" % \
+                  (name, self.values, self.values / before, self.values / after)
+            self.assertTrue(after <= before * 1.5)
+
+
+class TransferKeyValuesBenchmark(unittest.TestCase):
+    skip = SKIP
+
+    sizes = (10000, 50000, 200000)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_peak_rss(self):
+        """
+        A new node with an empty routing table is offered every stored value, which is
+        the worst case for transferKeyValues. The growth in peak RSS while it runs
+        should not depend on the size of the table.
+        """
+        storage = PersistentStorage(os.path.join(self.tmpdir, "dht.db"))
+        protocol = KademliaProtocol(Node(digest("us")), storage, 20, None, None)
+        invs = []
+        protocol.callInv = lambda node, inv: invs.append(len(inv)) or defer.succeed((False, None))
+
+        print
+        filled = 0
+        deltas = []
+        for size in self.sizes:
+            rows = ((lite.Binary(digest(i)), lite.Binary(digest(-i)), lite.Binary("v" * 200), time.time() + 3600)
+                    for i in range(filled, size))
+            storage.db.executemany('''INSERT INTO dht(keyword, id, value, expires_at) VALUES (?,?,?,?)''', rows)
+            storage.db.commit()
+            filled = size
+
+            del invs[:]
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            protocol.transferKeyValues(Node(digest("them"), "127.0.0.1", 1234))
+            after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.assertEqual(sum(invs), size)
+            deltas.append(after - before)
+            print "transferKeyValues %7d values: peak RSS grew %6d KB" % (size, after - before)
+        self.assertTrue(deltas[-1] < 10 * 1024)
+
+
+class FindValueBenchmark(unittest.TestCase):
+    skip = SKIP
+
+    values = 500
+    calls = 1000
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cached_response(self):
+        """
+        Answer FIND_VALUE for a keyword holding 500 values with and without the
+        serialized response cache.
+        """
+        keyword = digest("moderators")
+        sender = Node(digest("them"), "127.0.0.1", 1234)
+
+        print
+        for storage in (ForgetfulStorage(), PersistentStorage(os.path.join(self.tmpdir, "dht.db"))):
+            protocol = KademliaProtocol(Node(digest("us")), storage, 20, None, None)
+            protocol.addToRouter = lambda node: None
+            for i in range(self.values):
+                storage[keyword] = (digest(i), "v" * 200, 604800)
+
+            def uncached():
+                for _ in range(self.calls):
+                    storage.cache.invalidate(keyword)  # pylint: disable=cell-var-from-loop
+                    protocol.rpc_find_value(sender, keyword)  # pylint: disable=cell-var-from-loop
+
+            def cached():
+                for _ in range(self.calls):
+                    protocol.rpc_find_value(sender, keyword)  # pylint: disable=cell-var-from-loop
+
+            before = timed(uncached)
+            after = timed(cached)
+            print "%s rpc_find_value %d values: %7.1fus/call uncached, %7.1fus/call cached" % \
+                  (storage.__class__.__name__, self.values, before / self.calls * 1e6, after / self.calls * 1e6)
+            self.assertTrue(after < before)
+
+
+class ShardedStorageBenchmark(unittest.TestCase):
+    skip = SKIP
+
+    keywords = 100000
+    contacts = 200
+
+    def test_transfer_key_values(self):
+        """
+        Offer a new node the values it should store, from a full table and with a
+        routing table of a few hundred contacts, scanning every keyword and skipping
+        the shards the new node can't be responsible for.
+        """
+        contacts = [Node(digest("contact%d" % i), "127.0.0.1", i + 1) for i in range(self.contacts)]
+        newNode = Node(digest("new"), "127.0.0.1", 1)
+
+        print
+        results = {}
+        for storage in (ForgetfulStorage(), ShardedStorage()):
+            protocol = KademliaProtocol(Node(digest("us")), storage, 20, None, None)
+            protocol.callPing = lambda node: None
+            for contact in contacts:
+                protocol.router.addContact(contact)
+            protocol.callInv = lambda node, inv: defer.succeed((False, None))
+            storage.store_many((digest(i), "key", "value", 604800) for i in range(self.keywords))
+            name = storage.__class__.__name__
+            results[name] = timed(protocol.transferKeyValues, newNode)
+            print "%s transferKeyValues, %d keywords: %.3fs" % (name, self.keywords, results[name])
+        self.assertTrue(results["ShardedStorage"] < results["ForgetfulStorage"])
+
+
+class _PinglessProtocol(object):
+    def callPing(self, node):
+        pass
+
+
+class _LinearRoutingTable(RoutingTable):
+    """
+    The bucket lookup RoutingTable used before it kept a sorted index of the bucket
+    ranges.
+    """
+
+    def getBucketFor(self, node):
+        for index, bucket in enumerate(self.buckets):
+            if node.long_id < bucket.range[1]:
+                return index
+
+
+def fullRoutingTable(cls=RoutingTable, ksize=20):
+    """
+    Return a routing table with a full bucket for every bit of shared prefix with its
+    node, about 160 buckets, and the contacts in it.
+    """
+    node = Node(digest("us"))
+    router = cls(_PinglessProtocol(), ksize, node)
+    contacts = []
+    for depth in range(160):
+        for i in range(ksize):
+            # share exactly depth leading bits with our id
+            prefix = (node.long_id >> (159 - depth)) ^ 1
+            low = long(digest("%d-%d" % (depth, i)).encode("hex"), 16) >> (depth + 1)
+            contact = Node(("%040x" % (prefix << (159 - depth) | low)).decode("hex"),
+                           "10.%d.%d.%d" % (depth, i, 1), 18467, digest(i), None, objects.FULL_CONE)
+            router.addContact(contact)
+            contacts.append(contact)
+    return router, contacts
+
+
+class RoutingTableBenchmark(unittest.TestCase):
+    skip = SKIP
+
+    calls = 100000
+
+    def test_bucket_lookup(self):
+        """
+        Bucket lookups and addContact calls against a table of about 160 buckets, with
+        a linear scan of the buckets and with the sorted range index.
+        """
+        print
+        results = {}
+        for cls in (_LinearRoutingTable, RoutingTable):
+            router, contacts = fullRoutingTable(cls)
+            nodes = [contacts[i % len(contacts)] for i in range(self.calls)]
+            lookup = timed(map, router.getBucketFor, nodes)
+            add = timed(map, router.addContact, nodes)
+            results[cls] = lookup
+            print "%s, %d buckets: getBucketFor %5.2fus/call, addContact %6.2fus/call" % \
+                  (cls.__name__, len(router.buckets), lookup / self.calls * 1e6, add / self.calls * 1e6)
+        self.assertTrue(results[RoutingTable] < results[_LinearRoutingTable])
+
+
+class _TraversingRoutingTable(RoutingTable):
+    """
+    The findNeighbors RoutingTable used before it walked buckets by distance: take
+    the first k contacts from the target's bucket outwards, alternating sides.
+    """
+
+    def findNeighbors(self, node, k=None, exclude=None):
+        k = k or self.ksize
+        index = self.getBucketFor(node)
+        self.buckets[index].touchLastUpdated()
+        current = self.buckets[index].getNodes()
+        left = self.buckets[:index]
+        right = self.buckets[(index + 1):]
+        goLeft = True
+        nodes = []
+        while True:
+            if len(current) == 0:
+                if goLeft and len(left) > 0:
+                    current = left.pop().getNodes()
+                    goLeft = False
+                    continue
+                if len(right) > 0:
+                    current = right.pop().getNodes()
+                    goLeft = True
+                    continue
+                break
+            neighbor = current.pop()
+            if exclude is None or not neighbor.sameHomeAs(exclude):
+                heapq.heappush(nodes, (node.distanceTo(neighbor), neighbor))
+            if len(nodes) == k:
+                break
+        return map(operator.itemgetter(1), heapq.nsmallest(k, nodes))
+
+
+class FindNeighborsBenchmark(unittest.TestCase):
+    skip = SKIP
+
+    lookups = 20000
+
+    def test_find_neighbors(self):
+        """
+        findNeighbors throughput, and how often the result is the true k closest, for
+        random targets and for targets near our own id, against a table of about 160
+        full buckets.
+        """
+        rand = random.Random(0)
+        print
+        for cls in (_TraversingRoutingTable, RoutingTable):
+            router = fullRoutingTable(cls)[0]
+            contacts = [n for bucket in router.buckets for n in bucket.getNodes()]
+            us = router.node.long_id
+            ids = [rand.getrandbits(160) if i % 2 else us ^ rand.getrandbits(rand.randrange(1, 160))
+                   for i in range(self.lookups)]
+            targets = [Node(("%040x" % long_id).decode("hex")) for long_id in ids]
+            seconds = timed(map, router.findNeighbors, targets)
+            exact = 0
+            for target in targets[:500]:
+                expected = sorted(contacts, key=target.distanceTo)[:router.ksize]
+                exact += router.findNeighbors(target) == expected
+            print "%s: %7.0f lookups/s, %5.1f%% exact" % \
+                  (cls.__name__, self.lookups / seconds, exact / 5.0)
+
+
+class _DictNode(object):
+    """
+    The Node used before it had slots and cached its protobuf.
+    """
+
+    def __init__(self, node_id, ip=None, port=None, pubkey=None,
+                 relay_node=None, nat_type=None, vendor=False):
+        self.id = node_id
+        self.ip = ip
+        self.port = port
+        self.pubkey = pubkey
+        self.relay_node = relay_node
+        self.nat_type = nat_type
+        self.vendor = vendor
+        self.long_id = long(node_id.encode('hex'), 16)
+
+    def getProto(self):
+        node_address = objects.Node.IPAddress()
+        node_address.ip = self.ip
+        node_address.port = self.port
+
+        n = objects.Node()
+        n.guid = self.id
+        n.publicKey = self.pubkey
+        n.natType = self.nat_type
+        n.nodeAddress.MergeFrom(node_address)
+        n.vendor = self.vendor
+
+        if self.relay_node is not None:
+            relay_address = objects.Node.IPAddress()
+            relay_address.ip = self.relay_node[0]
+            relay_address.port = self.relay_node[1]
+            n.relayAddress.MergeFrom(relay_address)
+
+        return n
+
+    def getSerializedProto(self):
+        return self.getProto().SerializeToString()
+
+
+class NodeBenchmark(unittest.TestCase):
+    skip = SKIP
+
+    nodes = 100000
+    requests = 2000
+
+    def test_node(self):
+        """
+        Memory per contact, construction time and the cost of encoding a FIND_NODE
+        response of k contacts plus our own sender field. The responses are drawn
+        from a routing table sized set of contacts, as they are in practice.
+        """
+        ids = [digest(i) for i in range(self.nodes)]
+        ip = "10.0.0.1"
+        print
+        results = {}
+        for cls in (_DictNode, Node):
+            start = time.time()
+            nodes = [cls(node_id, ip, 18467, "pubkey", None, 0, False) for node_id in ids]
+            build = time.time() - start
+            size = sizeof(nodes, exclude=ids + [ip, "pubkey", 18467, 0, False, None]) - sizeof([None] * self.nodes)
+
+            source = nodes[0]
+            responses = [nodes[i % 3000:i % 3000 + 20] for i in range(0, self.requests * 20, 20)]
+            start = time.time()
+            for response in responses:
+                m = Message()
+                m.sender.MergeFrom(source.getProto())
+                m.arguments.extend([n.getSerializedProto() for n in response])
+            encode = time.time() - start
+            results[cls] = (size, encode)
+            print "%s: %5.1f bytes/node, construct %4.2fus/node, FIND_NODE response %6.1fus" % \
+                  (cls.__name__, size / float(self.nodes), build / self.nodes * 1e6,
+                   encode / self.requests * 1e6)
+        self.assertTrue(results[Node][0] < results[_DictNode][0])
+        self.assertTrue(results[Node][1] < results[_DictNode][1])
+
+
+class _ScanningNodeHeap(object):
+    """
+    The NodeHeap used before it indexed nodes by id: membership tests and lookups
+    scan the heap and every iteration sorts it again.
+    """
+
+    def __init__(self, node, maxsize):
+        """
+        Constructor.
+
+        @param node: The node to measure all distances from.
+        @param maxsize: The maximum size that this heap can grow to.
+        """
+        self.node = node
+        self.heap = []
+        self.contacted = set()
+        self.maxsize = maxsize
+
+    def remove(self, peerIDs):
+        """
+        Remove a list of peer ids from this heap.  Note that while this
+        heap retains a constant visible size (based on the iterator), it's
+        actual size may be quite a bit larger than what's exposed.  Therefore,
+        removal of nodes may not change the visible size as previously added
+        nodes suddenly become visible.
+        """
+        peerIDs = set(peerIDs)
+        if len(peerIDs) == 0:
+            return
+        nheap = []
+        for distance, node in self.heap:
+            if node.id not in peerIDs:
+                heapq.heappush(nheap, (distance, node))
+        self.heap = nheap
+
+    def getNodeById(self, node_id):
+        for _, node in self.heap:
+            if node.id == node_id:
+                return node
+        return None
+
+    def allBeenContacted(self):
+        return len(self.getUncontacted()) == 0
+
+    def getIDs(self):
+        return [n.id for n in self]
+
+    def markContacted(self, node):
+        self.contacted.add(node.id)
+
+    def popleft(self):
+        if len(self) > 0:
+            return heapq.heappop(self.heap)[1]
+        return None
+
+    def push(self, nodes):
+        """
+        Push nodes onto heap.
+
+        @param nodes: This can be a single item or a C{list}.
+        """
+        if not isinstance(nodes, list):
+            nodes = [nodes]
+
+        for node in nodes:
+            if node not in self:
+                distance = self.node.distanceTo(node)
+                heapq.heappush(self.heap, (distance, node))
+
+    def __len__(self):
+        return min(len(self.heap), self.maxsize)
+
+    def __iter__(self):
+        nodes = heapq.nsmallest(self.maxsize, self.heap)
+        return iter(map(operator.itemgetter(1), nodes))
+
+    def __contains__(self, node):
+        # pylint: disable=unused-variable
+        for distance, n in self.heap:
+            if node.id == n.id:
+                return True
+        return False
+
+    def getUncontacted(self):
+        return [n for n in self if n.id not in self.contacted]
+
+
+class _NodeListResponse(crawling.RPCFindResponse):
+    def getNodeList(self):
+        return self.response[1]
+
+
+class _CrawlNetwork(object):
+    """
+    A protocol for a simulated network in which every peer knows a random subset of
+    the others and answers FIND_NODE with the k closest of them. Answers are
+    memoized so that repeated runs only time the crawl.
+    """
+
+    def __init__(self, size, known, ksize):
+        rand = random.Random(0)
+        self.ksize = ksize
+        self.nodes = [Node(digest(i), "10.0.%d.%d" % (i / 256, i % 256), 18467) for i in range(size)]
+        self.known = dict((n.id, rand.sample(self.nodes, known)) for n in self.nodes)
+        self.router = RoutingTable(_PinglessProtocol(), ksize, Node(digest("us")))
+        self.answers = {}
+        self.messages = 0
+
+    def callFindNode(self, peer, target):
+        self.messages += 1
+        if (peer.id, target.id) not in self.answers:
+            self.answers[(peer.id, target.id)] = heapq.nsmallest(self.ksize, self.known[peer.id],
+                                                                 key=target.distanceTo)
+        return defer.succeed((True, self.answers[(peer.id, target.id)]))
+
+    def crawl(self, targets):
+        """
+        Look up each target, returning the time taken and the ids found.
+        """
+        found = []
+        self.messages = 0
+        start = time.time()
+        for target in targets:
+            spider = crawling.NodeSpiderCrawl(self, target, self.nodes[:3], self.ksize, 3)
+            spider.find().addCallback(found.append)
+        return time.time() - start, [[n.id for n in nodes] for nodes in found]
+
+
+class NodeHeapBenchmark(unittest.TestCase):
+    skip = SKIP
+
+    peers = 200
+    lookups = 500
+
+    def test_crawl(self):
+        """
+        NodeSpiderCrawl lookups through a simulated network of 200 peers, with the
+        heap scanning for every membership test and with the id indexed heap.
+        """
+        print
+        network = _CrawlNetwork(self.peers, 60, 20)
+        rand = random.Random(1)
+        targets = [Node(digest(rand.random())) for _ in range(self.lookups)]
+        results = {}
+        original = (crawling.NodeHeap, crawling.RPCFindResponse)
+        crawling.RPCFindResponse = _NodeListResponse
+        try:
+            network.crawl(targets)
+            for cls in (_ScanningNodeHeap, NodeHeap):
+                crawling.NodeHeap = cls
+                seconds, results[cls] = network.crawl(targets)
+                print "%s: %6.0fus/lookup, %4.1f messages/lookup" % \
+                      (cls.__name__, seconds / self.lookups * 1e6, network.messages / float(self.lookups))
+        finally:
+            crawling.NodeHeap, crawling.RPCFindResponse = original
+        self.assertEqual(results[NodeHeap], results[_ScanningNodeHeap])
+
+
+class RoutingTableSnapshotBenchmark(unittest.TestCase):
+    skip = SKIP
+
+    def test_snapshot(self):
+        """
+        Size of a snapshot of a table of about 160 full buckets and replacement caches,
+        and how long it takes to write and restore.
+        """
+        router = fullRoutingTable()[0]
+        for bucket in router.buckets:
+            for i in range(router.ksize):
+                node = bucket.getNodes()[0]
+                bucket.replacementNodes.push(Node(digest((node.id, i)), "10.9.%d.1" % i, 18467, digest(i), None,
+                                                  objects.FULL_CONE))
+        contacts = sum(len(b) + len(b.replacementNodes) for b in router.buckets)
+        # the first snapshot serializes every contact, later ones reuse the encodings
+        first = timed(router.snapshot)
+        start = time.time()
+        data = router.snapshot()
+        save = time.time() - start
+        restored = RoutingTable(_PinglessProtocol(), router.ksize, router.node)
+        load = timed(restored.restore, data)
+        print
+        print "%d contacts: %d bytes/contact, first snapshot %.1fms, snapshot %.1fms, restore %.1fms" % \
+              (contacts, len(data) / contacts, first * 1e3, save * 1e3, load * 1e3)
+        self.assertEqual(len(restored.addresses), len(router.addresses))
+
+
+class ContactStatsBenchmark(unittest.TestCase):
+    skip = SKIP
+
+    def test_churn(self):
+        """
+        How many live contacts are removed from a table of about 160 full buckets when
+        10% of requests are lost, removing contacts on their first failure and after
+        MAX_FAILURES in a row.
+        """
+        print
+        rand = random.Random(0)
+        results = {}
+        for failures in (1, RoutingTable.MAX_FAILURES):
+            router, contacts = fullRoutingTable()
+            router.MAX_FAILURES = failures
+            removed = 0
+            for _ in range(20):
+                for contact in contacts:
+                    if rand.random() < 0.1:
+                        if router.recordFailure(contact) and not router.isNewNode(contact):
+                            router.removeContact(contact)
+                            removed += 1
+                    else:
+                        router.recordResponse(contact, 0.1)
+            print "evict after %d failures: %d of %d live contacts removed in 20 rounds of requests" % \
+                  (failures, removed, len(contacts))
+            results[failures] = removed
+        self.assertTrue(results[RoutingTable.MAX_FAILURES] < results[1])
+
+
+class _RefreshNetwork(object):
+    """
+    A protocol counting the messages a refresh sends in each second of a simulated
+    clock. FIND_NODE is answered with no new contacts and each republish is an inv
+    followed by the values it asks for.
+    """
+
+    def __init__(self, router, clock):
+        self.router = router
+        self.clock = clock
+        self.sent = {}
+
+    def _send(self, messages):
+        second = int(self.clock.seconds())
+        self.sent[second] = self.sent.get(second, 0) + messages
+
+    def callFindNode(self, peer, target):
+        self._send(1)
+        return defer.succeed((True, []))
+
+    def transferKeyValues(self, node):
+        self._send(2)
+        return defer.succeed(2)
+
+    def peak(self, window):
+        return max(sum(self.sent.get(t, 0) for t in range(start, start + window)) for start in self.sent)
+
+
+class RefreshSchedulerBenchmark(unittest.TestCase):
+    skip = SKIP
+
+    def test_refresh(self):
+        """
+        The peak message rate of refreshing every bucket of a table of about 160 full
+        buckets and republishing to its contacts, all at once as refreshTable used to
+        and paced by the RefreshScheduler.
+        """
+        print
+        for name, kwargs in (("all at once", {"concurrency": 10 ** 6, "rate": 10 ** 6, "burst": 10 ** 6}),
+                             ("scheduled", {})):
+            router = fullRoutingTable()[0]
+            for bucket in router.buckets:
+                bucket.lastUpdated = 0
+            clock = task.Clock()
+            network = _RefreshNetwork(router, clock)
+            scheduler = RefreshScheduler(network, router.ksize, 3, clock=clock, **kwargs)
+            reports = []
+            start = time.time()
+            scheduler.refresh().addCallback(reports.append)
+            while not reports:
+                clock.advance(1)
+            print "%s: %d buckets and %d contacts in %ds, %d messages, peak %d/s and %d/minute, %.1fs cpu" % \
+                  (name, reports[0]["buckets"], reports[0]["republished"], reports[0]["duration"],
+                   reports[0]["messages"], network.peak(1), network.peak(60), time.time() - start)
+            self.assertTrue(reports[0]["duration"] <= 3600)
+
+
+class DistanceBenchmark(unittest.TestCase):
+    skip = "NumPy isn't installed" if xor.numpy is None else SKIP
+
+    keywords = 20000
+    network = 100000
+
+    def test_transfer_key_values(self):
+        """
+        Offer a new node near us the values it should store, from the routing tables we
+        would have in a network of 100000 nodes, comparing ids one at a time and with
+        NumPy.
+        """
+        print
+        us = Node(digest("us"))
+        storage = ForgetfulStorage()
+        for i in range(self.keywords):
+            # keywords sharing up to 20 leading bits with us, so some are ours to hand over
+            keyword = us.long_id ^ (long(digest(i).encode("hex"), 16) >> (i % 20))
+            storage[("%040x" % keyword).decode("hex")] = ("key", "value", 604800)
+        newNode = Node(("%040x" % (us.long_id ^ 2 ** 140)).decode("hex"), "10.255.255.1", 18467)
+        for ksize in (20, 100):
+            protocol = KademliaProtocol(us, storage, ksize, None, None)
+            protocol.router = RoutingTable(_PinglessProtocol(), ksize, us)
+            for i in range(self.network):
+                protocol.router.addContact(Node(digest(i), "10.%d.%d.%d" % (i >> 16, i >> 8 & 255, i & 255), 18467))
+            results = {}
+            for vectorized in (False, True):
+                sent = []
+                protocol.callInv = lambda node, inv, sent=sent: sent.extend(inv) or defer.succeed((False, None))
+                original, xor.numpy = xor.numpy, xor.numpy if vectorized else None
+                try:
+                    seconds = timed(protocol.transferKeyValues, newNode)
+                finally:
+                    xor.numpy = original
+                results[vectorized] = sent
+                print "ksize %3d, %4d contacts, %s: %3.0fus/keyword, %d of %d keywords sent" % \
+                      (ksize, len(protocol.router.addresses), "numpy " if vectorized else "python",
+                       seconds / self.keywords * 1e6, len(sent), self.keywords)
+            self.assertEqual(results[True], results[False])
+
+
+class _RoundSpiderCrawl(crawling.NodeSpiderCrawl):
+    """
+    NodeSpiderCrawl as it was before lookups were pipelined, waiting for every query in
+    a round to be answered or time out before starting the next.
+    """
+
+    lastIDsCrawled = ()
+
+    def _find(self, rpcmethod):
+        count = self.alpha
+        if self.nearest.getIDs() == self.lastIDsCrawled:
+            count = len(self.nearest)
+        self.lastIDsCrawled = self.nearest.getIDs()
+        ds = {}
+        for peer in self._candidates(count):
+            ds[peer.id] = rpcmethod(peer, self.node)
+            self.nearest.markContacted(peer)
+        self.queries += len(ds)
+        return deferredDict(ds).addCallback(self._nodesFound)
+
+    def _nodesFound(self, responses):
+        toremove = []
+        for peerid, response in responses.items():
+            response = crawling.RPCFindResponse(response)
+            if not response.happened():
+                toremove.append(peerid)
+            else:
+                self.nearest.push(response.getNodeList())
+        self.nearest.remove(toremove)
+        if self.nearest.allBeenContacted():
+            return list(self.nearest)
+        return self.find()
+
+
+class _LatencyNetwork(_CrawlNetwork):
+    """
+    A _CrawlNetwork on a simulated clock where most peers answer in around 100ms, some
+    take seconds and some never answer, so their queries fail after the rpc timeout.
+    """
+
+    TIMEOUT = 15
+
+    def __init__(self, size, known, ksize, clock):
+        _CrawlNetwork.__init__(self, size, known, ksize)
+        self.clock = clock
+        rand = random.Random(2)
+        self.latency = {}
+        for node in self.nodes:
+            draw = rand.random()
+            if draw < 0.05:
+                self.latency[node.id] = None
+            elif draw < 0.15:
+                self.latency[node.id] = rand.uniform(1, 5)
+            else:
+                self.latency[node.id] = rand.lognormvariate(-2.3, 0.5)
+
+    def callFindNode(self, peer, target):
+        response = _CrawlNetwork.callFindNode(self, peer, target).result
+        latency = self.latency[peer.id]
+        d = defer.Deferred()
+        if latency is None:
+            self.clock.callLater(self.TIMEOUT, d.callback, (False, None))
+        else:
+            self.clock.callLater(latency, d.callback, response)
+        return d
+
+
+class PipelinedCrawlBenchmark(unittest.TestCase):
+    skip = SKIP
+
+    def test_latency(self):
+        """
+        Lookup latency through a simulated network of 2000 peers with realistic answer
+        times, 10% slow and 5% dead peers, waiting for each round of queries to finish
+        and pipelining them.
+        """
+        print
+        rand = random.Random(1)
+        targets = [Node(digest(rand.random())) for _ in range(300)]
+        results = {}
+        original = crawling.RPCFindResponse
+        crawling.RPCFindResponse = _NodeListResponse
+        try:
+            for cls in (_RoundSpiderCrawl, crawling.NodeSpiderCrawl):
+                clock = task.Clock()
+                self.patch(crawling, "reactor", clock)
+                network = _LatencyNetwork(2000, 100, 20, clock)
+                latencies = []
+                for target in targets:
+                    peers = [n for n in network.nodes[:20] if network.latency[n.id] is not None][:3]
+                    spider = cls(network, target, peers, 20, 3)
+                    spider.find().addCallback(lambda _, c=clock, l=latencies: l.append(c.seconds()))
+                while len(latencies) < len(targets):
+                    clock.advance(0.01)
+                results[cls] = latencies
+                print "%s: p50 %.2fs, p99 %.2fs, %.1f messages/lookup" % \
+                      (cls.__name__, percentile(latencies, 0.5), percentile(latencies, 0.99),
+                       network.messages / float(len(targets)))
+        finally:
+            crawling.RPCFindResponse = original
+        self.assertTrue(percentile(results[crawling.NodeSpiderCrawl], 0.5) <
+                        percentile(results[_RoundSpiderCrawl], 0.5))
+
+
+class LookupCacheBenchmark(unittest.TestCase):
+    skip = SKIP
+
+    def test_fan_out(self):
+        """
+        Messages sent by 200 lookups for 20 keywords started at once, as a page of search
+        results does, and the same again 10 seconds later, crawling for every lookup and
+        sharing them through a LookupCache.
+        """
+        print
+        rand = random.Random(1)
+        keywords = [Node(digest(rand.random())) for _ in range(20)]
+        targets = [rand.choice(keywords) for _ in range(200)]
+        messages = {}
+        original = crawling.RPCFindResponse
+        crawling.RPCFindResponse = _NodeListResponse
+        try:
+            for cached in (False, True):
+                clock = task.Clock()
+                self.patch(crawling, "reactor", clock)
+                network = _LatencyNetwork(2000, 100, 20, clock)
+                cache = LookupCache(clock=clock)
+                peers = [n for n in network.nodes[:20] if network.latency[n.id] is not None][:3]
+                found = []
+                for _ in range(2):
+                    for target in targets:
+                        def crawl(target=target, network=network, peers=peers):
+                            return crawling.NodeSpiderCrawl(network, target, peers, 20, 3).find()
+                        d = cache.get(target.id, crawl) if cached else crawl()
+                        d.addCallback(found.append)
+                    clock.pump([0.01] * 1000)
+                messages[cached] = network.messages
+                print "%s: %d lookups, %d messages, %d hits, %d coalesced, %d misses" % \
+                      ("cached" if cached else "uncached", len(found), network.messages, cache.hits,
+                       cache.coalesced, cache.misses)
+                self.assertEqual(len(found), 2 * len(targets))
+        finally:
+            crawling.RPCFindResponse = original
+        self.assertTrue(messages[True] * 5 < messages[False])
+
+
+class _ValueNetwork(_LatencyNetwork):
+    """
+    A _LatencyNetwork in which each keyword's values are stored on the k nodes closest
+    to it, each of them holding a value with the given probability, as when values are
+    published while the network changes.
+    """
+
+    def __init__(self, size, known, ksize, clock, keywords, values, replication):
+        _LatencyNetwork.__init__(self, size, known, ksize, clock)
+        rand = random.Random(3)
+        self.stored = {}
+        for keyword in keywords:
+            found = [objects.Value(valueKey=digest((keyword.id, i)), serializedData="data",
+                                   ttl=10).SerializeToString() for i in range(values)]
+            for node in heapq.nsmallest(ksize, self.nodes, key=keyword.distanceTo):
+                held = [v for v in found if rand.random() < replication]
+                if held:
+                    self.stored[(node.id, keyword.id)] = held
+
+    def callFindValue(self, peer, target):
+        held = self.stored.get((peer.id, target.id))
+        if held is None:
+            return self.callFindNode(peer, target)
+        self.messages += 1
+        d = defer.Deferred()
+        latency = self.latency[peer.id]
+        if latency is None:
+            self.clock.callLater(self.TIMEOUT, d.callback, (False, None))
+        else:
+            self.clock.callLater(latency, d.callback, (True, ["value"] + held))
+        return d
+
+
+class DisjointValueSpiderCrawlBenchmark(unittest.TestCase):
+    skip = SKIP
+
+    def test_keyword_lookups(self):
+        """
+        Latency and share of a keyword's 20 values found by lookups over one path and
+        three disjoint paths, through a simulated network of 2000 peers with 10% slow
+        and 5% dead peers, when every value is on each of the k closest nodes and when
+        each of them only holds 40% of the values.
+        """
+        def done(values, clock, latencies, found):
+            latencies.append(clock.seconds())
+            found.append(len(values or []) / 20.0)
+
+        print
+        rand = random.Random(1)
+        keywords = [Node(digest(rand.random())) for _ in range(200)]
+        original = crawling.RPCFindResponse
+        crawling.RPCFindResponse = _NodeListResponse
+        try:
+            for replication in (1.0, 0.4):
+                results = {}
+                for paths in (1, 3):
+                    clock = task.Clock()
+                    self.patch(crawling, "reactor", clock)
+                    network = _ValueNetwork(2000, 100, 20, clock, keywords, 20, replication)
+                    latencies, found = [], []
+                    for keyword in keywords:
+                        # a routing table's k neighbors, some of them slow or dead
+                        peers = network.nodes[:20]
+                        if paths == 1:
+                            spider = crawling.ValueSpiderCrawl(network, keyword, peers, 20, 3, False)
+                        else:
+                            spider = crawling.DisjointValueSpiderCrawl(network, keyword, peers, 20, 3, paths,
+                                                                       save_at_nearest=False)
+                        spider.find().addCallback(done, clock, latencies, found)
+                    while len(latencies) < len(keywords):
+                        clock.advance(0.01)
+                    results[paths] = sum(found) / len(found)
+                    print "%d%% replicas, %d paths: p50 %.2fs, p99 %.2fs, %.0f%% of values found, " \
+                          "%.1f messages/lookup" % (replication * 100, paths, percentile(latencies, 0.5),
+                                                    percentile(latencies, 0.99), results[paths] * 100,
+                                                    network.messages / float(len(keywords)))
+                self.assertTrue(results[3] >= results[1])
+        finally:
+            crawling.RPCFindResponse = original
+
+
+class StreamingSearchBenchmark(unittest.TestCase):
+    skip = SKIP
+
+    def test_time_to_first_result(self):
+        """
+        When the first values of a three path keyword lookup reach onValues and when
+        the lookup returns, through the simulated network with each of the k closest
+        nodes holding 40% of the keyword's values.
+        """
+        def streamed(values, clock, first, keyword):
+            first.setdefault(keyword.id, clock.seconds())
+
+        def done(values, clock, last):
+            last.append(clock.seconds())
+
+        print
+        rand = random.Random(1)
+        keywords = [Node(digest(rand.random())) for _ in range(200)]
+        clock = task.Clock()
+        self.patch(crawling, "reactor", clock)
+        self.patch(crawling, "RPCFindResponse", _NodeListResponse)
+        network = _ValueNetwork(2000, 100, 20, clock, keywords, 20, 0.4)
+        first, last = {}, []
+        for keyword in keywords:
+            spider = crawling.DisjointValueSpiderCrawl(
+                network, keyword, network.nodes[:20], 20, 3, 3, save_at_nearest=False,
+                onValues=lambda values, keyword=keyword: streamed(values, clock, first, keyword))
+            spider.find().addCallback(done, clock, last)
+        while len(last) < len(keywords):
+            clock.advance(0.01)
+        first = first.values()
+        print "first values: p50 %.2fs, p99 %.2fs; whole lookup: p50 %.2fs, p99 %.2fs" % \
+              (percentile(first, 0.5), percentile(first, 0.99), percentile(last, 0.5), percentile(last, 0.99))
+        self.assertTrue(percentile(first, 0.99) < percentile(last, 0.99))
@@ -0,0 +1,60 @@
+from twisted.internet import task
+from twisted.trial import unittest
+
+from dht.contacts import ContactCache
+from dht.node import Node
+from dht.utils import digest
+from protos.objects import FULL_CONE, RESTRICTED
+
+
+def peer(i):
+    return Node(digest(i), "10.0.0.%d" % i, 18467 + i, digest(("key", i)), ("10.1.0.1", 18469), RESTRICTED, False)
+
+
+class ContactCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = ContactCache(maxsize=3, clock=self.clock)
+
+    def test_get(self):
+        self.cache.add(peer(1))
+        self.assertEqual(self.cache.get(peer(1).id).port, 18468)
+        self.assertIsNone(self.cache.get(peer(2).id))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        # the latest address wins
+        moved = Node(peer(1).id, "10.0.9.9", 1234, peer(1).pubkey, None, FULL_CONE, False)
+        self.cache.add(moved)
+        self.assertEqual(self.cache.get(peer(1).id).ip, "10.0.9.9")
+        self.cache.remove(peer(1).id)
+        self.assertFalse(peer(1).id in self.cache)
+
+    def test_least_recently_used_dropped(self):
+        for i in range(3):
+            self.cache.add(peer(i))
+        self.cache.get(peer(0).id)
+        self.cache.add(peer(3))
+        self.assertEqual(len(self.cache), 3)
+        self.assertFalse(peer(1).id in self.cache)
+        self.assertTrue(peer(0).id in self.cache)
+
+    def test_stale(self):
+        self.cache.add(peer(0))
+        self.clock.advance(10)
+        self.cache.add(peer(1))
+        self.cache.add(peer(2))
+        self.clock.advance(5)
+        self.assertEqual([n.id for n in self.cache.stale(10, 5)], [peer(0).id])
+        self.assertEqual([n.id for n in self.cache.stale(1, 2)], [peer(0).id, peer(1).id])
+
+    def test_snapshot(self):
+        for i in range(3):
+            self.clock.advance(1)
+            self.cache.add(peer(i))
+        restored = ContactCache(clock=self.clock)
+        self.assertEqual(restored.restore(self.cache.snapshot()), 3)
+        self.assertEqual(restored.entries.keys(), self.cache.entries.keys())
+        node = restored.get(peer(2).id)
+        self.assertEqual((node.ip, node.port, node.pubkey, node.relay_node, node.nat_type),
+                         ("10.0.0.2", 18469, digest(("key", 2)), ("10.1.0.1", 18469), RESTRICTED))
+        self.assertEqual([n.id for n in restored.stale(1.5, 5)], [peer(0).id])
@@ -6,14 +6,16 @@ import nacl.hash
 import os
 from binascii import unhexlify
 from db.datastore import Database
-from dht.crawling import RPCFindResponse, NodeSpiderCrawl, ValueSpiderCrawl
+from dht import crawling
+from dht.crawling import RPCFindResponse, NodeSpiderCrawl, ValueSpiderCrawl, DisjointValueSpiderCrawl
 from dht.node import Node, NodeHeap
 from dht.protocol import KademliaProtocol
+from dht.routing import RoutingTable
 from dht.storage import ForgetfulStorage
 from dht.utils import digest
 from net.wireprotocol import OpenBazaarProtocol
 from protos.objects import Value, FULL_CONE
-from twisted.internet import udp, address, task
+from twisted.internet import defer, udp, address, task
 from twisted.trial import unittest
 from txrudp import packet, connection, rudp, constants
 
@@ -267,6 +269,20 @@ class NodeSpiderCrawlTest(unittest.TestCase):
         connection.REACTOR.runUntilCurrent()
         self.assertEqual(len(self.proto_mock.send_datagram.call_args_list), 7)
 
+    def test_candidates(self):
+        target = Node("\x00" * 20)
+        peers = [Node("\x00" * 19 + chr(i), "10.0.0.%d" % i, 1234) for i in range(8, 12)]
+        for peer in peers:
+            self.protocol.router.addContact(peer)
+        spider = NodeSpiderCrawl(self.protocol, target, peers, 20, 2)
+        self.assertEqual(spider._candidates(2), peers[:2])
+
+        # peers the same power of two away are ranked by expected answer time
+        self.protocol.router.recordResponse(peers[3], 0.1)
+        self.protocol.router.recordFailure(peers[0])
+        self.assertEqual(spider._candidates(2), [peers[3], peers[1]])
+        self.assertEqual(spider._candidates(5), peers)
+
     def test_nodesFound(self):
         self._connecting_to_connected()
         self.wire_protocol[self.addr1] = self.con
@@ -289,6 +305,10 @@ class NodeSpiderCrawlTest(unittest.TestCase):
         connection.REACTOR.runUntilCurrent()
         self.assertEqual(len(self.proto_mock.send_datagram.call_args_list), 7)
 
+        # test all been contacted
+        spider = NodeSpiderCrawl(self.protocol, node, nearest, 20, 3)
+        for peer in spider.nearest.getUncontacted():
+            spider.nearest.markContacted(peer)
         response = (True, (self.node1.getProto().SerializeToString(), self.node2.getProto().SerializeToString(),
                            self.node3.getProto().SerializeToString()))
         responses = {self.node1.id: response}
@@ -301,6 +321,10 @@ class NodeSpiderCrawlTest(unittest.TestCase):
         self.assertTrue(self.node2.getProto() in node_protos)
         self.assertTrue(self.node3.getProto() in node_protos)
 
+        # test didn't happen
+        spider = NodeSpiderCrawl(self.protocol, node, nearest, 20, 3)
+        for peer in spider.nearest.getUncontacted():
+            spider.nearest.markContacted(peer)
         response = (False, (self.node1.getProto().SerializeToString(), self.node2.getProto().SerializeToString(),
                             self.node3.getProto().SerializeToString()))
         responses = {self.node1.id: response}
@@ -371,3 +395,271 @@ class RPCFindResponseTest(unittest.TestCase):
         self.assertEqual(nodes[0].getProto(), node1.getProto())
         self.assertEqual(nodes[1].getProto(), node2.getProto())
         self.assertEqual(nodes[2].getProto(), node3.getProto())
+
+
+def intNode(i):
+    return Node(("%040x" % i).decode("hex"), "10.0.0.%d" % (i % 250 + 1), 18467, digest(i), None, FULL_CONE, True)
+
+
+class _PendingProtocol(object):
+    """
+    Records find_node and find_value queries, leaving them to be answered by the test.
+    """
+
+    def __init__(self):
+        self.router = RoutingTable(self, 20, intNode(2 ** 159))
+        self.pending = {}
+
+    def callFindNode(self, nodeToAsk, nodeToFind):
+        d = defer.Deferred()
+        self.pending[nodeToAsk.long_id] = d
+        return d
+
+    callFindValue = callFindNode
+
+    def answer(self, i, nodes=(), value=None):
+        if value is not None:
+            response = (True, ("value", value))
+        else:
+            response = (True, tuple(intNode(n).getProto().SerializeToString() for n in nodes))
+        self.pending.pop(i).callback(response)
+
+
+class PipelinedCrawlTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(crawling, "reactor", self.clock)
+        self.protocol = _PendingProtocol()
+        self.target = intNode(0)
+
+    def test_keeps_alpha_in_flight(self):
+        spider = NodeSpiderCrawl(self.protocol, self.target, [intNode(i) for i in (8, 9, 10)], 3, 2)
+        found = []
+        spider.find().addCallback(found.append)
+        self.assertEqual(sorted(self.protocol.pending), [8, 9])
+
+        # the next query goes out as soon as one answers, without waiting for the other
+        self.protocol.answer(9, [1, 2])
+        self.assertEqual(sorted(self.protocol.pending), [1, 8])
+        self.protocol.answer(1)
+        self.assertEqual(sorted(self.protocol.pending), [2, 8])
+        self.protocol.answer(2)
+        self.assertEqual(found, [])
+        self.protocol.answer(8)
+        self.assertEqual([n.long_id for n in found[0]], [1, 2, 8])
+        self.assertEqual(spider.queries, 4)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_slow_peer(self):
+        spider = NodeSpiderCrawl(self.protocol, self.target, [intNode(i) for i in (8, 9)], 2, 1)
+        found = []
+        spider.find().addCallback(found.append)
+        self.assertEqual(list(self.protocol.pending), [8])
+
+        # 8 is slow so 9 is asked instead and 8 drops out of the nearest nodes
+        self.clock.advance(spider.HOP_TIMEOUT)
+        self.assertEqual(sorted(self.protocol.pending), [8, 9])
+        self.protocol.answer(9, [3])
+        self.protocol.answer(3)
+        self.assertEqual([n.long_id for n in found[0]], [3, 9])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_waits_for_slow_peers(self):
+        spider = NodeSpiderCrawl(self.protocol, self.target, [intNode(i) for i in (8, 9)], 2, 2)
+        found = []
+        spider.find().addCallback(found.append)
+        self.clock.advance(spider.HOP_TIMEOUT)
+        self.protocol.answer(9)
+        # there aren't k nodes without 8, so its late answer is still used
+        self.assertEqual(found, [])
+        self.protocol.answer(8, [5])
+        self.protocol.answer(5)
+        self.assertEqual([n.long_id for n in found[0]], [5, 8])
+
+    def test_value_ends_lookup(self):
+        val = Value()
+        val.valueKey = digest("contractID")
+        val.serializedData = "data"
+        val.ttl = 10
+        spider = ValueSpiderCrawl(self.protocol, self.target, [intNode(i) for i in (8, 9, 10)], 20, 3,
+                                  save_at_nearest=False)
+        found = []
+        spider.find().addCallback(found.append)
+        self.protocol.answer(10, [1])
+        self.protocol.answer(9, value=val.SerializeToString())
+        self.assertEqual(found, [[val.SerializeToString()]])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        # answers after the lookup is over are ignored
+        self.protocol.answer(8, [2])
+        self.assertEqual(sorted(self.protocol.pending), [1])
+
+
+    def test_callback_error_finishes_lookup(self):
+        spider = ValueSpiderCrawl(self.protocol, self.target, [intNode(i) for i in (8, 9)], 20, 1)
+        found = []
+        spider.find().addCallback(found.append)
+        self.protocol.answer(8)
+        # storing the value at 8 fails, since _PendingProtocol has no callValues
+        self.protocol.answer(9, value=serializedValue("contract", "data"))
+        self.assertEqual(found, [None])
+        self.assertEqual(spider.waiting, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+def serializedValue(key, data, ttl=10):
+    val = Value()
+    val.valueKey = digest(key)
+    val.serializedData = data
+    val.ttl = ttl
+    return val.SerializeToString()
+
+
+class DisjointValueSpiderCrawlTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(crawling, "reactor", self.clock)
+        self.protocol = _PendingProtocol()
+        self.target = intNode(0)
+
+    def _spider(self, peers, paths, quorum=None):
+        spider = DisjointValueSpiderCrawl(self.protocol, self.target, [intNode(i) for i in peers], 20, 1, paths,
+                                          quorum, save_at_nearest=False)
+        found = []
+        spider.find().addCallback(found.append)
+        return spider, found
+
+    def test_paths_are_disjoint(self):
+        spider, found = self._spider([8, 9, 10, 11], 2)
+        self.assertEqual(sorted(self.protocol.pending), [8, 9])
+        # 9 is on the other path so the first path asks 3 next instead
+        self.protocol.answer(8, [9, 11, 3])
+        self.assertEqual(sorted(self.protocol.pending), [3, 9])
+        self.protocol.answer(9, [3, 10, 5])
+        self.assertEqual(sorted(self.protocol.pending), [3, 5])
+        self.protocol.answer(3)
+        self.protocol.answer(5)
+        self.protocol.answer(10)
+        self.protocol.answer(11)
+        self.assertEqual(found, [None])
+        self.assertEqual(spider.queries, 6)
+
+    def test_quorum_ends_lookup(self):
+        spider, found = self._spider([8, 9, 10], 3)
+        value = serializedValue("contract", "data")
+        self.protocol.answer(8, value=value)
+        self.assertEqual(found, [])
+        # ttls differ depending on when the value was stored
+        self.protocol.answer(9, value=serializedValue("contract", "data", 5))
+        self.assertEqual(found, [[value]])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertTrue(all(path.done for path in spider.paths))
+
+    def test_merges_values(self):
+        spider, found = self._spider([8, 9, 10], 3)
+        first, second = serializedValue("first", "data"), serializedValue("second", "data")
+        self.protocol.answer(8, value=first)
+        self.protocol.answer(9, value=second)
+        # the paths disagree, so the lookup waits for the last one
+        self.assertEqual(found, [])
+        self.protocol.answer(10, value=second)
+        self.assertEqual(sorted(found[0]), sorted([first, second]))
+        self.assertEqual(len(spider.found), 3)
+
+    def test_deadline_after_quorum_finished(self):
+        spider, found = self._spider([8, 9, 10], 3)
+        first, second = serializedValue("first", "data"), serializedValue("second", "data")
+        self.protocol.answer(8, value=first)
+        self.protocol.answer(9, value=second)
+        # a quorum of paths have finished, so the last one only gets a little longer
+        self.clock.advance(spider.QUORUM_GRACE - 0.1)
+        self.assertEqual(found, [])
+        self.clock.advance(0.1)
+        self.assertEqual(sorted(found[0]), sorted([first, second]))
+        self.assertTrue(all(path.done for path in spider.paths))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_majority_wins(self):
+        spider, found = self._spider([8, 9, 10], 3, quorum=3)
+        self.protocol.answer(8, value=serializedValue("contract", "bad"))
+        self.protocol.answer(9, value=serializedValue("contract", "good"))
+        self.protocol.answer(10, value=serializedValue("contract", "good"))
+        self.assertEqual(found, [[serializedValue("contract", "good")]])
+        self.assertEqual(spider.quorum, 3)
+
+    def test_streams_values(self):
+        streamed = []
+        spider = DisjointValueSpiderCrawl(self.protocol, self.target, [intNode(i) for i in (8, 9, 10)], 20, 1, 3,
+                                          quorum=3, save_at_nearest=False, onValues=streamed.append)
+        found = []
+        spider.find().addCallback(found.append)
+        first, second = serializedValue("first", "data"), serializedValue("second", "data")
+        self.protocol.answer(8, value=first)
+        self.assertEqual(streamed, [[first]])
+        # only values with keys that haven't been passed on yet are
+        self.protocol.pending.pop(9).callback((True, ("value", first, second)))
+        self.assertEqual(streamed, [[first], [second]])
+        self.protocol.answer(10, value=serializedValue("first", "other"))
+        self.assertEqual(streamed, [[first], [second]])
+        self.assertEqual(sorted(found[0]), sorted([first, second]))
+
+
+class ValueStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(crawling, "reactor", self.clock)
+        self.protocol = _PendingProtocol()
+        self.stored = []
+        self.protocol.callValues = lambda node, values: self.stored.append(defer.Deferred()) or self.stored[-1]
+
+    def test_values_before_result(self):
+        streamed = []
+        spider = ValueSpiderCrawl(self.protocol, intNode(0), [intNode(i) for i in (8, 9)], 20, 2,
+                                  onValues=streamed.append)
+        found = []
+        spider.find().addCallback(found.append)
+        self.protocol.answer(9, [])
+        value = serializedValue("contract", "data")
+        self.protocol.answer(8, value=value)
+        # the values are passed on while they're stored at the nearest node without them
+        self.assertEqual(streamed, [[value]])
+        self.assertEqual(found, [])
+        self.stored[0].callback((True, None))
+        self.assertEqual(found, [[value]])
+
+    def test_values_streamed_from_queries_in_flight(self):
+        streamed = []
+        spider = ValueSpiderCrawl(self.protocol, intNode(0), [intNode(i) for i in (8, 9, 10)], 20, 3, False,
+                                  streamed.append)
+        found = []
+        spider.find().addCallback(found.append)
+        first, second = serializedValue("first", "data"), serializedValue("second", "data")
+        self.protocol.answer(8, value=first)
+        self.assertEqual(streamed, [[first]])
+        self.assertEqual(found, [])
+        # nothing new is asked once a value is found, but the answers on their way are used
+        self.protocol.answer(9, [1, 2])
+        self.assertEqual(sorted(self.protocol.pending), [10])
+        self.protocol.answer(10, value=second)
+        self.assertEqual(streamed, [[first], [second]])
+        self.assertEqual(sorted(found[0]), sorted([first, second]))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_slow_query_ends_gathering(self):
+        streamed = []
+        spider = ValueSpiderCrawl(self.protocol, intNode(0), [intNode(i) for i in (8, 9)], 20, 2, False,
+                                  streamed.append)
+        found = []
+        spider.find().addCallback(found.append)
+        value = serializedValue("contract", "data")
+        self.protocol.answer(8, value=value)
+        self.assertEqual(found, [])
+        self.clock.advance(spider.HOP_TIMEOUT)
+        self.assertEqual(found, [[value]])
+
+    def test_callback_errors_ignored(self):
+        def fail(values):
+            raise ValueError(values)
+        spider = ValueSpiderCrawl(self.protocol, intNode(0), [intNode(8)], 20, 1, False, fail)
+        found = []
+        spider.find().addCallback(found.append)
+        self.protocol.answer(8, value=serializedValue("contract", "data"))
+        self.assertEqual(len(found), 1)
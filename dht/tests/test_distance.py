@@ -0,0 +1,83 @@
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from dht import distance
+from dht.distance import PackedIds
+from dht.node import Node
+from dht.protocol import KademliaProtocol
+from dht.routing import RoutingTable
+from dht.storage import ForgetfulStorage
+from dht.utils import digest
+
+
+def intNode(i, port=18467):
+    return Node(("%040x" % i).decode("hex"), "10.0.%d.%d" % (i >> 8 & 255, i & 255), port)
+
+
+class PackedIdsTest(unittest.TestCase):
+    def setUp(self):
+        # random ids, and ids sharing their top 64 or 128 bits with each other so some
+        # distances tie on the first words
+        self.nodes = [Node(digest(i)) for i in range(100)]
+        self.nodes += [intNode(2 ** 100 + i) for i in range(30)] + [intNode(2 ** 40 + i) for i in range(30)]
+        self.targets = [Node(digest("target%d" % i)) for i in range(10)] + [intNode(2 ** 100 + 7), intNode(3)]
+
+    def _check(self):
+        packed = PackedIds(self.nodes)
+        for target in self.targets:
+            ordered = sorted(self.nodes, key=target.distanceTo)
+            for bound in (ordered[0], ordered[25], ordered[-1]):
+                d = target.distanceTo(bound)
+                expected = [n for n in self.nodes if target.distanceTo(n) < d]
+                self.assertEqual(packed.countWithin(target, d), len(expected))
+        return packed
+
+    def test_vectorized(self):
+        if distance.numpy is None:
+            raise unittest.SkipTest("NumPy isn't installed")
+        self.assertTrue(self._check().vectorized)
+
+    def test_fallback(self):
+        original, distance.numpy = distance.numpy, None
+        try:
+            self.assertFalse(self._check().vectorized)
+        finally:
+            distance.numpy = original
+
+    def test_few_ids(self):
+        self.nodes = self.nodes[:distance.VECTORIZE_THRESHOLD - 1]
+        self.assertFalse(self._check().vectorized)
+
+
+class TransferKeyValuesTest(unittest.TestCase):
+    def test_vectorized_matches_routing_table(self):
+        """
+        transferKeyValues makes the same choices comparing every contact with NumPy as
+        it does looking up the nearest ones in the routing table.
+        """
+        if distance.numpy is None:
+            raise unittest.SkipTest("NumPy isn't installed")
+        us = Node(digest("us"))
+        storage = ForgetfulStorage()
+        for i in range(500):
+            keyword = us.long_id ^ (long(digest(i).encode("hex"), 16) >> (i % 12))
+            storage[("%040x" % keyword).decode("hex")] = ("key", "value", 604800)
+        protocol = KademliaProtocol(us, storage, 20, None, None)
+        protocol.router = RoutingTable(protocol, 20, us)
+        protocol.callPing = lambda node: None
+        for i in range(2000):
+            protocol.router.addContact(Node(digest(i), "10.1.%d.%d" % (i >> 8, i & 255), 18467))
+        newNode = Node(("%040x" % (us.long_id ^ 2 ** 150)).decode("hex"), "10.2.0.1", 18467)
+
+        results = []
+        for numpy in (distance.numpy, None):
+            sent = []
+            protocol.callInv = lambda node, inv, sent=sent: sent.extend(inv) or defer.succeed((False, None))
+            original, distance.numpy = distance.numpy, numpy
+            try:
+                protocol.transferKeyValues(newNode)
+            finally:
+                distance.numpy = original
+            results.append(sent)
+        self.assertTrue(len(results[0]) > 0)
+        self.assertEqual(results[0], results[1])
@@ -0,0 +1,75 @@
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from dht.lookups import LookupCache
+
+
+class LookupCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = LookupCache(ttl=30, maxsize=2, clock=self.clock)
+        self.lookups = []
+
+    def lookup(self):
+        d = defer.Deferred()
+        self.lookups.append(d)
+        return d
+
+    def test_coalesces_running_lookups(self):
+        results = []
+        for _ in range(3):
+            self.cache.get("key", self.lookup).addCallback(results.append)
+        self.assertEqual(len(self.lookups), 1)
+        self.lookups[0].callback(["a", "b"])
+        self.assertEqual(results, [["a", "b"]] * 3)
+        # each caller gets its own list
+        results[0].append("c")
+        self.assertEqual(results[1], ["a", "b"])
+        self.assertEqual((self.cache.hits, self.cache.misses, self.cache.coalesced), (0, 1, 2))
+
+    def test_caches_until_ttl(self):
+        results = []
+        self.cache.get("key", self.lookup)
+        self.lookups[0].callback(["a"])
+        self.clock.advance(29)
+        self.cache.get("key", self.lookup).addCallback(results.append)
+        self.assertEqual(results, [["a"]])
+        self.assertEqual(len(self.lookups), 1)
+        self.clock.advance(1)
+        self.cache.get("key", self.lookup)
+        self.assertEqual(len(self.lookups), 2)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_empty_results_not_kept(self):
+        results = []
+        self.cache.get("key", lambda: None)
+        self.cache.get("key", lambda: []).addCallback(results.append)
+        self.assertEqual(results, [[]])
+        self.assertEqual(self.cache.misses, 2)
+        self.assertEqual(len(self.cache.results), 0)
+
+    def test_failure(self):
+        failures = []
+        for _ in range(2):
+            self.cache.get("key", self.lookup).addErrback(failures.append)
+        self.lookups[0].errback(ValueError("no"))
+        self.assertEqual([f.type for f in failures], [ValueError, ValueError])
+        self.assertEqual(len(self.cache.results), 0)
+
+    def test_invalidate(self):
+        self.cache.get("key", self.lookup)
+        self.lookups[0].callback(["a"])
+        self.cache.invalidate("key")
+        self.cache.get("key", self.lookup)
+        # invalidated while it was running, so the result isn't kept
+        self.cache.invalidate("key")
+        self.lookups[1].callback(["b"])
+        self.cache.get("key", self.lookup)
+        self.assertEqual(len(self.lookups), 3)
+
+    def test_maxsize(self):
+        for key in ("a", "b", "c"):
+            self.cache.get(key, lambda key=key: [key])
+        self.cache.get("b", self.lookup)
+        self.assertEqual(list(self.cache.results), ["c", "b"])
+        self.assertEqual(self.lookups, [])
@@ -51,6 +51,27 @@ class NodeTest(unittest.TestCase):
         n2 = Node(rid, "127.0.0.1", 1234, digest("pubkey"), ("127.0.0.1", 1234), objects.FULL_CONE, True)
         self.assertEqual(n1, n2.getProto())
 
+    def test_proto_cache(self):
+        n = Node(digest("id"), "127.0.0.1", 1234, digest("pubkey"), None, objects.FULL_CONE, False)
+        proto = n.getProto()
+        serialized = n.getSerializedProto()
+        self.assertIs(n.getProto(), proto)
+        self.assertEqual(serialized, proto.SerializeToString())
+        self.assertIs(n.getSerializedProto(), serialized)
+
+        n.relay_node = ("127.0.0.2", 4321)
+        self.assertEqual(n.getProto().relayAddress.ip, "127.0.0.2")
+        n.ip, n.port, n.nat_type, n.vendor = "127.0.0.3", 5678, objects.SYMMETRIC, True
+        n2 = objects.Node()
+        n2.ParseFromString(n.getSerializedProto())
+        self.assertEqual((n2.nodeAddress.ip, n2.nodeAddress.port, n2.natType, n2.vendor, n2.relayAddress.port),
+                         ("127.0.0.3", 5678, objects.SYMMETRIC, True, 4321))
+
+    def test_slots(self):
+        n = Node(digest("id"))
+        self.assertFalse(hasattr(n, "__dict__"))
+        self.assertRaises(AttributeError, setattr, n, "foo", "bar")
+
     def test_tuple(self):
         n = Node('127.0.0.1', 0, 'testkey')
         i = n.__iter__()
@@ -96,3 +117,43 @@ class NodeHeapTest(unittest.TestCase):
         nh = NodeHeap(n, 5)
         val = nh.getNodeById('')
         self.assertIsNone(val)
+
+    def test_getNodeById(self):
+        heap = NodeHeap(mknode(intid=0), 2)
+        nodes = [mknode(intid=x) for x in range(5)]
+        heap.push(nodes)
+        # nodes beyond maxsize are still known
+        self.assertIs(heap.getNodeById(nodes[4].id), nodes[4])
+        self.assertTrue(nodes[4] in heap)
+        self.assertFalse(mknode(intid=9) in heap)
+
+    def test_push_remove_push(self):
+        heap = NodeHeap(mknode(intid=0), 3)
+        nodes = [mknode(intid=x) for x in range(6)]
+        heap.push(nodes)
+        self.assertEqual(heap.getIDs(), [n.id for n in nodes[:3]])
+        heap.push(mknode(intid=1))
+        heap.remove([nodes[1].id, nodes[2].id, nodes[3].id])
+        self.assertEqual(heap.getIDs(), [nodes[0].id, nodes[4].id, nodes[5].id])
+        self.assertIsNone(heap.getNodeById(nodes[1].id))
+
+        # the removed entries are dropped from the heap once they are the majority
+        self.assertEqual(len(heap.heap), 6)
+        heap.remove([nodes[4].id])
+        self.assertEqual(len(heap.heap), 2)
+
+        heap.push(nodes[2])
+        self.assertEqual(heap.getIDs(), [nodes[0].id, nodes[2].id, nodes[5].id])
+        self.assertEqual([heap.popleft(), heap.popleft(), heap.popleft(), heap.popleft()],
+                         [nodes[0], nodes[2], nodes[5], None])
+
+    def test_getUncontacted(self):
+        heap = NodeHeap(mknode(intid=0), 2)
+        nodes = [mknode(intid=x) for x in range(3)]
+        heap.push(nodes)
+        heap.markContacted(nodes[0])
+        self.assertEqual(heap.getUncontacted(), [nodes[1]])
+        heap.markContacted(nodes[1])
+        self.assertTrue(heap.allBeenContacted())
+        heap.remove([nodes[1].id])
+        self.assertEqual(heap.getUncontacted(), [nodes[2]])
@@ -14,7 +14,7 @@ from twisted.internet import task, address, udp, defer, reactor
 
 from dht.protocol import KademliaProtocol
 from dht.utils import digest
-from dht.storage import ForgetfulStorage
+from dht.storage import ForgetfulStorage, ShardedStorage
 from dht.node import Node
 from protos import message, objects
 from net.wireprotocol import OpenBazaarProtocol
@@ -74,6 +74,7 @@ class KademliaProtocolTest(unittest.TestCase):
     def test_invalid_datagram(self):
         self.assertFalse(self.handler.receive_message("hi"))
         self.assertFalse(self.handler.receive_message("hihihihihihihihihihihihihihihihihihihihih"))
+        self.assertEqual(len(self.protocol.contacts), 0)
 
     def test_rpc_ping(self):
         self._connecting_to_connected()
@@ -105,6 +106,10 @@ class KademliaProtocolTest(unittest.TestCase):
         self.assertEqual(received_message, expected_message)
         self.assertEqual(len(m_calls), 2)
 
+        # the verified sender is remembered for resolving its guid
+        contact = self.protocol.contacts.get(self.protocol.sourceNode.id)
+        self.assertEqual((contact.ip, contact.port), (self.public_ip, self.port))
+
     def test_rpc_store(self):
         self._connecting_to_connected()
         self.protocol.router.addContact(self.protocol.sourceNode)
@@ -518,8 +523,12 @@ class KademliaProtocolTest(unittest.TestCase):
         message_id = digest("msgid")
         n = Node(digest("S"), self.addr1[0], self.addr1[1])
         d = defer.Deferred()
-        self.protocol._outstanding[message_id] = (d, self.addr1, reactor.callLater(5, handle_response))
+        self.protocol.router.addContact(n)
+        self.protocol._outstanding[message_id] = (d, self.addr1, reactor.callLater(5, handle_response), time.time())
         self.protocol._acceptResponse(message_id, ["test"], n)
+        stats = self.protocol.router.getStats(n)
+        self.assertEqual(stats.successes, 1)
+        self.assertTrue(0 <= stats.rtt < 5)
 
         return d.addCallback(handle_response)
 
@@ -534,9 +543,54 @@ class KademliaProtocolTest(unittest.TestCase):
 
         n = Node(digest("S"), self.addr1[0], self.addr1[1])
         d = defer.Deferred().addCallback(handle_response, n)
-        self.protocol._outstanding["msgID"] = [d, self.addr1, reactor.callLater(5, handle_response)]
+        self.protocol._outstanding["msgID"] = [d, self.addr1, reactor.callLater(5, handle_response), time.time()]
+        self.protocol.router.addContact(n)
+        self.protocol._timedOut("msgID", n)
+        self.assertEqual(self.protocol._outstanding, {})
+        self.assertEqual(self.protocol.router.getStats(n).consecutiveFailures, 1)
+        # a request which was already answered or cancelled isn't counted
+        self.protocol._timedOut("msgID", n)
+        self.assertEqual(self.protocol.router.getStats(n).consecutiveFailures, 1)
+        return d
+
+    def test_timeout_counted_once(self):
+        """
+        One unanswered request is one failure, though closing the connection tells
+        every processor sharing the routing table about it.
+        """
+        other = KademliaProtocol(self.node, self.storage, 20, self.db, self.signing_key)
+        other.router = self.protocol.router
+        other.connect_multiplexer(self.wire_protocol)
+        handler = self.wire_protocol.ConnHandler([self.protocol, other], self.wire_protocol, None)
+        handler.connection = self.con
+        n = Node(digest("S"), self.addr1[0], self.addr1[1])
+        handler.node = n
+        self.protocol.router.addContact(n)
+
+        for i in range(1, self.protocol.router.MAX_FAILURES + 1):
+            self.assertFalse(self.protocol.router.isNewNode(n))
+            self.protocol._outstanding[i] = [defer.Deferred(), self.addr1, reactor.callLater(5, lambda: None),
+                                             time.time()]
+            self.protocol._timedOut(i, n)
+            # which shuts the connection down, timing out both processors
+            handler.handle_shutdown()
+            if i < self.protocol.router.MAX_FAILURES:
+                self.assertEqual(self.protocol.router.getStats(n).consecutiveFailures, i)
+        self.assertTrue(self.protocol.router.isNewNode(n))
+
+    def test_shutdown_not_a_failure(self):
+        handler = self.wire_protocol.ConnHandler([self.protocol], self.wire_protocol, None)
+        handler.connection = self.con
+        n = Node(digest("S"), self.addr1[0], self.addr1[1])
+        handler.node = n
         self.protocol.router.addContact(n)
-        self.protocol.timeout(n)
+        d = defer.Deferred()
+        self.protocol._outstanding["msgID"] = [d, self.addr1, reactor.callLater(5, lambda: None), time.time()]
+        handler.handle_shutdown()
+        self.assertEqual(self.protocol._outstanding, {})
+        self.assertFalse(self.protocol.router.isNewNode(n))
+        self.assertEqual(self.protocol.router.getStats(n).consecutiveFailures, 0)
+        return d.addCallback(self.assertEqual, (False, None))
 
     def test_transferKeyValues(self):
         self._connecting_to_connected()
@@ -575,17 +629,29 @@ class KademliaProtocolTest(unittest.TestCase):
         self.assertTrue(x.arguments[0] in m.arguments)
         self.assertTrue(x.arguments[1] in m.arguments)
 
-    def test_refreshIDs(self):
-        node1 = Node(digest("id1"), "127.0.0.1", 12345, pubkey=digest("key1"))
-        node2 = Node(digest("id2"), "127.0.0.1", 22222, pubkey=digest("key2"))
-        node3 = Node(digest("id3"), "127.0.0.1", 77777, pubkey=digest("key3"))
-        self.protocol.router.addContact(node1)
-        self.protocol.router.addContact(node2)
-        self.protocol.router.addContact(node3)
-        for b in self.protocol.router.buckets:
-            b.lastUpdated = (time.time() - 5000)
-        ids = self.protocol.getRefreshIDs()
-        self.assertTrue(len(ids) == 1)
+    def test_transferKeyValues_skips_shards(self):
+        self.protocol.storage = ShardedStorage(prefix_bits=1)
+        ours = self.protocol.sourceNode.id
+        flipped = chr(ord(ours[0]) ^ 0x80)
+        contact = Node(flipped + digest("contact")[1:], "127.0.0.1", 1234)
+        newNode = Node(ours[0] + digest("new")[1:], "127.0.0.1", 5678)
+        near = ours[0] + digest("near")[1:]
+        far = flipped + digest("far")[1:]
+        self.protocol.router.addContact(contact)
+        self.protocol.storage[near] = (digest("key"), "value", 10)
+        self.protocol.storage[far] = (digest("key"), "value", 10)
+
+        looked_up = []
+        findNeighbors = self.protocol.router.findNeighbors
+        self.protocol.router.findNeighbors = lambda n, **kw: looked_up.append(n.id) or findNeighbors(n, **kw)
+        invs = []
+        self.protocol.callInv = lambda node, inv: invs.extend(inv) or defer.succeed((False, None))
+        self.protocol.transferKeyValues(newNode)
+
+        self.assertEqual(looked_up, [near])
+        i = objects.Inv()
+        i.ParseFromString(invs[0])
+        self.assertEqual((len(invs), i.keyword), (1, near))
 
     def _connecting_to_connected(self):
         remote_synack_packet = packet.Packet.from_data(
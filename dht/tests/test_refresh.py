@@ -0,0 +1,131 @@
+import time
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from dht.node import Node
+from dht.refresh import RefreshScheduler, TokenBucket
+from dht.routing import RoutingTable
+
+
+def intNode(i):
+    return Node(("%040x" % i).decode("hex"), "127.0.0.%d" % (i % 250 + 1), i % 65536)
+
+
+class _RefreshProtocol(object):
+    """
+    Just enough of a KademliaProtocol for the scheduler. Every find_node is answered
+    straight away with no new contacts and republishes are recorded with the time
+    they're started.
+    """
+
+    def __init__(self, clock, ksize):
+        self.clock = clock
+        self.router = RoutingTable(self, ksize, intNode(0))
+        self.found = []
+        self.republished = []
+        self.pending = None
+
+    def callFindNode(self, nodeToAsk, nodeToFind):
+        self.found.append(nodeToAsk)
+        return defer.succeed((True, []))
+
+    def transferKeyValues(self, node):
+        self.republished.append((self.clock.seconds(), node))
+        if self.pending is not None:
+            d = defer.Deferred()
+            self.pending.append(d)
+            return d
+        return defer.succeed(2)
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_take(self):
+        clock = task.Clock()
+        tokens = TokenBucket(2, 3, clock)
+        self.assertEqual([tokens.take() for _ in range(3)], [0, 0, 0])
+        self.assertEqual(tokens.take(), 0.5)
+        clock.advance(0.5)
+        self.assertEqual(tokens.take(), 0)
+        clock.advance(100)
+        self.assertEqual([tokens.take() for _ in range(4)], [0, 0, 0, 0.5])
+
+
+class RefreshSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.protocol = _RefreshProtocol(self.clock, 2)
+        self.router = self.protocol.router
+        # two contacts in each half of the id space, so there are two buckets
+        for i in (1, 2, 2 ** 159 + 1, 2 ** 159 + 2):
+            self.router.addContact(intNode(i))
+        self.assertEqual(len(self.router.buckets), 2)
+        for bucket in self.router.buckets:
+            bucket.lastUpdated = time.time() - 5000
+
+    def test_spreads_jobs_over_period(self):
+        scheduler = RefreshScheduler(self.protocol, 2, 1, period=100, clock=self.clock)
+        reports = []
+        scheduler.refresh().addCallback(reports.append)
+        # two buckets and a random id to crawl, then four contacts to republish to
+        # as fast as nine jobs fit into half the period
+        self.clock.pump([1] * 100)
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(sorted(n.long_id for _, n in self.protocol.republished),
+                         [1, 2, 2 ** 159 + 1, 2 ** 159 + 2])
+        started = [t for t, _ in self.protocol.republished]
+        self.assertEqual(started, sorted(started))
+        self.assertTrue(all(b - a >= 5 for a, b in zip(started, started[1:])))
+        self.assertTrue(started[-1] <= 50)
+        report = reports[0]
+        self.assertEqual((report["buckets"], report["skipped"], report["republished"]), (2, 0, 4))
+        self.assertEqual(report["messages"], len(self.protocol.found) + 4 * 2)
+        self.assertEqual(scheduler.lastReport, report)
+
+    def test_concurrency(self):
+        self.protocol.pending = []
+        scheduler = RefreshScheduler(self.protocol, 2, 1, period=100, concurrency=2, rate=1000, burst=10,
+                                     clock=self.clock)
+        reports = []
+        scheduler.refresh().addCallback(reports.append)
+        self.clock.advance(1)
+        self.assertEqual(len(self.protocol.republished), 2)
+        self.protocol.pending.pop(0).callback(1)
+        self.clock.advance(1)
+        self.assertEqual(len(self.protocol.republished), 3)
+
+        # a refresh while this one is running waits for it instead
+        self.assertIs(scheduler.refresh(), scheduler.finished)
+        while self.protocol.pending:
+            self.protocol.pending.pop(0).callback(1)
+            self.clock.advance(1)
+        self.assertEqual(len(self.protocol.republished), 4)
+        self.assertEqual(reports[0]["republished"], 4)
+        self.assertIsNone(scheduler.finished)
+
+    def test_skips_touched_buckets(self):
+        scheduler = RefreshScheduler(self.protocol, 2, 1, period=100, rate=1, burst=1, clock=self.clock)
+        reports = []
+        scheduler.refresh().addCallback(reports.append)
+        # a lookup in the second bucket before its refresh gets a token
+        self.router.findNeighbors(intNode(2 ** 159 + 3))
+        self.clock.pump([1] * 10)
+        self.assertEqual((reports[0]["buckets"], reports[0]["skipped"]), (1, 1))
+
+    def test_only_lonely_buckets(self):
+        self.router.buckets[0].touchLastUpdated()
+        scheduler = RefreshScheduler(self.protocol, 2, 1, period=100, rate=1000, clock=self.clock)
+        reports = []
+        scheduler.refresh().addCallback(reports.append)
+        self.clock.pump([1] * 10)
+        self.assertEqual((reports[0]["buckets"], reports[0]["skipped"]), (1, 0))
+
+    def test_start(self):
+        scheduler = RefreshScheduler(self.protocol, 2, 1, period=100, rate=1000, clock=self.clock)
+        scheduler.start()
+        self.clock.pump([1] * 10)
+        self.assertEqual(len(self.protocol.republished), 4)
+        self.clock.pump([1] * 100)
+        self.assertEqual(len(self.protocol.republished), 8)
+        scheduler.stop()
+        self.assertFalse(scheduler.loop.running)
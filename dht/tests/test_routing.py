@@ -1,9 +1,12 @@
+import random
+
 from twisted.trial import unittest
 
-from dht.routing import KBucket, RoutingTable
+from dht.routing import KBucket, RoutingTable, SnapshotError, ContactStats
 from dht.utils import digest
 from dht.node import Node
 from dht.tests.utils import mknode
+from protos import objects
 
 
 class KBucketTest(unittest.TestCase):
@@ -43,6 +46,60 @@ class KBucketTest(unittest.TestCase):
         bucket.removeNode(mknode(intid=2))
         self.assertEqual(len(bucket), 1)
 
+    def test_address_index(self):
+        bucket = KBucket(0, 2 ** 160, 2)
+        one = mknode(ip="1.1.1.1", port=1)
+        two = mknode(ip="2.2.2.2", port=2)
+        bucket.addNode(one)
+        bucket.addNode(two)
+        moved = Node(one.id, "1.1.1.2", 1)
+        bucket.addNode(moved)
+        self.assertEqual(bucket.addresses, {("1.1.1.2", 1): moved, ("2.2.2.2", 2): two})
+        bucket.removeNode(two)
+        self.assertEqual(bucket.addresses, {("1.1.1.2", 1): moved})
+        lower, upper = bucket.split()
+        self.assertTrue(lower.addresses is bucket.addresses and upper.addresses is bucket.addresses)
+
+    def test_replacement_promotion_updates_address_index(self):
+        bucket = KBucket(0, 2 ** 160, 2)
+        nodes = [mknode(ip="10.0.0.%d" % i, port=i) for i in range(4)]
+        for node in nodes:
+            bucket.addNode(node)
+        self.assertEqual(list(bucket.replacementNodes), nodes[2:])
+        self.assertEqual(set(bucket.addresses), set([("10.0.0.0", 0), ("10.0.0.1", 1)]))
+
+        # the most recently seen replacement is promoted and indexed
+        bucket.removeNode(nodes[0])
+        self.assertEqual(bucket.getNodes(), [nodes[1], nodes[3]])
+        self.assertEqual(bucket.addresses, {("10.0.0.1", 1): nodes[1], ("10.0.0.3", 3): nodes[3]})
+
+        # a replacement whose address has been taken by another contact is dropped
+        bucket.addresses[("10.0.0.2", 2)] = mknode(ip="10.0.0.2", port=2)
+        bucket.removeNode(nodes[1])
+        self.assertEqual(bucket.getNodes(), [nodes[3]])
+        self.assertEqual(len(bucket.replacementNodes), 0)
+
+    def test_replacementNodes(self):
+        bucket = KBucket(0, 2 ** 160, 1, replacementSize=2)
+        bucket.addNode(mknode(intid=1))
+        for i in (2, 3, 4):
+            bucket.addNode(mknode(intid=i))
+        self.assertEqual([n.long_id for n in bucket.replacementNodes], [3, 4])
+
+        # the same id seen again as a new object is moved, not duplicated
+        bucket.addNode(mknode(intid=3))
+        self.assertEqual([n.long_id for n in bucket.replacementNodes], [4, 3])
+
+        # a replacement which fails is forgotten
+        bucket.removeNode(mknode(intid=4))
+        self.assertEqual([n.long_id for n in bucket.replacementNodes], [3])
+
+        bucket.addNode(mknode(intid=5))
+        lower, upper = bucket.split()
+        self.assertEqual([n.long_id for n in lower.replacementNodes], [3, 5])
+        self.assertEqual(lower.replacementNodes.maxsize, 2)
+        self.assertEqual(len(upper.replacementNodes), 0)
+
     def test_inRange(self):
         bucket = KBucket(0, 10, 10)
         self.assertTrue(bucket.hasInRange(mknode(intid=5)))
@@ -51,10 +108,40 @@ class KBucketTest(unittest.TestCase):
         self.assertTrue(bucket.hasInRange(mknode(intid=0)))
 
 
+class ContactStatsTest(unittest.TestCase):
+    def test_rtt_average(self):
+        stats = ContactStats()
+        self.assertIsNone(stats.rtt)
+        stats.response(0.8)
+        self.assertEqual(stats.rtt, 0.8)
+        stats.response(0.0)
+        self.assertAlmostEqual(stats.rtt, 0.7)
+        self.assertEqual((stats.successes, stats.failures), (2, 0))
+
+    def test_failures(self):
+        stats = ContactStats()
+        stats.failure()
+        stats.failure()
+        self.assertEqual((stats.failures, stats.consecutiveFailures), (2, 2))
+        stats.seen()
+        self.assertEqual((stats.failures, stats.consecutiveFailures), (2, 0))
+
+    def test_cost(self):
+        self.assertEqual(ContactStats().cost, ContactStats.DEFAULT_COST)
+        fast, slow, flaky = ContactStats(), ContactStats(), ContactStats()
+        for stats, rtt in ((fast, 0.1), (slow, 0.5), (flaky, 0.1)):
+            for _ in range(4):
+                stats.response(rtt)
+        for _ in range(4):
+            flaky.failure()
+        self.assertTrue(fast.cost < flaky.cost < slow.cost < ContactStats.DEFAULT_COST)
+
+
 class RoutingTableTest(unittest.TestCase):
     def setUp(self):
         self.node = Node(digest("test"), "127.0.0.1", 1234)
         self.router = RoutingTable(self, 20, self.node.id)
+        self.pinged = []
 
     def test_addContact(self):
         self.router.addContact(mknode())
@@ -73,3 +160,170 @@ class RoutingTableTest(unittest.TestCase):
         self.assertTrue(len(self.router.buckets), 1)
         self.assertTrue(len(self.router.buckets[0].nodes), 1)
         self.assertTrue(self.router.buckets[0].getNodes()[0].id == digest("asdf"))
+
+    def test_getBucketFor(self):
+        for _ in range(50):
+            self.router.splitBucket(random.randrange(len(self.router.buckets)))
+        self.assertEqual(self.router.upperBounds, [b.range[1] for b in self.router.buckets])
+        ids = [random.getrandbits(160) for _ in range(500)]
+        for bucket in self.router.buckets:
+            ids.extend(bucket.range)
+        for long_id in ids:
+            if long_id == 2 ** 160:
+                continue
+            node = Node(("%040x" % long_id).decode("hex"))
+            index = self.router.getBucketFor(node)
+            self.assertTrue(self.router.buckets[index].hasInRange(node))
+
+    def test_addSameIP_after_promotion(self):
+        router = RoutingTable(self, 2, self.node)
+        nodes = [Node(digest(i), "10.0.0.%d" % i, 1234) for i in range(3)]
+        for node in nodes:
+            router.buckets[router.getBucketFor(node)].addNode(node)
+        bucket = router.buckets[0]
+        promoted = list(bucket.replacementNodes)[-1]
+        router.removeContact(bucket.getNodes()[0])
+        self.assertTrue(promoted in bucket.getNodes())
+        self.assertEqual(router.addresses[(promoted.ip, promoted.port)], promoted)
+
+        # a new id at the promoted node's address replaces it
+        newNode = Node(digest("new"), promoted.ip, promoted.port)
+        router.addContact(newNode)
+        self.assertFalse(promoted in bucket.getNodes())
+        self.assertEqual(router.addresses[(promoted.ip, promoted.port)], newNode)
+        self.assertEqual(len(router.addresses), sum(len(b) for b in router.buckets))
+
+    def test_findNeighbors_exact(self):
+        """
+        Compare against sorting every contact by distance, for tables which have
+        split to different depths.
+        """
+        rand = random.Random(1)
+
+        def randomNode(prefix=0, bits=0):
+            long_id = prefix << (160 - bits) | rand.getrandbits(160 - bits)
+            ip = "10.0.%d.%d" % (rand.randrange(256), rand.randrange(256))
+            return Node(("%040x" % long_id).decode("hex"), ip, rand.randrange(1, 65536))
+
+        for ksize in (2, 5, 20):
+            node = randomNode()
+            router = RoutingTable(self, ksize, node)
+            for _ in range(300):
+                # bias towards our own id so buckets split deep down our side of the tree
+                bits = rand.randrange(0, 40)
+                router.addContact(randomNode(node.long_id >> (160 - bits), bits))
+            contacts = [n for bucket in router.buckets for n in bucket.getNodes()]
+            self.assertTrue(len(router.buckets) > 5)
+
+            for _ in range(100):
+                target = randomNode()
+                exclude = rand.choice(contacts) if rand.random() < 0.5 else None
+                for k in (None, 1, ksize * 3):
+                    expected = sorted((n for n in contacts if exclude is None or not n.sameHomeAs(exclude)),
+                                      key=target.distanceTo)[:k or ksize]
+                    self.assertEqual(router.findNeighbors(target, k, exclude), expected)
+
+    def callPing(self, node):
+        self.pinged.append(node)
+
+    def _snapshotTable(self):
+        router = RoutingTable(self, 3, self.node)
+        for i in range(40):
+            router.addContact(Node(digest(i), "10.0.0.%d" % i, 1234 + i, digest("key%d" % i),
+                                   ("10.1.0.1", 4321) if i % 2 else None,
+                                   objects.RESTRICTED if i % 3 else objects.FULL_CONE, i % 5 == 0))
+            if i % 4 == 0:
+                router.recordResponse(Node(digest(i)), 0.25)
+            if i % 7 == 0:
+                router.recordFailure(Node(digest(i)))
+        return router
+
+    def test_snapshot(self):
+        router = self._snapshotTable()
+        restored = RoutingTable(self, 3, self.node)
+        self.assertEqual(restored.restore(router.snapshot()), len(router.addresses))
+        self.assertEqual(restored.upperBounds, router.upperBounds)
+        for bucket, copy in zip(router.buckets, restored.buckets):
+            self.assertEqual(copy.range, bucket.range)
+            self.assertEqual(copy.lastUpdated, bucket.lastUpdated)
+            fields = lambda b: dict((i, (st.lastSeen, st.rtt, st.successes, st.failures))
+                                    for i, st in b.stats.items())
+            self.assertEqual(fields(copy), fields(bucket))
+            self.assertEqual(set(st.consecutiveFailures for st in copy.stats.values()),
+                             set([RoutingTable.MAX_FAILURES - 1]) if len(copy) else set())
+            self.assertEqual([n.getProto() for n in copy.getNodes()], [n.getProto() for n in bucket.getNodes()])
+            self.assertEqual([(n.getProto(), seen) for n, seen in copy.replacementNodes.items()],
+                             [(n.getProto(), seen) for n, seen in bucket.replacementNodes.items()])
+        self.assertEqual(set(restored.addresses), set(router.addresses))
+        self.assertEqual(set(restored.stale), set(n.id for n in router.addresses.values()))
+
+        # contacts stop being stale once heard from, or once they're checked
+        contact = restored.buckets[-1].getNodes()[0]
+        restored.addContact(Node(contact.id, contact.ip, contact.port))
+        self.assertFalse(contact.id in restored.stale)
+        checking = restored.popStale(5)
+        self.assertEqual(len(checking), 5)
+        self.assertFalse(any(n.id in restored.stale for n in checking))
+        self.assertEqual(len(restored.popStale(100)), len(router.addresses) - 6)
+        self.assertEqual(restored.stale, {})
+
+    def test_restore_rejects_bad_snapshots(self):
+        router = self._snapshotTable()
+        data = router.snapshot()
+        restored = RoutingTable(self, 3, self.node)
+        for bad in (data[:-1], data[:40] + chr(ord(data[40]) ^ 1) + data[41:], "",
+                    RoutingTable(self, 3, Node(digest("other"))).snapshot(),
+                    RoutingTable(self, 4, self.node).snapshot()):
+            self.assertRaises(SnapshotError, restored.restore, bad)
+        self.assertEqual(len(restored.buckets), 1)
+
+    def test_full_bucket_pings_stale_contact_first(self):
+        router = RoutingTable(self, 2, self.node)
+        # in the half of the id space we're not in, sharing no prefix so the bucket isn't split
+        far = [Node(("%040x" % (~self.node.long_id & 2 ** 159 | i << 153)).decode("hex"),
+                    "10.0.0.%d" % i, 1234) for i in range(4)]
+        router.addContact(far[0])
+        router.addContact(far[1])
+        router.stale[far[1].id] = far[1]
+        router.addContact(far[2])
+        self.assertEqual(self.pinged, [far[1]])
+        router.addContact(far[1])
+        router.addContact(far[3])
+        self.assertEqual(self.pinged, [far[1], far[0]])
+
+
+    def test_eviction_needs_consecutive_failures(self):
+        node = mknode(ip="10.0.0.1", port=1)
+        self.router.addContact(node)
+        for _ in range(RoutingTable.MAX_FAILURES - 1):
+            self.assertFalse(self.router.recordFailure(node))
+        self.router.addContact(node)
+        for _ in range(RoutingTable.MAX_FAILURES - 1):
+            self.assertFalse(self.router.recordFailure(node))
+        self.assertTrue(self.router.recordFailure(node))
+        self.assertEqual(self.router.getStats(node).failures, 2 * RoutingTable.MAX_FAILURES - 1)
+        self.assertTrue(self.router.recordFailure(mknode()))
+
+    def test_findNeighbors_ignores_contact_stats(self):
+        router = RoutingTable(self, 20, self.node)
+        nodes = [mknode(intid=i, ip="10.0.0.%d" % i, port=i) for i in range(8, 16)]
+        for node in nodes:
+            router.addContact(node)
+        target = mknode(intid=0)
+        router.recordResponse(nodes[5], 0.1)
+        router.recordResponse(nodes[2], 0.3)
+        router.recordFailure(nodes[0])
+        # callers such as transferKeyValues rely on the closest coming first, so
+        # fast contacts are only preferred when choosing whom to query
+        self.assertEqual(router.findNeighbors(target), nodes)
+        self.assertEqual(router.findNeighbors(target, 2), nodes[:2])
+
+    def test_full_bucket_pings_failing_contact_first(self):
+        router = RoutingTable(self, 2, self.node)
+        far = [Node(("%040x" % (~self.node.long_id & 2 ** 159 | i << 153)).decode("hex"),
+                    "10.0.0.%d" % i, 1234) for i in range(3)]
+        router.addContact(far[0])
+        router.addContact(far[1])
+        router.recordFailure(far[1])
+        router.addContact(far[2])
+        self.assertEqual(self.pinged, [far[1]])
@@ -1,10 +1,15 @@
 __author__ = 'chris'
+import os
 import time
+import shutil
+import tempfile
+from collections import MutableMapping
 
 from twisted.trial import unittest
 
 from dht.utils import digest
-from dht.storage import ForgetfulStorage, PersistentStorage, TTLDict
+from dht.storage import ForgetfulStorage, PersistentStorage, LogStorage, ShardedStorage, StorageQuota, TTLDict, \
+    TTLMap, ValueCache
 
 from protos.objects import Value
 
@@ -75,6 +80,60 @@ class ForgetFulStorageTest(unittest.TestCase):
         f[self.keyword1] = (self.key1, self.value, .00000000000001)
         self.assertTrue(self.keyword1 not in f)
 
+    def test_cull_expired_only(self):
+        f = ForgetfulStorage()
+        f[self.keyword1] = (self.key1, self.value, 10)
+        f[self.keyword2] = (self.key1, self.value, -1)
+        self.assertTrue(self.keyword2 not in f.data)
+        f[self.keyword2] = (self.key2, self.value, 10)
+        self.assertEqual(len(f.expirations), 2)
+        self.assertEqual(list(f.iterkeys()), [self.keyword1, self.keyword2])
+        self.assertEqual(f.getSpecific(self.keyword2, self.key1), None)
+        self.assertEqual(self.value, f.getSpecific(self.keyword2, self.key2))
+
+
+class ShardedStorageTest(unittest.TestCase):
+    def test_prefix(self):
+        s = ShardedStorage(prefix_bits=4)
+        self.assertEqual(len(s.shards), 16)
+        self.assertEqual(s.prefix("\xab" + "\x00" * 19), 0xa)
+        s = ShardedStorage(prefix_bits=12)
+        self.assertEqual(s.prefix("\xab\xcd" + "\x00" * 18), 0xabc)
+
+    def test_stats(self):
+        s = ShardedStorage(prefix_bits=4)
+        keyword1 = "\x10" + digest("shoes")[1:]
+        keyword2 = "\x1f" + digest("socks")[1:]
+        keyword3 = "\xf0" + digest("hats")[1:]
+        now = time.time()
+        s[keyword1] = ("key1", "value", 20)
+        s[keyword2] = ("key2", "value", 10)
+        s[keyword3] = ("key", "value", 30)
+        stats = s.stats()
+        self.assertEqual([(d["prefix"], d["values"], d["bytes"]) for d in stats], [(1, 2, 18), (15, 1, 8)])
+        self.assertTrue(now + 9 < stats[0]["oldest"] <= time.time() + 10)
+        s.delete(keyword2, "key2")
+        stats = s.stats()
+        self.assertEqual((stats[0]["values"], stats[0]["bytes"]), (1, 9))
+        self.assertTrue(now + 19 < stats[0]["oldest"] <= time.time() + 20)
+        s.delete(keyword1, "key1")
+        self.assertEqual([d["prefix"] for d in s.stats()], [15])
+
+    def test_expired(self):
+        s = ShardedStorage(prefix_bits=4)
+        s[digest("shoes")] = ("key", "value", -1)
+        s[digest("socks")] = ("key", "value", 10)
+        self.assertEqual([d["values"] for d in s.stats()], [1])
+        self.assertEqual(list(s.iterkeys()), [digest("socks")])
+
+    def test_iterkeys(self):
+        s = ShardedStorage(prefix_bits=2)
+        keywords = [chr(i * 64) + digest(i)[1:] for i in range(4)]
+        for keyword in reversed(keywords):
+            s[keyword] = ("key", "value", 10)
+        self.assertEqual(list(s.iterkeys()), keywords)
+        self.assertEqual(list(s.iterkeys(lambda prefix: prefix % 2 == 1)), [keywords[1], keywords[3]])
+
 
 class PersistentStorageTest(unittest.TestCase):
     def setUp(self):
@@ -133,6 +192,422 @@ class PersistentStorageTest(unittest.TestCase):
         p[self.keyword1] = (self.key1, self.value, .000000000001)
         self.assertTrue(p.get(self.keyword1) is None)
 
+    def test_batched_flush(self):
+        p = PersistentStorage(":memory:")
+        p[self.keyword1] = (self.key1, self.value, 10)
+        p[self.keyword1] = (self.key2, self.value, 10)
+        p[self.keyword2] = (self.key1, self.value, 10)
+        self.assertEqual(len(p.pending), 3)
+        self.assertTrue(p.flushCall.active())
+        p.flush()
+        self.assertEqual(p.pending, [])
+        self.assertTrue(p.flushCall is None)
+        self.assertEqual(len(p[self.keyword1]), 2)
+        self.assertEqual(len(p[self.keyword2]), 1)
+
+    def test_duplicate_key(self):
+        p = PersistentStorage(":memory:")
+        p[self.keyword1] = (self.key1, self.value, 10)
+        p[self.keyword1] = (self.key1, "other value", 10)
+        p[self.keyword2] = (self.key1, "other value", 10)
+        self.assertEqual(len(p[self.keyword1]), 1)
+        self.assertEqual(self.value, p.getSpecific(self.keyword1, self.key1))
+        self.assertEqual(sorted(p.iterkeys()), sorted([self.keyword1, self.keyword2]))
+
+    def test_restore_expired_before_cull(self):
+        p = PersistentStorage(":memory:")
+        p.store_many([(self.keyword1, self.key1, self.value, 0.05)])
+        time.sleep(0.1)
+        p.store_many([(self.keyword1, self.key1, "new", 100)])
+        self.assertEqual(p.getSpecific(self.keyword1, self.key1), "new")
+        p.cull()
+        self.assertEqual(len(p.get(self.keyword1)), 1)
+        self.assertEqual((p.entries, p.size), (1, len(self.key1) + len("new")))
+
+    def test_binary_keys(self):
+        p = PersistentStorage(":memory:")
+        keyword = "\x00" * 20
+        p[keyword] = ("\x00\x01", "\x00\x02", 10)
+        p[keyword] = ("\x00\x02", "\x00\x02", 10)
+        self.assertEqual(list(p.iterkeys()), [keyword])
+        self.assertEqual(list(p.iteritems(keyword)), [("\x00\x01", "\x00\x02"), ("\x00\x02", "\x00\x02")])
+
+    def test_paged_iteration(self):
+        p = PersistentStorage(":memory:", page_size=2)
+        keywords = [digest(i) for i in range(5)]
+        keys = [digest("key%s" % i) for i in range(5)]
+        for keyword in keywords:
+            for key in keys:
+                p[keyword] = (key, self.value, 10)
+        self.assertEqual(list(p.iterkeys()), sorted(keywords))
+        self.assertEqual(list(p.iteritems(keywords[0])), [(k, self.value) for k in sorted(keys)])
+
+    def test_cull(self):
+        p = PersistentStorage(":memory:")
+        p[self.keyword1] = (self.key1, self.value, 10)
+        p[self.keyword1] = (self.key2, self.value, -1)
+        self.assertEqual(p.getSpecific(self.keyword1, self.key2), None)
+        p.cull()
+        cursor = p.db.cursor()
+        cursor.execute('''SELECT id FROM dht''')
+        self.assertEqual([str(row[0]) for row in cursor.fetchall()], [self.key1])
+
+
+class LogStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.keyword1 = digest("shoes")
+        self.keyword2 = digest("socks")
+        self.key1 = digest("contract1")
+        self.key2 = digest("contract2")
+        self.value = digest("node")
+        self.path = tempfile.mkdtemp()
+        self.storages = []
+
+    def tearDown(self):
+        for s in self.storages:
+            s.close()
+        shutil.rmtree(self.path)
+
+    def _open(self, **kwargs):
+        s = LogStorage(self.path, **kwargs)
+        self.storages.append(s)
+        return s
+
+    def test_setitem(self):
+        s = self._open()
+        s[self.keyword1] = (self.key1, self.value, 10)
+        s[self.keyword1] = (self.key1, "other", 10)
+        s[self.keyword1] = (self.key2, self.value, 10)
+        self.assertEqual([(k, v) for k, v, _ in s[self.keyword1]],
+                         [(self.key1, self.value), (self.key2, self.value)])
+        self.assertRaises(KeyError, s.__getitem__, self.keyword2)
+
+    def test_get(self):
+        s = self._open()
+        s[self.keyword1] = (self.key1, self.value, 10)
+        v = Value()
+        v.valueKey = self.key1
+        v.serializedData = self.value
+        v.ttl = 10
+        self.assertEqual(s.get(self.keyword1), [v.SerializeToString()])
+        self.assertEqual(s.get(self.keyword2, False), False)
+
+    def test_getSpecific(self):
+        s = self._open()
+        s[self.keyword1] = (self.key1, self.value, 10)
+        self.assertEqual(s.getSpecific(self.keyword1, self.key1), self.value)
+        self.assertEqual(s.getSpecific(self.keyword1, self.key2), None)
+
+    def test_delete(self):
+        s = self._open()
+        s[self.keyword1] = (self.key1, self.value, 10)
+        s.delete(self.keyword1, self.key1)
+        self.assertEqual(s.get(self.keyword1), None)
+        self.assertEqual(s.entries, 0)
+
+    def test_iter(self):
+        s = self._open()
+        s[self.keyword1] = (self.key1, self.value, 10)
+        s[self.keyword2] = (self.key2, self.value, 10)
+        self.assertEqual(list(s.iterkeys()), [self.keyword1, self.keyword2])
+        self.assertEqual(list(s.iteritems(self.keyword2)), [(self.key2, self.value)])
+
+    def test_ttl(self):
+        s = self._open()
+        s[self.keyword1] = (self.key1, self.value, 10)
+        self.assertTrue(9 < s.get_ttl(self.keyword1, self.key1) <= 10)
+
+    def test_cull(self):
+        s = self._open()
+        s[self.keyword1] = (self.key1, self.value, -1)
+        s[self.keyword1] = (self.key2, self.value, 10)
+        s.cull()
+        self.assertEqual([k for k, _, _ in s[self.keyword1]], [self.key2])
+        s[self.keyword1] = (self.key1, "new", 10)
+        self.assertEqual(s.getSpecific(self.keyword1, self.key1), "new")
+
+    def test_cull_counts_expired_records(self):
+        s = self._open()
+        s[self.keyword1] = (self.key1, self.value, 0.05)
+        s[self.keyword1] = (self.key2, self.value, 10)
+        size = s.size
+        time.sleep(0.1)
+        s.cull()
+        self.assertEqual(s.entries, 1)
+        self.assertTrue(s.size < size)
+        self.assertEqual(s.active.live, 1)
+        self.assertEqual(s.active.dead, size - s.size)
+
+        # storing an expired key again replaces its record
+        s[self.keyword2] = (self.key1, self.value, 0.05)
+        time.sleep(0.1)
+        s[self.keyword2] = (self.key1, self.value, 10)
+        self.assertEqual(s.entries, 2)
+        self.assertEqual(s.active.live, 2)
+
+    def test_get_all_expired(self):
+        s = self._open()
+        s[self.keyword1] = (self.key1, self.value, 0.05)
+        time.sleep(0.1)
+        # expired but not culled yet
+        s.expirations = []
+        self.assertEqual(s.get(self.keyword1), None)
+        self.assertEqual(s.get(self.keyword1, False), False)
+
+    def test_recovery(self):
+        s = self._open(segment_size=4096)
+        for i in range(100):
+            s[digest(i % 7)] = (digest(i), "v" * 50, 100)
+        s.delete(digest(0), digest(0))
+        s.close()
+        self.assertTrue(len([name for name in os.listdir(self.path) if name.endswith(".hint")]) > 0)
+        s = self._open(segment_size=4096)
+        self.assertEqual(s.entries, 99)
+        self.assertEqual(s.getSpecific(digest(0), digest(0)), None)
+        self.assertEqual(s.getSpecific(digest(1), digest(8)), "v" * 50)
+        self.assertTrue(99 < s.get_ttl(digest(1), digest(8)) <= 100)
+
+    def test_torn_write(self):
+        s = self._open()
+        s[self.keyword1] = (self.key1, self.value, 10)
+        s[self.keyword1] = (self.key2, self.value, 10)
+        # corrupt the last record as if the write never finished
+        s.active.map[s.active.end - 1] = "x"
+        s.close()
+        s = self._open()
+        self.assertEqual([k for k, _, _ in s[self.keyword1]], [self.key1])
+        s[self.keyword2] = (self.key2, self.value, 10)
+        s.close()
+        s = self._open()
+        self.assertEqual(s.entries, 2)
+        self.assertEqual(s.getSpecific(self.keyword2, self.key2), self.value)
+
+    def test_record_too_large(self):
+        s = self._open(segment_size=1024)
+        self.assertRaises(ValueError, s.__setitem__, self.keyword1, (self.key1, "v" * 2000, 10))
+
+    def test_compaction(self):
+        s = self._open(segment_size=4096, compact_ratio=2)
+        for i in range(100):
+            s[digest(i % 7)] = (digest(i), "v" * 50, 100)
+        segments = s.segments.keys()
+        for i in range(0, 100, 2):
+            s.delete(digest(i % 7), digest(i))
+        s.compact_ratio = 0.5
+        compactions = []
+        s.compact = lambda: compactions.append(True)
+        s.cull()
+        self.assertEqual(compactions, [True])
+        for _ in s._compact():  # pylint: disable=protected-access
+            pass
+        self.assertFalse(segments[0] in s.segments)
+        self.assertFalse(os.path.exists(os.path.join(self.path, "%08d.log" % segments[0])))
+        self.assertEqual(s.entries, 50)
+        for i in range(1, 100, 2):
+            self.assertEqual(s.getSpecific(digest(i % 7), digest(i)), "v" * 50)
+        s.close()
+        s = self._open(segment_size=4096)
+        self.assertEqual(s.entries, 50)
+        for i in range(100):
+            self.assertEqual(s.getSpecific(digest(i % 7), digest(i)), "v" * 50 if i % 2 else None)
+
+
+class StoreManyTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _storages(self):
+        return [ForgetfulStorage(), PersistentStorage(":memory:"), LogStorage(self.path)]
+
+    def test_store_many(self):
+        values = [(digest(i / 10), digest(i), "value", 10) for i in range(10000)]
+        for s in self._storages():
+            s[digest(0)] = (digest(0), "first", 10)
+            s.store_many(values)
+            self.assertEqual(s.entries, 10000)
+            self.assertEqual(len(list(s.iterkeys())), 1000)
+            self.assertEqual(s.getSpecific(digest(0), digest(0)), "first")
+            self.assertEqual(s.getSpecific(digest(999), digest(9999)), "value")
+            self.assertTrue(9 < s.get_ttl(digest(999), digest(9999)) <= 10)
+
+    def test_store_many_single_transaction(self):
+        s = PersistentStorage(":memory:")
+        commits = []
+        s.db = _CountingConnection(s.db, commits)
+        s.store_many([(digest(i / 10), digest(i), "value", 10) for i in range(10000)])
+        self.assertEqual(len(commits), 1)
+        self.assertEqual(s.pending, [])
+
+    def test_store_many_origin(self):
+        for s in self._storages()[:2]:
+            s.quota = StorageQuota(digest("node"), max_per_origin=2)
+            s.store_many([(digest("shoes"), digest(i), "value", 10, digest("them")) for i in range(3)])
+            self.assertEqual(s.entries, 2)
+            self.assertEqual(s.quota.rejections["origin"], 1)
+
+
+class _CountingConnection(object):
+    def __init__(self, db, commits):
+        self.db = db
+        self.commits = commits
+
+    def commit(self):
+        self.commits.append(True)
+        self.db.commit()
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
+class StorageQuotaTest(unittest.TestCase):
+    def setUp(self):
+        self.near = digest("shoes")
+        self.far = digest("socks")
+        self.node1 = digest("node1")
+        self.node2 = digest("node2")
+
+    def _storages(self, **kwargs):
+        return [ForgetfulStorage(quota=StorageQuota(self.near, **kwargs)),
+                PersistentStorage(":memory:", quota=StorageQuota(self.near, **kwargs))]
+
+    @staticmethod
+    def _keys(storage, keyword):
+        keys = []
+        for v in storage.get(keyword, []):
+            value = Value()
+            value.ParseFromString(v)
+            keys.append(value.valueKey)
+        return sorted(keys)
+
+    def test_distance(self):
+        quota = StorageQuota(self.near)
+        self.assertEqual(quota.distance(self.near), 0)
+        self.assertTrue(quota.distance(self.far) > 0)
+
+    def test_max_per_keyword(self):
+        for s in self._storages(max_per_keyword=2):
+            for i in range(3):
+                s[self.near] = (digest(i), "value", 10)
+            self.assertEqual(self._keys(s, self.near), sorted([digest(0), digest(1)]))
+            self.assertEqual(s.quota.rejections["keyword"], 1)
+
+    def test_max_per_origin(self):
+        for s in self._storages(max_per_origin=1):
+            s[self.near] = (digest(0), "value", 10, self.node1)
+            s[self.far] = (digest(1), "value", 10, self.node1)
+            s[self.far] = (digest(2), "value", 10, self.node2)
+            s[self.far] = (digest(3), "value", 10)
+            self.assertEqual(len(s[self.near]), 1)
+            self.assertEqual(self._keys(s, self.far), sorted([digest(2), digest(3)]))
+            self.assertEqual(s.quota.rejections["origin"], 1)
+
+    def test_evict_farthest_entries(self):
+        for s in self._storages(max_entries=3):
+            s[self.far] = (digest(0), "value", 10)
+            s[self.far] = (digest(1), "value", 10)
+            s[self.near] = (digest(2), "value", 10)
+            s[self.near] = (digest(3), "value", 10)
+            self.assertEqual(len(s[self.near]), 2)
+            self.assertEqual(len(s[self.far]), 1)
+            self.assertEqual(s.entries, 3)
+            self.assertEqual(s.quota.evictions["entries"], 1)
+
+    def test_evict_farthest_bytes(self):
+        for s in self._storages(max_bytes=100):
+            s[self.far] = ("key", "v" * 40, 10)
+            s[self.near] = ("key", "v" * 40, 10)
+            s[self.near] = ("key2", "v" * 40, 10)
+            self.assertEqual(s.get(self.far), None)
+            self.assertEqual(len(s[self.near]), 2)
+            self.assertEqual(s.size, 87)
+            self.assertEqual(s.quota.evictions["bytes"], 1)
+
+    def test_farthest_heap_bounded(self):
+        s = ForgetfulStorage(quota=StorageQuota(self.near, max_entries=10))
+        for i in range(100):
+            s[self.far] = ("key", "value", 10)
+            s.delete(self.far, "key")
+            s[digest(i)] = ("key", "value", 10)
+            s.delete(digest(i), "key")
+        self.assertTrue(len(s.farthest) <= 3)
+        self.assertEqual(len([entry for entry in s.farthest if entry[1] == self.far]), 1)
+
+    def test_counters_follow_delete_and_cull(self):
+        for s in self._storages():
+            s[self.near] = ("key1", "value", 10)
+            s[self.near] = ("key2", "value", -1)
+            s[self.far] = ("key", "value", 10)
+            s.delete(self.far, "key")
+            s.cull()
+            self.assertEqual((s.entries, s.size), (1, 9))
+
+
+class ValueCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.keyword = digest("shoes")
+
+    @staticmethod
+    def _storages():
+        return [ForgetfulStorage(), PersistentStorage(":memory:")]
+
+    def test_matches_protobuf(self):
+        cache = ValueCache()
+        now = time.time()
+        ttls = (0, 1, 127, 128, 16384, 604800)
+        ret = cache.put(self.keyword, [(digest(ttl), "value", now + ttl) for ttl in ttls], now)
+        for serialized, ttl in zip(ret, ttls):
+            value = Value()
+            value.valueKey = digest(ttl)
+            value.serializedData = "value"
+            value.ttl = ttl
+            self.assertEqual(serialized, value.SerializeToString())
+
+    def test_hit(self):
+        for s in self._storages():
+            s[self.keyword] = ("key", "value", 10)
+            first = s.get(self.keyword)
+            self.assertEqual(s.get(self.keyword), first)
+            self.assertEqual((s.cache.hits, s.cache.misses), (1, 1))
+
+    def test_invalidated_on_store_and_delete(self):
+        for s in self._storages():
+            s[self.keyword] = ("key1", "value", 10)
+            self.assertEqual(len(s.get(self.keyword)), 1)
+            s[self.keyword] = ("key2", "value", 10)
+            self.assertEqual(len(s.get(self.keyword)), 2)
+            s.delete(self.keyword, "key1")
+            self.assertEqual(len(s.get(self.keyword)), 1)
+            self.assertEqual(s.cache.hits, 0)
+
+    def test_invalidated_on_expiry(self):
+        for s in self._storages():
+            s[self.keyword] = ("key1", "value", 0.05)
+            s[self.keyword] = ("key2", "value", 10)
+            self.assertEqual(len(s.get(self.keyword)), 2)
+            time.sleep(0.1)
+            self.assertEqual(len(s.get(self.keyword)), 1)
+            self.assertEqual(s.cache.hits, 0)
+
+    def test_expired_before_cull(self):
+        self.assertEqual(ValueCache().put(self.keyword, [], time.time()), [])
+        s = ForgetfulStorage()
+        s[self.keyword] = ("key1", "value", 0.05)
+        time.sleep(0.1)
+        s.expirations = []
+        self.assertEqual(s.get(self.keyword), None)
+
+    def test_lru(self):
+        cache = ValueCache(size=2)
+        now = time.time()
+        for keyword in ("a", "b"):
+            cache.put(keyword, [("key", "value", now + 10)], now)
+        cache.get("a", now)
+        cache.put("c", [("key", "value", now + 10)], now)
+        self.assertEqual(cache.entries.keys(), ["a", "c"])
+
 
 class TTLDictTest(unittest.TestCase):
     """ TTLDict tests """
@@ -211,3 +686,69 @@ class TTLDictTest(unittest.TestCase):
 
         # remove=False, so nothing should be gone
         self.assertEqual(len(ttl_dict), 2)
+
+
+class TTLMapTest(unittest.TestCase):
+    """ TTLMap tests """
+
+    def test_get_set(self):
+        ttl_map = TTLMap(60)
+        ttl_map['a'] = 1
+        self.assertEqual(ttl_map['a'], 1)
+        self.assertEqual(ttl_map.get('b'), None)
+        self.assertTrue('a' in ttl_map)
+        self.assertFalse('b' in ttl_map)
+        self.assertEqual(ttl_map.items(), [('a', 1)])
+
+    def test_equals_ttl_dict(self):
+        ttl_map = TTLMap(60)
+        ttl_dict = TTLDict(60)
+        ttl_map['a'] = ttl_dict['a'] = 1
+        self.assertEqual(ttl_map, ttl_dict)
+        self.assertEqual(ttl_dict, ttl_map)
+        ttl_map['b'] = 2
+        self.assertNotEqual(ttl_map, ttl_dict)
+
+    def test_equals(self):
+        ttl_map, other = TTLMap(60), TTLMap(None)
+        ttl_map['a'] = other['a'] = 1
+        self.assertEqual(ttl_map, other)
+        self.assertEqual(ttl_map, {'a': 1})
+        ttl_map.expire_at('a', time.time() - 1)
+        self.assertEqual(ttl_map, {})
+        self.assertNotEqual(ttl_map, other)
+        # only the parts of the dict interface storage uses are provided
+        self.assertFalse(isinstance(ttl_map, MutableMapping))
+
+    def test_lazy_expiry(self):
+        ttl_map = TTLMap(60)
+        ttl_map['a'] = 1
+        ttl_map['b'] = 2
+        ttl_map.expire_at('a', time.time() - 1)
+        self.assertEqual(len(ttl_map), 2)
+        self.assertEqual(list(ttl_map), ['b'])
+        self.assertFalse('a' in ttl_map)
+        self.assertRaises(KeyError, lambda: ttl_map['a'])
+        self.assertEqual(len(ttl_map), 2)
+        ttl_map.cull()
+        self.assertEqual(len(ttl_map), 1)
+
+    def test_cull(self):
+        ttl_map = TTLMap(-1)
+        ttl_map['a'] = 1
+        ttl_map['b'] = 2
+        ttl_map.set_ttl('b', 60)
+        ttl_map['c'] = 3
+        ttl_map.cull()
+        self.assertEqual(ttl_map._keys, ['b'])
+        self.assertEqual(ttl_map['b'], 2)
+
+    def test_set_ttl_get_ttl(self):
+        ttl_map = TTLMap(None)
+        ttl_map['a'] = 1
+        self.assertFalse(ttl_map.is_expired('a'))
+        ttl_map.set_ttl('a', 3)
+        self.assertTrue(ttl_map.get_ttl('a') <= 3.0)
+        self.assertTrue(ttl_map.is_expired('a', now=time.time() + 4))
+        self.assertRaises(KeyError, ttl_map.set_ttl, 'missing', 10)
+        self.assertRaises(KeyError, ttl_map.get_ttl, 'missing')
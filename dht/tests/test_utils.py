@@ -3,7 +3,7 @@ import hashlib
 from twisted.trial import unittest
 from twisted.internet import defer
 
-from dht.utils import digest, sharedPrefix, OrderedSet, deferredDict
+from dht.utils import digest, sharedPrefix, deferredDict
 
 
 class UtilsTest(unittest.TestCase):
@@ -46,13 +46,3 @@ class UtilsTest(unittest.TestCase):
         for v in ds.itervalues():
             v.callback("True")
         deferredDict({}).addCallback(checkEmpty)
-
-
-class OrderedSetTest(unittest.TestCase):
-    def test_order(self):
-        o = OrderedSet()
-        o.push('1')
-        o.push('1')
-        o.push('2')
-        o.push('1')
-        self.assertEqual(o, ['2', '1'])
@@ -25,15 +25,6 @@ class FakeProtocol(object):
         self.storage = {}
         self.sourceID = sourceID
 
-    def getRefreshIDs(self):
-        """
-        Get ids to search for to keep old buckets up to date.
-        """
-        ids = []
-        for bucket in self.router.getLonelyBuckets():
-            ids.append(random.randint(*bucket.range))
-        return ids
-
     def rpc_ping(self, sender, nodeid):
         source = Node(nodeid, sender[0], sender[1])
         self.router.addContact(source)
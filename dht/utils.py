@@ -42,21 +42,6 @@ def deferredDict(d):
     return dl.addCallback(handle, d.keys())
 
 
-class OrderedSet(list):
-    """
-    Acts like a list in all ways, except in the behavior of the :meth:`push` method.
-    """
-
-    def push(self, thing):
-        """
-        1. If the item exists in the list, it's removed
-        2. The item is pushed to the end of the list
-        """
-        if thing in self:
-            self.remove(thing)
-        self.append(thing)
-
-
 def sharedPrefix(args):
     """
     Find the shared prefix between the strings.
@@ -294,7 +294,7 @@ class Server(object):
         u.bitcoin_key.MergeFrom(k)
         u.moderator = True
         Profile(self.db).update(u)
-        proto = self.kserver.node.getProto().SerializeToString()
+        proto = self.kserver.node.getSerializedProto()
         self.kserver.set(digest("moderators"), digest(proto), proto)
         self.log.info("setting self as moderator on the network")
 
@@ -303,7 +303,7 @@ class Server(object):
         Deletes our moderator entry from the network.
         """
 
-        key = digest(self.kserver.node.getProto().SerializeToString())
+        key = digest(self.kserver.node.getSerializedProto())
         signature = self.signing_key.sign(key)[:64]
         self.kserver.delete("moderators", key, signature)
         Profile(self.db).remove_field("moderator")
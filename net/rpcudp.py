@@ -4,6 +4,7 @@ Copyright (c) 2015 OpenBazaar
 """
 
 import abc
+import time
 import random
 from base64 import b64encode
 from config import PROTOCOL_VERSION
@@ -74,11 +75,12 @@ class RPCProtocol:
             self.log.debug("received response for message id %s from %s" % msgargs)
         else:
             self.log.warning("received 404 error response from %s" % sender)
-        d = self._outstanding[msgID][0]
-        if self._outstanding[msgID][2].active():
-            self._outstanding[msgID][2].cancel()
+        d, _, timeout, sent = self._outstanding[msgID]
+        if timeout.active():
+            timeout.cancel()
         d.callback((True, data))
         del self._outstanding[msgID]
+        self.router.recordResponse(sender, time.time() - sent)
 
     def _acceptRequest(self, msgID, funcname, args, sender, connection):
         self.log.debug("received request from %s, command %s" % (sender, funcname.upper()))
@@ -116,6 +118,8 @@ class RPCProtocol:
         """
         This timeout is called by the txrudp connection handler. We will run through the
         outstanding messages and callback false on any waiting on this IP address.
+        Closing the connection isn't counted against the node, only requests which go
+        unanswered for the wait timeout are, see _timedOut.
         """
         address = (node.ip, node.port)
         for msgID, val in self._outstanding.items():
@@ -125,12 +129,23 @@ class RPCProtocol:
                     self._outstanding[msgID][2].cancel()
                 del self._outstanding[msgID]
 
-        self.router.removeContact(node)
         try:
             self.multiplexer[address].shutdown()
         except Exception:
             pass
 
+    def _timedOut(self, msgID, node):
+        """
+        Called when the request msgID to node has gone unanswered for the wait timeout.
+        This is counted as one failure, and the node is removed from the routing table
+        once it has failed several times in a row.
+        """
+        if msgID not in self._outstanding:
+            return
+        if self.router.recordFailure(node):
+            self.router.removeContact(node)
+        self.timeout(node)
+
     def rpc_hole_punch(self, sender, ip, port, relay="False"):
         """
         A method for handling an incoming HOLE_PUNCH message. Relay the message
@@ -179,8 +194,8 @@ class RPCProtocol:
 
             d = defer.Deferred()
             if m.command != HOLE_PUNCH:
-                timeout = reactor.callLater(self._waitTimeout, self.timeout, node)
-                self._outstanding[msgID] = [d, address, timeout]
+                timeout = reactor.callLater(self._waitTimeout, self._timedOut, msgID, node)
+                self._outstanding[msgID] = [d, address, timeout, time.time()]
                 self.log.debug("calling remote function %s on %s (msgid %s)" % (name, address, b64encode(msgID)))
 
             self.multiplexer.send_message(data, address, relay_addr)
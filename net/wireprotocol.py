@@ -61,6 +61,7 @@ class OpenBazaarProtocol(ConnectionMultiplexer):
             self.addr = None
             self.ban_score = None
             self.is_new_node = True
+            self.verified_guid = None
             self.on_connection_made()
             self.time_last_message = 0
 
@@ -96,6 +97,10 @@ class OpenBazaarProtocol(ConnectionMultiplexer):
                     pow_hash = h[40:]
                     if int(pow_hash[:6], 16) >= 50 or m.sender.guid.encode("hex") != h[:40]:
                         raise Exception('Invalid GUID')
+                    self.verified_guid = m.sender.guid
+                if m.sender.guid == self.verified_guid:
+                    # remember where to reach the sender so resolving it doesn't need a crawl
+                    self.processors[0].contacts.add(self.node)
                 for processor in self.processors:
                     if m.command in processor or m.command == NOT_FOUND:
                         processor.receive_message(m, self.node, self.connection)
@@ -11,12 +11,13 @@ import urllib2
 from api.ws import WSFactory, AuthenticatedWebSocketProtocol, AuthenticatedWebSocketFactory
 from api.restapi import RestAPI
 from config import DATA_FOLDER, KSIZE, ALPHA, LIBBITCOIN_SERVER,\
-    LIBBITCOIN_SERVER_TESTNET, SSL_KEY, SSL_CERT, SEEDS, SSL
+    LIBBITCOIN_SERVER_TESTNET, SSL_KEY, SSL_CERT, SEEDS, SSL, DHT_STORAGE, DHT_MAX_ENTRIES, \
+    DHT_MAX_BYTES, DHT_MAX_PER_KEYWORD, DHT_MAX_PER_ORIGIN
 from daemon import Daemon
 from db.datastore import Database
 from dht.network import Server
 from dht.node import Node
-from dht.storage import PersistentStorage, ForgetfulStorage
+from dht.storage import PersistentStorage, ShardedStorage, LogStorage, StorageQuota
 from keys.credentials import get_credentials
 from keys.keychain import KeyChain
 from log import Logger, FileLogObserver
@@ -79,7 +80,14 @@ def run(*args):
                                       relaying=True if nat_type == FULL_CONE else False)
 
         # kademlia
-        storage = ForgetfulStorage() if TESTNET else PersistentStorage(db.get_database_path())
+        quota = StorageQuota(keys.guid, max_bytes=DHT_MAX_BYTES, max_entries=DHT_MAX_ENTRIES,
+                             max_per_keyword=DHT_MAX_PER_KEYWORD, max_per_origin=DHT_MAX_PER_ORIGIN)
+        if TESTNET or DHT_STORAGE == "memory":
+            storage = ShardedStorage(quota=quota)
+        elif DHT_STORAGE == "log":
+            storage = LogStorage(DATA_FOLDER + "dht")
+        else:
+            storage = PersistentStorage(db.get_database_path(), quota=quota)
         relay_node = None
         if nat_type != FULL_CONE:
             for seed in SEEDS:
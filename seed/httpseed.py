@@ -157,7 +157,7 @@ def run(*args):
                     elif request.args["format"][0] == "protobuf":
                         proto = peers.PeerSeeds()
                         for node in nodes[:50]:
-                            proto.serializedNode.append(node.getProto().SerializeToString())
+                            proto.serializedNode.append(node.getSerializedProto())
 
                         sig = signing_key.sign("".join(proto.serializedNode))[:64]
                         proto.signature = sig
@@ -168,7 +168,7 @@ def run(*args):
                     if "type" in request.args and request.args["type"][0] == "vendors":
                         for node in nodes:
                             if node.vendor is True:
-                                proto.serializedNode.append(node.getProto().SerializeToString())
+                                proto.serializedNode.append(node.getSerializedProto())
 
                         sig = signing_key.sign("".join(proto.serializedNode))[:64]
                         proto.signature = sig
@@ -176,7 +176,7 @@ def run(*args):
                         request.write(uncompressed_data.encode("zlib"))
                     else:
                         for node in nodes[:50]:
-                            proto.serializedNode.append(node.getProto().SerializeToString())
+                            proto.serializedNode.append(node.getSerializedProto())
 
                         sig = signing_key.sign("".join(proto.serializedNode))[:64]
                         proto.signature = sig